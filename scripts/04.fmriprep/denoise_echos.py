@@ -5,54 +5,81 @@ import json
 import re
 import os
 import os.path as op
-import pandas as pd
 import numpy as np
 import argparse
 import shutil
 import subprocess
 import nibabel as nib
+import sys
+import traceback
 from tedana import workflows
-from multiprocessing import Pool
 from nilearn import image
 from nilearn.image import resample_to_img, math_img, load_img
 
-# define function that will extract echo information and run tedana
-def denoise_echoes(sub, session, bidsDir, derivDir, cores):
+# add misc folder to path to import shared image writer and subject executor functions
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from parallel_gzip import save_nifti
+from subject_executor import run_subjects
+
+# estimated memory used by tedana relative to the size of the echo data as float64 (the data are copied several times during decomposition)
+tedana_memory_factor = 3
+
+# define function that will find the runs for a subject and return a tedana job for each run that hasn't been denoised
+def collect_jobs(sub, session, derivDir):
     # define subject files prefix based on whether session information is used
     if session == 'yes':
         sub_prefix = op.join(derivDir, '{}'.format(sub), 'ses-01')
     else:
         sub_prefix = op.join(derivDir, '{}'.format(sub))
     
-    # grab grey and white matter mask files (we want to use native space files, not MNI files)
-    gm_mask = glob.glob(op.join(sub_prefix, 'anat', '{}*_label-GM_probseg.nii.gz'.format(sub)))
-    wm_mask = glob.glob(op.join(sub_prefix, 'anat', '{}*_label-WM_probseg.nii.gz'.format(sub)))
-    
-    # remove MNI space masks
-    gm_mask = [m for m in gm_mask if 'MNI' not in m][0]
-    wm_mask = [m for m in wm_mask if 'MNI' not in m][0]
-    
-    # confirm that masks were found
-    if len(gm_mask) == 0 or len(wm_mask) == 0:
-        print('No brain masks found for {}'.format(sub))
-    
     # grab echo bold files
     echo_imgs = glob.glob(op.join(sub_prefix, 'func', '*_echo-*_bold.nii.gz'))
     
     # extract file prefixes before echoes (i.e., individual runs)
     prefix_list = [re.search('(.*)_echo-',f).group(1) for f in echo_imgs]
-    prefix_list = set(prefix_list)
+    prefix_list = sorted(set(prefix_list))
     
     # loop through each unique task/run
-    dat = []
+    jobs = []
     for run in prefix_list:
         # extract task and run info
         task = re.search('task-(.*)', run).group(1)
         
-        # make tedana output directory
+        # skip runs that were already denoised
         outDir = op.join(sub_prefix, 'func', 'tedana/{}'.format(task))
+        if os.path.isfile(op.join(outDir, '{}_task-{}_tedana_report.html'.format(sub, task))):
+            print('Skipping tedana because tedana outputs found for {} task-{}'.format(sub, task))
+            continue
+        
+        # estimate memory from the shape of the echo files (the data aren't loaded)
+        run_echoes = [f for f in echo_imgs if f.startswith('{}_echo-'.format(run))]
+        nbytes = sum(np.prod(nib.load(f).shape) for f in run_echoes) * 8
+        memory_gb = tedana_memory_factor * nbytes / 1024**3
+        
+        jobs.append({'sub': sub, 'task': task, 'run': run, 'sub_prefix': sub_prefix, 'outDir': outDir, 'memory_gb': memory_gb})
+    
+    return jobs
+
+# define function that will create the masks, extract echo information, and run tedana for a run (failed runs are added to failed so other runs continue)
+def denoise_run(job, failed):
+    sub = job['sub']
+    task = job['task']
+    run = job['run']
+    sub_prefix = job['sub_prefix']
+    outDir = job['outDir']
+    
+    try:
+        # make tedana output directory
         os.makedirs(outDir, exist_ok=True)
         
+        # grab grey and white matter mask files (we want to use native space files, not MNI files)
+        gm_mask = glob.glob(op.join(sub_prefix, 'anat', '{}*_label-GM_probseg.nii.gz'.format(sub)))
+        wm_mask = glob.glob(op.join(sub_prefix, 'anat', '{}*_label-WM_probseg.nii.gz'.format(sub)))
+        
+        # remove MNI space masks
+        gm_mask = [m for m in gm_mask if 'MNI' not in m][0]
+        wm_mask = [m for m in wm_mask if 'MNI' not in m][0]
+        
         # grab bold and mask file
         bold_file = glob.glob(op.join('{}_echo-*1_desc-preproc_bold.nii.gz'.format(run)))[0]
         bold_mask = op.join('{}_desc-brain_mask.nii.gz'.format(run))
@@ -123,7 +150,7 @@ def denoise_echoes(sub, session, bidsDir, derivDir, cores):
             zooms = img_dat.header.get_zooms()
             new_zooms = (zooms[0], zooms[1], zooms[2], tr)
             img_dat.header.set_zooms(new_zooms)
-            nib.save(img_dat, img[0])
+            save_nifti(img_dat, img[0]) # written to a temporary file first, so the file isn't overwritten while it is being read
             
             # add run to run_list
             run_list.append(img)
@@ -138,22 +165,41 @@ def denoise_echoes(sub, session, bidsDir, derivDir, cores):
                     run_imgs.append(item)
             else:
                run_imgs.append(element)
-               
-        # make a dataframe with sub, input files, and echo times
-        dat.append([sub, task, run_imgs, dilated_mask_file, echo_times, outDir])
-    
+        
         print('Outputs will be saved to {}'.format(outDir))
-        tedana_df = pd.DataFrame(data=dat, columns=['sub', 'task', 'EchoFiles', 'MaskFile', 'EchoTimes', 'outDir'])
-        args=zip(tedana_df['sub'].tolist(),
-                 tedana_df['task'].tolist(),
-                 tedana_df['EchoFiles'].tolist(),
-                 tedana_df['MaskFile'].tolist(),
-                 tedana_df['EchoTimes'].tolist(),
-                 tedana_df['outDir'].tolist())
-             
+        
         # run tedana
-        pool = Pool(cores)
-        results = pool.starmap(call_tedana, args)
+        call_tedana(sub, task, run_imgs, dilated_mask_file, echo_times, outDir)
+    
+    except Exception:
+        traceback.print_exc()
+        print('ERROR: tedana failed for {} task-{}'.format(sub, task))
+        failed.append('{}_task-{}'.format(sub, task))
+
+# define function that will run tedana for all runs of all subjects in a single pool of processes
+def denoise_echoes(subjects, session, bidsDir, derivDir, cores, memory_gb=None):
+    # collect runs across all subjects
+    jobs = []
+    for sub in subjects:
+        jobs.extend(collect_jobs(sub, session, derivDir))
+    
+    if not jobs:
+        print('All runs have already been denoised')
+        return
+    
+    # limit the number of runs processed at the same time by the number of cores and the memory available
+    if memory_gb is None:
+        memory_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') / 1024**3
+    max_job_gb = max(job['memory_gb'] for job in jobs)
+    n_workers = max(1, min(cores, len(jobs), int(memory_gb // max_job_gb) if max_job_gb > 0 else cores))
+    print('Running tedana for {} runs using {} processes (estimated memory per run up to {:.1f}GB, {:.1f}GB available)'.format(len(jobs), n_workers, max_job_gb, memory_gb))
+    
+    # run tedana with a log file for each run (output is also shown in the terminal when runs are processed one at a time)
+    names = ['{}_task-{}'.format(job['sub'], job['task']) for job in jobs]
+    merged = run_subjects(denoise_run, names, [(job,) for job in jobs], jobs=n_workers, logDir=op.join(derivDir, 'tedana_logs'), accumulators=['failed'])
+    
+    if merged['failed']:
+        raise RuntimeError('tedana failed for runs: {}. See logs in {}'.format(merged['failed'], op.join(derivDir, 'tedana_logs')))
     
     # the code below is used to normalized the denoised optimally combined tedana outputs to MNI space using the tranform files output by fMRIPrep. The version of ants available in the nipype singularity can't read these files however, so the code is commented out (more here: https://github.com/nipreps/fmriprep/issues/2756).
     
@@ -231,7 +277,9 @@ def argparser():
     parser.add_argument('-d', dest='derivDir', default=os.getcwd(),
                         help='derivatives directory')  
     parser.add_argument('-c', dest='cores',
-                        help='number of cores')                                
+                        help='number of cores')
+    parser.add_argument('-m', dest='memory_gb', type=float,
+                        help='memory available in GB (default: available system memory)')
     return parser
 
 # define function that checks inputs against parser function
@@ -248,10 +296,11 @@ def main(argv=None):
     if not op.exists(args.bidsDir):
         raise IOError('BIDS directory {} not found.'.format(args.bidsDir))
 
-    # for each subject in the list of subjects
-    for index, sub in enumerate(args.subjects):
-        # run denoise_echos workflow with the inputs defined above
-        denoise_echoes(sub, args.session, args.bidsDir, args.derivDir, int(args.cores))
+    # session option is passed as a list
+    session = args.session[0] if args.session else 'no'
+    
+    # run tedana for all runs of the subjects in the list of subjects
+    denoise_echoes(args.subjects, session, args.bidsDir, args.derivDir, int(args.cores), args.memory_gb)
         
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':
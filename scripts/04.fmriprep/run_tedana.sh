@@ -77,10 +77,17 @@ derivDir=$(awk -F'\t' '$1=="derivDir"{print $2}' "$config")
 # extract preprocessing relevant values from config file
 sessions=$(awk -F'\t' '$1=="sessions"{print $2}' "$config")
 
+# extract number of processes and memory (GB) for tedana runs from config file (runs from all subjects are processed in a single pool)
+n_procs=$(awk -F'\t' '$1=="n_procs"{print $2}' "$config")
+memory_gb=$(awk -F'\t' '$1=="memory_gb"{print $2}' "$config")
+
 # strip extra formatting if present
 bidsDir="${bidsDir%$'\r'}"
 derivDir="${derivDir%$'\r'}"
 sessions="${sessions%$'\r'}"
+n_procs="${n_procs%$'\r'}"
+memory_gb="${memory_gb%$'\r'}"
+n_procs="${n_procs:-4}"
 
 # change the location of the singularity cache ($HOME/.singularity/cache by default, but limited space in this directory)
 export APPTAINER_TMPDIR=${singularityDir}
@@ -95,7 +102,8 @@ ${singularityDir}/nipype_nilearn.simg											\
 -n ${sessions}																	\
 -b ${bidsDir}																	\
 -d ${derivDir}																	\
--c 4
+-c ${n_procs}																	\
+${memory_gb:+-m ${memory_gb}}
 
 # normalize tedana outputs within fmriprep singularity
 # the easier option would be to use the version of ants included in nipype but this version won't read the h5 transform files output by fMRIPrep (more here: https://github.com/nipreps/fmriprep/issues/2756). 
@@ -1,10 +1,9 @@
 # import modules
 from bids.layout import BIDSLayout
-from nipype.algorithms import rapidart
 import pandas as pd
 import numpy as np
 from collections import defaultdict
-from nipype import Workflow, Node
+from concurrent.futures import ProcessPoolExecutor
 import argparse
 import os
 import os.path as op
@@ -12,18 +11,21 @@ import sys
 import glob
 import shutil
 
+# add misc folder to path to import shared artifact detection functions
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from artifact_detect import detect_artifacts
+from qc_ledger import ledger_file, update_ledger
+
 # define function that will tag motion outlier volumes/runs based on defined threshold
-def mark_motion_exclusions(sub, derivDir, qcDir, ses, multiecho, fd_thresh, dvars_thresh, art_norm_thresh, art_z_thresh, ntmpts_exclude):
+def mark_motion_exclusions(sub, derivDir, qcDir, ses, multiecho, fd_thresh, dvars_thresh, art_norm_thresh, art_z_thresh, ntmpts_exclude, n_procs=4, ledger_format='tsv'):
     # print current subject
     print('running motion exclusion script for {}'.format(sub))
     
     # find the BIDS scans file, depending on whether session information is in BIDS directory/file names
     if ses != 'no':
         funcDir = op.join(derivDir, '{}'.format(sub), 'ses-{}'.format(ses), 'func')
-        prefix = '{}_ses-{}'.format(sub, ses)
     else: # if session was 'no'
         funcDir = op.join(derivDir, '{}'.format(sub), 'func')
-        prefix = '{}'.format(sub)   
     
     # copy fMRIPrep output images to data checking directory for QC
     # for T1_svg in glob.glob('{}/{}/figures/*_desc-reconall_T1w.svg'.format(derivDir, sub)):
@@ -55,6 +57,10 @@ def mark_motion_exclusions(sub, derivDir, qcDir, ses, multiecho, fd_thresh, dvar
     df_merge.loc[:,'MeanDVARS'] = None
     df_merge.loc[:,'#Artifacts_DVARS'] = None
     df_merge.loc[:,'#Artifacts_ART'] = None
+    df_merge.loc[:,'nVols'] = None
+    
+    # runs to check for artifacts (artifacts are detected for all runs in parallel once the confounds files are read)
+    runs = []
     
     # extract motion info from confounds file and merge with dataframe
     for index, row in df_merge.iterrows():
@@ -67,10 +73,10 @@ def mark_motion_exclusions(sub, derivDir, qcDir, ses, multiecho, fd_thresh, dvar
             if run == None:
                 # name of confound file (has FD/DVARS info)
                 confounds_filestr = '*task-' + task + '_desc-confounds*.tsv'
-                
+        
                 # name of preprocessed bold data
                 preproc_filestr = '*task-' + task + '_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz'
-                
+        
                 # could grab multi-echo denoised data, but this will likely underestimate motion because the data have already been denoised
                 # if multiecho == 'yes':
                     # print('Data are multi-echo...')
@@ -80,24 +86,17 @@ def mark_motion_exclusions(sub, derivDir, qcDir, ses, multiecho, fd_thresh, dvar
                     # print('Data are not multi-echo...')
                     # print('Using standard fMRIPrep bold file')
                     # preproc_filestr = '*task-' + task + '_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz'
-                
-                # name of motion parameters file (will be written out in next step)
-                mp_filestr = prefix + '_task-' + task + '_mcparams.tsv'
-                
-                # name of motion parameters file (written out by rapidart)
-                art_filestr = '*outliers.txt'
-                af = op.join(funcDir, 'art', task, art_filestr)
-                
+        
                 outname = task # create a different output directory name for each run
-                
+        
             # if there's multiple runs specified
             else: 
                 # name of confound file (has FD/DVARS info)
                 confounds_filestr = '*task-' + task + '_run-' + str(run) + '_desc-confounds*.tsv'
-                
+        
                 # name of preprocessed bold data
                 preproc_filestr = '*task-' + task + '_run-' + str(run) + '_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz'
-                
+        
                 # could grab multi-echo denoised data, but this will likely underestimate motion because the data have already been denoised
                 # if multiecho == 'yes':
                     # print('Data are multi-echo...')
@@ -108,13 +107,6 @@ def mark_motion_exclusions(sub, derivDir, qcDir, ses, multiecho, fd_thresh, dvar
                     # print('Using standard fMRIPrep bold file')
                     # preproc_filestr = '*task-' + task + '_run-' + str(run) + '_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz'
                     
-                # name of motion parameters file (will be written out in next step)
-                mp_filestr = prefix + '_task-' + task + '_run-' + str(run) + '_mcparams.tsv'
-                
-                # name of motion parameters file (written out by rapidart)
-                art_filestr = '*outliers.txt'
-                af = op.join(funcDir, 'art', task+str(run), art_filestr)
-                
                 outname = task + str(run) # create a different output directory name for each run
 
             # read in confound file (has FD/DVARS info)
@@ -139,82 +131,61 @@ def mark_motion_exclusions(sub, derivDir, qcDir, ses, multiecho, fd_thresh, dvar
             dfConfounds = pd.read_csv(confound_file, sep='\t')
             nVols = len(dfConfounds) # record number of volumes to calculate threshold for excluding data
             
-            # extract and write realignment parameters in a format for art
-            mp_name = op.join(funcDir, mp_filestr)
-            pd.read_table(confound_file).to_csv(mp_name, sep='\t',
-                                                header = False,
-                                                index = False, 
-                                                columns=['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z'])
-                
-            # read in motion parameters file
-            mp = glob.glob(op.join(funcDir, mp_filestr))
-            motion_params = mp[0]
-            
-            # use rapidart to detect outliers in realigned files
-            art = Node(rapidart.ArtifactDetect(mask_type = 'file',
-                                               mask_file =  mask_file, # specifies a brain mask file (should be an image consisting of 0s and 1s)
-                                               realigned_files = preproc_file,
-                                               realignment_parameters = [motion_params],
-                                               use_norm = True, # use a composite of the motion parameters in order to determine outliers
-                                               norm_threshold = art_norm_thresh, # threshold to use to detect motion-related outliers when composite motion is being used
-                                               zintensity_threshold = art_z_thresh, # intensity Z-threshold used to detect images that deviate from the mean
-                                               parameter_source = 'SPM',
-                                               use_differences = [True, False]), # use differences between successive motion (first element) and intensity parameter (second element) estimates in order to determine outliers
-                        name=op.join(outname)) # create a different output directory name for each run
-            
-            # create a rapidart workflow
-            wf = Workflow(name = 'art',
-                          base_dir = funcDir)
-            
-            # add node to workflow and run
-            wf.add_nodes([art])          
-            wf.run()
-            
-            # read in art output to count number of artefact timepoints
-            art_file = glob.glob(af)[0]
-            
-            if op.getsize(art_file) == 0: # if no timepoints tagged as artifact
-                nArt=0
-            else:
-                nArt=len(pd.read_csv(art_file, header=None))
-            
-            # print number of artifact timepoints
-            print('identified ' + str(nArt) + ' artifacts saved in ' + art_file)
-                    
-            # extract standarized dvars and calculate TRs over FD and DVARS limits
-            FD = dfConfounds.framewise_displacement[1:]
-            meanFD = np.mean(FD)
-            FDoverlim = FD > fd_thresh
-            FDartifacts = FDoverlim.sum()
-            
-            DVARS = dfConfounds.std_dvars[1:]
-            meanDVARS = np.mean(DVARS)
-            DVARSoverlim = DVARS > dvars_thresh
-            DVARSartifacts = DVARSoverlim.sum()
+            # extract realignment parameters (in the SPM order used by art)
+            motion_params = dfConfounds[['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']].values
             
-            # add values to dataframe
-            df_merge.loc[index, 'MeanFD'] = meanFD
-            df_merge.loc[index, '#Artifacts_FD'] = FDartifacts
-            df_merge.loc[index, 'MeanDVARS'] = meanDVARS
-            df_merge.loc[index, '#Artifacts_DVARS'] = DVARSartifacts
-            df_merge.loc[index, '#Artifacts_ART'] = nArt
-
-            # sum of bools is number of true values. count of bool array is length
-            # mark run for exclusion if more than specified number of vols are identified as motion using FD, DVARS, or ART timepoints
-            # or (DVARSoverlim.sum() / DVARSoverlim.count() >= ntmpts_exclude)
-            if (FDoverlim.sum() / FDoverlim.count() >= ntmpts_exclude) or (nArt / nVols >= ntmpts_exclude):
-                df_merge.loc[index, 'MotionExclusion'] = True
-                print('Motion Exclusion: ' + row['filename'])
-        
-            print('saving updated scans.tsv file with motion information for {}'.format(sub))
-            df_merge.to_csv(scansfile, sep = '\t', 
-                            index = False, 
-                            columns=['filename', 'task', 'run', 'subject', 'MotionExclusion', 'MeanFD',
-                                     '#Artifacts_FD', 'MeanDVARS', '#Artifacts_DVARS', '#Artifacts_ART'])
+            # detect outliers in each run using the settings previously passed to rapidart (composite motion norm and global intensity, not differenced between volumes)
+            # outputs are saved in the same art directory for each run as the rapidart workflow
+            runs.append((index, row['filename'], dfConfounds, nVols, (preproc_file, mask_file, motion_params, op.join(funcDir, 'art', outname), art_norm_thresh, art_z_thresh)))
         
         else: # skip if preprocessed file doesn't exist
             print('No preprocessed data was found for {}'.format(preproc_filestr))
             print('Motion exclusion checking will be skipped for this run')
+    
+    # detect artifacts in all runs in parallel
+    with ProcessPoolExecutor(max_workers=max(min(n_procs, len(runs)), 1)) as executor:
+        futures = [executor.submit(detect_artifacts, *art_inputs) for index, filename, dfConfounds, nVols, art_inputs in runs]
+        art_outputs = [future.result() for future in futures]
+    
+    for (index, filename, dfConfounds, nVols, art_inputs), (art_file, nArt) in zip(runs, art_outputs):
+        # print number of artifact timepoints
+        print('identified ' + str(nArt) + ' artifacts saved in ' + art_file)
+        
+        # extract standarized dvars and calculate TRs over FD and DVARS limits
+        FD = dfConfounds.framewise_displacement[1:]
+        meanFD = np.mean(FD)
+        FDoverlim = FD > fd_thresh
+        FDartifacts = FDoverlim.sum()
+        
+        DVARS = dfConfounds.std_dvars[1:]
+        meanDVARS = np.mean(DVARS)
+        DVARSoverlim = DVARS > dvars_thresh
+        DVARSartifacts = DVARSoverlim.sum()
+        
+        # add values to dataframe
+        df_merge.loc[index, 'MeanFD'] = meanFD
+        df_merge.loc[index, '#Artifacts_FD'] = FDartifacts
+        df_merge.loc[index, 'MeanDVARS'] = meanDVARS
+        df_merge.loc[index, '#Artifacts_DVARS'] = DVARSartifacts
+        df_merge.loc[index, '#Artifacts_ART'] = nArt
+        df_merge.loc[index, 'nVols'] = nVols
+        
+        # sum of bools is number of true values. count of bool array is length
+        # mark run for exclusion if more than specified number of vols are identified as motion using FD, DVARS, or ART timepoints
+        # or (DVARSoverlim.sum() / DVARSoverlim.count() >= ntmpts_exclude)
+        if (FDoverlim.sum() / FDoverlim.count() >= ntmpts_exclude) or (nArt / nVols >= ntmpts_exclude):
+            df_merge.loc[index, 'MotionExclusion'] = True
+            print('Motion Exclusion: ' + filename)
+    
+    print('saving updated scans.tsv file with motion information for {}'.format(sub))
+    df_merge.to_csv(scansfile, sep = '\t', 
+                    index = False, 
+                    columns=['filename', 'task', 'run', 'subject', 'MotionExclusion', 'MeanFD',
+                             '#Artifacts_FD', 'MeanDVARS', '#Artifacts_DVARS', '#Artifacts_ART'])
+    
+    # replace the subject's runs in the study QC ledger (read by the first-level pipelines)
+    qc_file = update_ledger(ledger_file(derivDir, ledger_format), sub, ses, df_merge[~pd.isnull(df_merge['task'])])
+    print('saved motion information for {} to QC ledger {}'.format(sub, qc_file))
 
 # define command line parser function
 def argparser():
@@ -236,7 +207,7 @@ def main(argv=None):
     args = parser.parse_args(argv)
     
     # read in configuration file and parse inputs
-    config_file=pd.read_csv(args.config, sep='\t', header=None, index_col=0)
+    config_file=pd.read_csv(args.config, sep='\t', header=None, index_col=0).replace({np.nan: None})
     derivDir=config_file.loc['derivDir',1]
     ses=config_file.loc['sessions',1]
     multiecho=config_file.loc['multiecho',1]
@@ -246,6 +217,16 @@ def main(argv=None):
     art_z_thresh=int(config_file.loc['art_z_thresh',1])
     ntmpts_exclude=float(config_file.loc['ntmpts_exclude',1])
     
+    # number of runs checked in parallel (default: 4)
+    n_procs = 4
+    if 'n_procs' in config_file.index and config_file.loc['n_procs',1] is not None:
+        n_procs = int(float(config_file.loc['n_procs',1]))
+    
+    # QC ledger is saved as a parquet file if stats tables are saved as parquet files (default: tsv)
+    ledger_format = 'tsv'
+    if 'stats_format' in config_file.index and config_file.loc['stats_format',1] == 'parquet':
+        ledger_format = 'parquet'
+    
     # print if the derivatives directory is not found
     if not op.exists(derivDir):
         raise IOError('Derivatives directory {} not found.'.format(derivDir))
@@ -255,7 +236,7 @@ def main(argv=None):
     # os.makedirs(qcDir, exist_ok=True) # uncommented because reports can be viewed on datastore instead
 
     # run mark_motion_exclusions function with different inputs depending on config options
-    mark_motion_exclusions(args.sub, derivDir, qcDir, ses, multiecho, fd_thresh, dvars_thresh, art_norm_thresh, art_z_thresh, ntmpts_exclude)
+    mark_motion_exclusions(args.sub, derivDir, qcDir, ses, multiecho, fd_thresh, dvars_thresh, art_norm_thresh, art_z_thresh, ntmpts_exclude, n_procs, ledger_format)
 
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':
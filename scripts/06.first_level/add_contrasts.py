@@ -0,0 +1,168 @@
+"""
+Add contrasts to the outputs of the firstlevel pipeline without refitting the model
+
+The parameter estimates from the firstlevel model don't depend on the contrasts, so contrasts that are added to the contrasts file (files/contrast_files/contrasts.tsv) and to the contrast option in the config file can be estimated from the saved model outputs rather than rerunning firstlevel_pipeline.py.
+For each run (or splithalf), contrasts in the config file that aren't in the run's contrast file are estimated from the parameter estimates, residual variance (sigmasquareds), degrees of freedom (dof), design matrix, and autocorrelation estimates (threshac1) saved in the model and design folders (see misc/posthoc_contrasts.py).
+The new copes, varcopes, tstats, and zstats are saved in the model folder with the same file names as the firstlevel pipeline outputs, and the contrasts are added to the contrast file in the design folder so calc_psc.py and combine_runs.py can be run as usual.
+
+When the model was fit with FSL FILMGLS, the varcopes are recalculated from the FILM autocorrelation estimates and will be close to but not identical to those from FILMGLS. Use -check to compare the recalculated and saved varcopes for the existing contrasts.
+
+Example call (through run_first-level.sh, as for the other first-level scripts):
+./run_first-level.sh add_contrasts.py config-pixar_mind-body.tsv pixar_subjs.txt
+
+"""
+import sys
+import os
+import os.path as op
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+
+# add misc folder to path to import shared contrast and image writer functions
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from posthoc_contrasts import add_run_contrasts, check_existing
+from parallel_gzip import default_threads
+
+# define function to read in and parse task contrasts (as done by the contrastgen node in firstlevel_pipeline.py)
+def read_contrasts(projDir, task, contrast_opts):
+    contrasts = []
+    
+    # read in data contrast file
+    contrasts_file = op.join(projDir, 'files', 'contrast_files', 'contrasts.tsv')
+    
+    # raise error if contrasts file not found
+    if not op.exists(contrasts_file):
+        raise FileNotFoundError('Contrasts file {} not found.'.format(contrasts_file))
+    
+    # read in contrasts file
+    contrast_info = pd.read_csv(contrasts_file, sep='\t')
+    
+    # set contrasts condition column to lowercase to avoid case errors and allow users flexibility when specifying events in config and contrasts files
+    contrast_info['desc'] = contrast_info['desc'].str.lower()
+    contrast_info['conds'] = contrast_info['conds'].str.lower()
+    contrast_info['weights'] = contrast_info['weights'].str.lower()
+    
+    # select contrasts of interest specified in config file
+    contrast_info = contrast_info[contrast_info['desc'].isin(contrast_opts)]
+    
+    # for each row
+    for index, row in contrast_info.iterrows():
+        # skip a row specifies a contrast for a different task
+        if row.iloc[0] != task:
+            continue
+        
+        # extract task contrasts
+        contrasts.append([
+            row.iloc[1],
+            'T',
+            [cond for cond in row.iloc[2].split(' ')],
+            [float(w) for w in row.iloc[3].split(' ')]
+        ])
+    
+    # raise error if there are no contrasts in the file for the current task
+    if not contrasts:
+        raise AttributeError('No contrasts found for task {}'.format(task))
+    
+    return contrasts
+
+# define command line parser function
+def argparser():
+    # create an instance of ArgumentParser
+    parser = argparse.ArgumentParser()
+    # attach argument specifications to the parser
+    parser.add_argument('-p', dest='projDir',
+                        help='Project directory')
+    parser.add_argument('-w', dest='workDir', default=os.getcwd(),
+                        help='Working directory (not used)')
+    parser.add_argument('-o', dest='outDir', default=os.getcwd(),
+                        help='Output directory (not used, outputs are saved to the resultsDir in the config file)')
+    parser.add_argument('-s', dest='subjects', nargs='*',
+                        help='List of subjects to process')
+    parser.add_argument('-r', dest='runs', nargs='*',
+                        help='List of runs for each subject')
+    parser.add_argument('-c', dest='config',
+                        help='Configuration file')
+    parser.add_argument('-n', dest='n_threads', type=int, default=default_threads(),
+                        help='Number of threads used to estimate contrasts and save files (default: number of CPUs, up to 8)')
+    parser.add_argument('-check', action='store_true',
+                        help='Compare recalculated varcopes for the existing contrasts with the saved varcopes')
+    return parser
+
+# define main function that parses the config file and adds contrasts for each subject
+def main(argv=None):
+    # don't buffer messages
+    sys.stdout = open(sys.stdout.fileno(), mode='w', buffering=1)
+    
+    # call argparser function that defines command line inputs
+    parser = argparser()
+    args = parser.parse_args(argv)
+    
+    # print if the project directory is not found
+    if not op.exists(args.projDir):
+        raise IOError('Project directory {} not found.'.format(args.projDir))
+    
+    # print if config file is not found
+    if not op.exists(args.config):
+        raise IOError('Configuration file {} not found. Make sure it is saved in your project directory!'.format(args.config))
+    
+    # read in configuration file and parse inputs
+    config_file=pd.read_csv(args.config, sep='\t', header=None, index_col=0).replace({np.nan: None})
+    resultsDir=config_file.loc['resultsDir',1]
+    task=config_file.loc['task',1]
+    contrast_opts=config_file.loc['contrast',1].replace(' ','').split(',')
+    splithalf=config_file.loc['splithalf',1]
+    
+    # lowercase contrast_opts to avoid case errors - allows flexibility in how users specify contrasts in config and contrasts files
+    contrast_opts = [c.lower() for c in contrast_opts]
+    contrasts = read_contrasts(args.projDir, task, contrast_opts)
+    
+    if splithalf == 'yes':
+        splithalves = [1,2]
+    else:
+        splithalves = [0]
+    
+    # identify analysis README file
+    readme_file=op.join(resultsDir, 'README.txt')
+    
+    # add config details to project README file
+    with open(readme_file, 'a') as file_1:
+        file_1.write('\n')
+        file_1.write('Contrasts were added to the firstlevel outputs using the add_contrasts.py script and options specified in the config file: {} \n'.format(args.config))
+    
+    # for each subject in the list of subjects
+    for index, sub in enumerate(args.subjects):
+        # check that run info was provided in subject list, otherwise throw an error
+        if not args.runs:
+            raise IOError('Run information missing. Make sure you are passing a subject-run list to the pipeline!')
+        
+        # pass runs for this sub
+        sub_runs=args.runs[index]
+        sub_runs=sub_runs.replace(' ','').split(',') # split runs by separators
+        if sub_runs == ['NA']: # if run info isn't used in file names
+            sub_runs = [1] # because outputs saved in run1 folders even if run info isn't specified in file name
+        else:
+            sub_runs=list(map(int, sub_runs)) # convert to integers
+        
+        for r in sub_runs:
+            for splithalf_id in splithalves:
+                # define directories based on run and splithalf info
+                run_folder = 'run{}'.format(r) if splithalf_id == 0 else 'run{}_splithalf{}'.format(r, splithalf_id)
+                modelDir = op.join(resultsDir, sub, 'model', run_folder)
+                designDir = op.join(resultsDir, sub, 'design', run_folder)
+                
+                # raise an error if the firstlevel outputs don't exist
+                if not glob.glob(op.join(modelDir, 'pe*.nii*')):
+                    raise FileNotFoundError('No firstlevel model outputs found for {} in {}'.format(sub, modelDir))
+                
+                if args.check:
+                    design_file = glob.glob(op.join(designDir, 'run*.mat'))[0]
+                    con_file = glob.glob(op.join(designDir, 'run*.con'))[0]
+                    for con, diff in check_existing(modelDir, design_file, con_file, args.n_threads).items():
+                        print('{} {}: median relative difference between recalculated and saved varcopes for {}: {:.2%}'.format(sub, run_folder, con, diff))
+                
+                add_run_contrasts(modelDir, designDir, contrasts, args.n_threads)
+
+# execute code when file is run as script (the conditional statement is TRUE when script is run in python)
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,10 @@ This script will:
 (2) calculate percent signal change for requested conditions (from config file) using the following approach:
 PSC = (cope map * PP Height [peak to peak height] * 100)/ voxelwise mean
 
+The denoised data are kept in memory to calculate the voxelwise mean (rather than saved), the PP heights are read from the design file once for each run, and PSC is calculated for all requested conditions together.
+Runs (and splithalves) are processed in parallel using the number of processes in the config file (n_procs, default: 4) or the number of jobs requested (-j), with the output for each run saved to a log file in the resultsDir. Only the *_psc.nii.gz maps are saved.
+When incremental is yes in the config file, runs whose PSC maps are newer than the scaled data, design, outlier, and cope files they were calculated from are not recalculated.
+
 The script assumes that cope file (rather than parameter estimate files are being used, 
 so the design.con file rather than the design.mat file is used to extract the PP Height.
 
@@ -18,9 +22,6 @@ This script should be run prior to the extract stats script is the user wants to
 
 """
 import sys
-from nipype.interfaces.fsl import MeanImage, BinaryMaths, ImageMaths
-import nipype.interfaces.io as nio
-from nipype import Workflow, Node
 import nibabel as nib
 from nibabel import load
 import nilearn
@@ -34,29 +35,22 @@ import numpy as np
 import pandas as pd
 from pandas.errors import EmptyDataError
 import argparse
-import glob
-import shutil
 
-# define calc psc workflow function
-def calc_psc_workflow(projDir, derivDir, resultsDir, workDir, sub, ses, task, sub_runs, contrast_opts, splithalf_id, hpf, filter_opt, TR, space_name, name='{}_task-{}_calcpsc'):
+# add misc folder to path to import shared image writer and subject executor functions
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from parallel_gzip import save_nifti
+from subject_executor import run_subjects
 
-    # define subject output directory
-    subDir = op.join(resultsDir, '{}'.format(sub))
+# define function to read the peak-to-peak heights of the contrasts from a design file
+def read_ppheights(design_file):
+    with open(design_file, 'r') as d:
+        for line in d:
+            if line.startswith('/PPheights'):
+                return [float(x) for x in line.split()[1:]]
+    raise ValueError('No PPheights found in design file {}'.format(design_file))
 
-    # raise an error if the firstlevel output directory doesn't exist
-    if not subDir:
-        raise FileNotFoundError('No firstlevel outputs found for {}'.format(sub))
-    
-    # delete prior processing directories because cache files can interfere with workflow
-    subworkDir = op.join(workDir, '{}_task-{}_calcpsc'.format(sub, task))
-    if os.path.exists(subworkDir):
-        shutil.rmtree(subworkDir)
-        
-    # initialize workflow
-    wf = Workflow(name=name.format(sub, task),
-                  base_dir=workDir)
-    
-    # grab MNI mask
+# define function to grab the MNI mask for a subject
+def get_mask(derivDir, sub, ses, space_name):
     if ses != 'no': # if session was provided
         # define path to preprocessed functional and mask data (subject derivatives func folder)
         funcDir = op.join(derivDir, '{}'.format(sub), 'ses-{}'.format(ses), 'func')
@@ -66,157 +60,139 @@ def calc_psc_workflow(projDir, derivDir, resultsDir, workDir, sub, ses, task, su
         # define path to preprocessed functional and mask data (subject derivatives func folder)
         funcDir = op.join(derivDir, '{}'.format(sub), 'func')
         mni_mask = glob.glob(op.join(funcDir, '{}_space-{}*_desc-brain_mask_allruns-BOLDmask.nii.gz'.format(sub, space_name)))[0]
-                  
-    # for each run
-    for r in sub_runs:
-        # define directories based on run and splithalf info
-        if splithalf_id == 0:
-            pscDir = op.join(subDir, 'psc', 'run{}'.format(r))
-            designDir = op.join(subDir, 'design', 'run{}'.format(r))
-            modelDir = op.join(subDir, 'model', 'run{}'.format(r))
-            preprocDir = op.join(subDir, 'preproc', 'run{}'.format(r))
-            
-            # grab rapidart outlier file
-            art_file = glob.glob(op.join(subDir, 'art_files', 'run{}'.format(r), '*out-vols.txt'))[0]
-            
-            # save intermediate file - optional output for data checking
-            denoised_file = op.join(pscDir, '{}_task-{}_run-{:03d}_denoised.nii.gz'.format(sub, task, r))
-            
-            # define output run mean file - optional output for data checking
-            mean_file = op.join(pscDir, '{}_task-{}_run-{:03d}_voxelwise_mean.nii.gz'.format(sub, task, r))
-            
-        else:
-            pscDir = op.join(subDir, 'psc', 'run{}_splithalf{}'.format(r, splithalf_id))
-            designDir = op.join(subDir, 'design', 'run{}_splithalf{}'.format(r, splithalf_id))
-            modelDir = op.join(subDir, 'model', 'run{}_splithalf{}'.format(r, splithalf_id))
-            preprocDir = op.join(subDir, 'preproc', 'run{}_splithalf{}'.format(r, splithalf_id))
-            
-            # grab rapidart outlier file
-            art_file = glob.glob(op.join(subDir, 'art_files', 'run{}_splithalf{}'.format(r, splithalf_id), '*out-vols.txt'))[0]
-            
-            # save intermediate file - optional output for data checking
-            denoised_file = op.join(pscDir, '{}_task-{}_run-{:03d}_splithalf-{:03d}_denoised.nii.gz'.format(sub, task, r, splithalf_id))
-            
-            # define output run mean file - optional output for data checking
-            mean_file = op.join(pscDir, '{}_task-{}_run-{:03d}_splithalf-{:03d}_voxelwise_mean.nii.gz'.format(sub, task, r, splithalf_id))
-        
-        # grab design file (has PP heights)
-        design_file = op.join(designDir, 'run{}.con'.format(r))
-            
-        # make psc directory
-        os.makedirs(pscDir, exist_ok=True)
-        
-        # grab scaled preproc file
-        scaled_file = glob.glob(op.join(preprocDir, '*_scaled.nii.gz'))[0]
-        
-        if not scaled_file:
-            raise FileNotFoundError('No scaled firstlevel outputs found for {}'.format(sub))
-        
-        print('Will denoise the following file to calculate voxelwise mean in run {}: {}'.format(r, scaled_file))
-        
-        # get number of volumes in scaled data (accounts for dropped/split data already)
-        nVols = (load(scaled_file).shape[3])
-        
-        print('Number of volumes in run {}: {}'.format(r, nVols))
-        
-        # generate vector of volume indices (where inclusion means to retain volume) to use for scrubbing
-        vol_indx = np.arange(nVols, dtype=np.int64)
+    
+    return mni_mask
+
+# define function to calculate percent signal change for all requested conditions in a run
+def calc_run_psc(subDir, sub, task, r, splithalf_id, mni_mask, contrast_opts, hpf, filter_opt, TR, incremental=False):
+    # define directories based on run and splithalf info
+    if splithalf_id == 0:
+        pscDir = op.join(subDir, 'psc', 'run{}'.format(r))
+        designDir = op.join(subDir, 'design', 'run{}'.format(r))
+        modelDir = op.join(subDir, 'model', 'run{}'.format(r))
+        preprocDir = op.join(subDir, 'preproc', 'run{}'.format(r))
         
-        # read in art file, creating an empty dataframe if no outlier volumes (i.e., empty text file)
-        try:
-            outliers = pd.read_csv(art_file, header=None)[0].astype(int)
-        except EmptyDataError:
-            outliers = pd.DataFrame()
+        # grab rapidart outlier file
+        art_file = glob.glob(op.join(subDir, 'art_files', 'run{}'.format(r), '*out-vols.txt'))[0]
         
-        print('ART identified motion spikes will be scrubbed from data')             
-        if np.shape(outliers)[0] != 0: # if there are outlier volumes
-            # remove excluded volumes from vec
-            vol_indx = np.delete(vol_indx, [outliers])
-            print('{} outlier volumes will be scrubbed in run {}'.format(len(outliers), r))
-        else:
-            print('No outlier volumes in run {}'.format(r))
+    else:
+        pscDir = op.join(subDir, 'psc', 'run{}_splithalf{}'.format(r, splithalf_id))
+        designDir = op.join(subDir, 'design', 'run{}_splithalf{}'.format(r, splithalf_id))
+        modelDir = op.join(subDir, 'model', 'run{}_splithalf{}'.format(r, splithalf_id))
+        preprocDir = op.join(subDir, 'preproc', 'run{}_splithalf{}'.format(r, splithalf_id))
         
-        # convert filter from seconds to Hz
-        hpf_hz = 1/hpf
-        print('Will apply a {} filter using a high pass filter cutoff of {}Hz for run {}.'.format(filter_opt, hpf_hz, r))
+        # grab rapidart outlier file
+        art_file = glob.glob(op.join(subDir, 'art_files', 'run{}_splithalf{}'.format(r, splithalf_id), '*out-vols.txt'))[0]
+    
+    # grab design file (has PP heights)
+    design_file = op.join(designDir, 'run{}.con'.format(r))
         
-        # define kwargs input to signal.clean function
-        if filter_opt == 'butterworth':
-            kwargs_opts={'clean__sample_mask':vol_indx, 
-                         'clean__butterworth__t_r':TR,
-                         'clean__butterworth__high_pass':hpf_hz}
-        elif filter_opt == 'cosine':
-            kwargs_opts={'clean__sample_mask':vol_indx, 
-                         'clean__cosine__t_r':TR,
-                         'clean__cosine__high_pass':hpf_hz}
-        else:
-            kwargs_opts={'clean__sample_mask':vol_indx,
-                         'clean__t_r':TR}
+    # make psc directory
+    os.makedirs(pscDir, exist_ok=True)
+    
+    # grab scaled preproc file
+    scaled_file = glob.glob(op.join(preprocDir, '*_scaled.nii.gz'))[0]
+    
+    if not scaled_file:
+        raise FileNotFoundError('No scaled firstlevel outputs found for {}'.format(sub))
+    
+    # skip the run if incremental is yes and the psc maps are newer than the files they are calculated from
+    psc_files = [op.join(pscDir, '{}_psc.nii.gz'.format(cope)) for cope in contrast_opts]
+    if incremental and all(op.exists(f) for f in psc_files):
+        input_files = [scaled_file, design_file, art_file] + glob.glob(op.join(modelDir, 'con*_cope.nii.gz'))
+        if min(op.getmtime(f) for f in psc_files) >= max(op.getmtime(f) for f in input_files):
+            print('Percent signal change maps for run {} are up to date and will not be recalculated'.format(r))
+            return psc_files
+    
+    print('Will denoise the following file to calculate voxelwise mean in run {}: {}'.format(r, scaled_file))
+    
+    # get number of volumes in scaled data (accounts for dropped/split data already)
+    nVols = (load(scaled_file).shape[3])
+    
+    print('Number of volumes in run {}: {}'.format(r, nVols))
+    
+    # generate vector of volume indices (where inclusion means to retain volume) to use for scrubbing
+    vol_indx = np.arange(nVols, dtype=np.int64)
+    
+    # read in art file, creating an empty dataframe if no outlier volumes (i.e., empty text file)
+    try:
+        outliers = pd.read_csv(art_file, header=None)[0].astype(int)
+    except EmptyDataError:
+        outliers = pd.DataFrame()
+    
+    print('ART identified motion spikes will be scrubbed from data')             
+    if np.shape(outliers)[0] != 0: # if there are outlier volumes
+        # remove excluded volumes from vec
+        vol_indx = np.delete(vol_indx, [outliers])
+        print('{} outlier volumes will be scrubbed in run {}'.format(len(outliers), r))
+    else:
+        print('No outlier volumes in run {}'.format(r))
+    
+    # convert filter from seconds to Hz
+    hpf_hz = 1/hpf
+    print('Will apply a {} filter using a high pass filter cutoff of {}Hz for run {}.'.format(filter_opt, hpf_hz, r))
+    
+    # define kwargs input to signal.clean function
+    if filter_opt == 'butterworth':
+        kwargs_opts={'clean__sample_mask':vol_indx, 
+                     'clean__butterworth__t_r':TR,
+                     'clean__butterworth__high_pass':hpf_hz}
+    elif filter_opt == 'cosine':
+        kwargs_opts={'clean__sample_mask':vol_indx, 
+                     'clean__cosine__t_r':TR,
+                     'clean__cosine__high_pass':hpf_hz}
+    else:
+        kwargs_opts={'clean__sample_mask':vol_indx,
+                     'clean__t_r':TR}
+    
+    # filter and remove artifact timepoints in scaled data file
+    denoised_data = image.clean_img(scaled_file, mask_img=mni_mask, detrend=False, standardize=False, **kwargs_opts)
+    
+    # step 1: calculate voxelwise mean across this run (from the denoised data in memory, so the denoised data are not saved)
+    mean_dat = np.asanyarray(denoised_data.dataobj).mean(axis=3, dtype=np.float64)
+    del denoised_data
+    
+    # read in ppheights from design file
+    ppheights = read_ppheights(design_file)
+    
+    # grab copes file and pp height for each cope map
+    cope_files = []
+    pp_values = []
+    for cope in contrast_opts:
+        print('Calculating percent signal change for {} condition'.format(cope))
         
-        # filter and remove artifact timepoints in scaled data file
-        denoised_data = image.clean_img(scaled_file, mask_img=mni_mask, detrend=False, standardize=False, **kwargs_opts)
+        # grab copes file corresponding to cope map
+        cope_file = glob.glob(op.join(modelDir, 'con*_{}_cope.nii.gz'.format(cope)))[0]
         
-        # save denoised data
-        nib.save(denoised_data, denoised_file)
+        # extract contrast number
+        con_num = int(re.search(r'con_(\d+)', cope_file).group(1))
         
-        # step 1: calculate voxelwise mean across this run
-        meanfunc = Node(MeanImage(), name='meanfunc_run{}_splithalf{}'.format(r, splithalf_id))
-        meanfunc.inputs.dimension = 'T' # returns the mean across time
-        meanfunc.inputs.in_file = denoised_file
-        #meanfunc.inputs.out_file = mean_file # can return this file as a data checking step
+        print('Using cope file: {}'.format(cope_file))
         
-        # add the meanfunc node to the workflow
-        wf.add_nodes([meanfunc])
-        meanfunc.run()
+        # use contrast number to select correct pp height
+        pp_value = ppheights[con_num - 1] # subtract 1 because of 0 indexing in python
         
-        # remove intermediate file
-        os.remove(denoised_file)
+        print('Using contrast peak-to-peak height {} in the PSC calculation: {}'.format(con_num, pp_value))
         
-        # loop over cope maps
-        for cope in contrast_opts:
-            print('Calculating percent signal change for {} condition'.format(cope))
-            
-            # grab copes file corresponding to cope map
-            cope_file = glob.glob(op.join(modelDir, 'con*_{}_cope.nii.gz'.format(cope)))[0]
-            
-            # extract contrast number
-            con_num = int(re.search(r'con_(\d+)', cope_file).group(1))
-            
-            print('Using cope file: {}'.format(cope_file))
-            
-            # read in ppheights from design file
-            with open(design_file, 'r') as d:
-                for line in d:
-                    if line.startswith('/PPheights'):
-                        ppheights = [float(x) for x in line.split()[1:]]
-                        
-            # use contrast number to select correct pp height
-            pp_value = ppheights[con_num - 1] # subtract 1 because of 0 indexing in python
-            
-            print('Using contrast peak-to-peak height {} in the PSC calculation: {}'.format(con_num, pp_value))
-            
-            # define psc output files
-            mul_file = op.join(pscDir, '{}_multiplied.nii.gz'.format(cope))
-            psc_file = op.join(pscDir, '{}_psc.nii.gz'.format(cope))
-            
-            # step 2: multiply cope file by PP height * 100
-            pp_scale_factor = pp_value * 100
-            multiplycope = Node(ImageMaths(), name='multiplycope_run{}_splithalf{}_{}'.format(r, splithalf_id, cope))
-            multiplycope.inputs.in_file = cope_file
-            multiplycope.inputs.args = '-mul {}'.format(pp_scale_factor)
-            #multiplycope.inputs.out_file = mul_file # can return this file as a data checking step
-
-            # step 3: divide cope map by the voxelwise mean_file
-            dividecope = Node(BinaryMaths(), name='dividecope_run{}_splithalf{}_{}'.format(r, splithalf_id, cope))
-            dividecope.inputs.operation = 'div' # divide
-            dividecope.inputs.out_file = psc_file
-            
-            # add nodes to workflow and connect inputs
-            wf.add_nodes([multiplycope, dividecope])
-            wf.connect(multiplycope, 'out_file', dividecope, 'in_file')
-            wf.connect(meanfunc, 'out_file', dividecope, 'operand_file')
-            
-    return wf
+        cope_files.append(cope_file)
+        pp_values.append(pp_value)
+    
+    # steps 2 and 3: multiply cope maps by PP height * 100 and divide by the voxelwise mean (voxels with a mean of 0 are set to 0, as done by fslmaths)
+    cope_dat = np.stack([np.asanyarray(load(f).dataobj).reshape(mean_dat.shape) for f in cope_files]).astype(np.float64)
+    pp_scale_factors = np.array(pp_values)[:, np.newaxis, np.newaxis, np.newaxis] * 100
+    psc_dat = np.zeros(cope_dat.shape)
+    np.divide(cope_dat * pp_scale_factors, mean_dat, out=psc_dat, where=mean_dat != 0)
+    
+    # save psc maps with the cope file headers
+    psc_files = []
+    for cope, cope_file, psc in zip(contrast_opts, cope_files, psc_dat):
+        psc_file = op.join(pscDir, '{}_psc.nii.gz'.format(cope))
+        cope_img = load(cope_file)
+        psc_img = nib.Nifti1Image(psc.astype(np.float32), cope_img.affine, cope_img.header)
+        psc_img.set_data_dtype(np.float32)
+        psc_files.append(save_nifti(psc_img, psc_file))
+    
+    return psc_files
 
 # define command line parser function
 def argparser():
@@ -237,8 +213,8 @@ def argparser():
                         help='Configuration file')                                            
     parser.add_argument('-sparse', action='store_true',
                         help='Specify a sparse model')
-    parser.add_argument('-m', dest='plugin',
-                        help='Nipype plugin to use (default: MultiProc)')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                        help='Number of runs to process in parallel (default: n_procs in the config file, or 4)')
     return parser
 
 # define main function that parses the config file and runs the functions defined above
@@ -271,8 +247,17 @@ def main(argv=None):
     filter_opt=config_file.loc['filter',1]
     space=config_file.loc['space',1]
     
-    # define working directory
-    workDir = op.join(resultsDir, 'processing')
+    # number of runs processed in parallel (default: 4, unless a number of jobs is requested)
+    n_procs = 4
+    if 'n_procs' in config_file.index and config_file.loc['n_procs',1] is not None:
+        n_procs = int(float(config_file.loc['n_procs',1]))
+    if args.jobs is not None:
+        n_procs = args.jobs
+    
+    # reuse psc maps from previous calls if incremental is yes (default: no)
+    incremental = False
+    if 'incremental' in config_file.index and config_file.loc['incremental',1] is not None:
+        incremental = config_file.loc['incremental',1] == 'yes'
     
     # lowercase contrast_opts and events to avoid case errors - allows flexibility in how users specify events in config and contrasts files
     contrast_opts = [c.lower() for c in contrast_opts]
@@ -308,31 +293,39 @@ def main(argv=None):
     TR = layout.get_metadata(epi)['RepetitionTime'] # extract TR field  
     
     # for each subject in the list of subjects
+    run_names = []
+    run_args = []
     for index, sub in enumerate(args.subjects):
+        # define subject output directory
+        subDir = op.join(resultsDir, '{}'.format(sub))
+        
+        # raise an error if the firstlevel output directory doesn't exist
+        if not op.exists(subDir):
+            raise FileNotFoundError('No firstlevel outputs found for {}'.format(sub))
+        
+        # grab MNI mask
+        mni_mask = get_mask(derivDir, sub, ses, space_name)
+        
+        # check that run info was provided in subject list, otherwise throw an error
+        if not args.runs:
+            raise IOError('Run information missing. Make sure you are passing a subject-run list to the pipeline!')
+        
+        # pass runs for this sub
+        sub_runs=args.runs[index]
+        sub_runs=sub_runs.replace(' ','').split(',') # split runs by separators
+        if sub_runs == ['NA']: # if run info isn't used in file names
+            sub_runs = [1] # because outputs saved in run1 folders even if run info isn't specified in file name
+        else:
+            sub_runs=list(map(int, sub_runs)) # convert to integers
+        
+        # save the calc_run_psc inputs defined above for each run (and splithalf) of this subject
         for splithalf_id in splithalves:
-            # check that run info was provided in subject list, otherwise throw an error
-            if not args.runs:
-                raise IOError('Run information missing. Make sure you are passing a subject-run list to the pipeline!')
-            
-            # pass runs for this sub
-            sub_runs=args.runs[index]
-            sub_runs=sub_runs.replace(' ','').split(',') # split runs by separators
-            if sub_runs == ['NA']: # if run info isn't used in file names
-                sub_runs = [1] # because outputs saved in run1 folders even if run info isn't specified in file name
-            else:
-                sub_runs=list(map(int, sub_runs)) # convert to integers
-                  
-            # create calc psc workflow with the inputs defined above
-            wf = calc_psc_workflow(args.projDir, derivDir, resultsDir, workDir, sub, ses, task, sub_runs, contrast_opts, splithalf_id, hpf, filter_opt, TR, space_name)
-       
-            # configure workflow options
-            wf.config['execution'] = {'crashfile_format': 'txt',
-                                      'remove_unnecessary_outputs': False,
-                                      'keep_inputs': True}
-
-            # run multiproc
-            args_dict = {'n_procs' : 4}
-            wf.run(plugin='MultiProc', plugin_args = args_dict)
+            for r in sub_runs:
+                run_names.append('{}_run{}'.format(sub, r) if splithalf_id == 0 else '{}_run{}_splithalf{}'.format(sub, r, splithalf_id))
+                run_args.append([subDir, sub, task, r, splithalf_id, mni_mask, contrast_opts, hpf, filter_opt, TR, incremental])
+    
+    # calculate percent signal change for each run (in parallel if more than 1 process is used)
+    run_subjects(calc_run_psc, run_names, run_args, jobs=n_procs, logDir=op.join(resultsDir, 'logs', 'calc_psc'))
 
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':
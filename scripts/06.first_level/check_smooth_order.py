@@ -0,0 +1,115 @@
+"""
+Compare smoothing each half of a run (smooth_order split) with smoothing the full run and then splitting it into halves (smooth_order full)
+
+SUSAN smoothing is spatial, but the SUSAN brightness threshold and the mean image used to find edges are calculated from all volumes in the file that is smoothed.
+Smoothing the full run rather than each half can therefore change the smoothed values slightly. This script reports the differences for a run so users can check them before setting smooth_order to full in the config file.
+
+The halves are defined as in the pipeline being checked (--pipeline, default: firstlevel). Volumes around the middle of the run are not included in either half: the firstlevel pipeline rounds the number of volumes dropped on each side up, and the timecourse pipeline rounds it down.
+The differences within the mask are saved to smooth_order_differences.csv in the output directory.
+
+Example call:
+python check_smooth_order.py -i sub-01_task-x_run-01_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz -m sub-01_task-x_run-01_space-MNI152NLin2009cAsym_res-2_desc-brain_mask.nii.gz -f 4 -t 2 -o /path/to/output
+
+"""
+import sys
+import os
+import math
+import os.path as op
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+# add misc folder to path to import shared smoothing and temporal view functions
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from smooth_cache import susan_smooth
+from temporal_view import dropped_range, load_view
+
+# define function to return the volume ranges of each half of a run (relative to the data after dropping volumes, as in process_data_files of the pipeline)
+def half_ranges(nVols, TR, pipeline='firstlevel'):
+    midVol = int(nVols/2)
+    if pipeline == 'firstlevel':
+        drop_nVols = int(math.ceil((6/TR)/2))
+    else:
+        drop_nVols = int((6/TR)/2)
+    return [(0, midVol-drop_nVols), (midVol+drop_nVols, midVol-drop_nVols)]
+
+# define function to compare the smoothed values within the mask
+def compare_smoothed(split_img, full_img, mask):
+    split_dat = split_img.get_fdata(dtype=np.float32)[mask]
+    full_dat = full_img.get_fdata(dtype=np.float32)[mask]
+    diff = np.abs(split_dat - full_dat)
+    
+    return {'max_abs_diff': float(diff.max()),
+            'mean_abs_diff': float(diff.mean()),
+            'max_rel_diff_percent': float(100 * diff.max() / np.abs(split_dat).mean()),
+            'correlation': float(np.corrcoef(split_dat.ravel(), full_dat.ravel())[0,1])}
+
+# define command line parser function
+def argparser():
+    # create an instance of ArgumentParser
+    parser = argparse.ArgumentParser()
+    # attach argument specifications to the parser
+    parser.add_argument('-i', dest='in_file',
+                        help='Preprocessed functional run')
+    parser.add_argument('-m', dest='mask_file',
+                        help='Brain mask for the functional run')
+    parser.add_argument('-f', dest='fwhm', type=float,
+                        help='Smoothing kernel size (mm)')
+    parser.add_argument('-t', dest='TR', type=float,
+                        help='Repetition time (s), used to define the halves of the run')
+    parser.add_argument('-d', dest='dropvols', type=int, default=0,
+                        help='Number of volumes to drop (as specified in the config file, default: 0)')
+    parser.add_argument('--pipeline', dest='pipeline', choices=['firstlevel', 'timecourse'], default='firstlevel',
+                        help='Pipeline that will use the smoothed halves, used to define the halves of the run (default: firstlevel)')
+    parser.add_argument('-o', dest='outDir', default=os.getcwd(),
+                        help='Output directory (smoothed files are saved in a smooth_order folder)')
+    return parser
+
+# define main function that smooths the run in both orders and compares the halves
+def main(argv=None):
+    # call argparser function that defines command line inputs
+    parser = argparser()
+    args = parser.parse_args(argv)
+    
+    # print if the input files are not found
+    for f in [args.in_file, args.mask_file]:
+        if not op.exists(f):
+            raise IOError('File {} not found.'.format(f))
+    
+    # define volume ranges of the full run (after dropping volumes) and of each half
+    fileVols = nib.load(args.in_file).shape[3]
+    nVols = fileVols - abs(args.dropvols)
+    drop_min, drop_size = dropped_range(fileVols, args.dropvols, nVols)
+    halves = half_ranges(drop_size, args.TR, args.pipeline)
+    
+    mask = np.asanyarray(nib.load(args.mask_file).dataobj)
+    mask = mask.reshape(mask.shape[:3]) > 0
+    
+    # smooth full run once
+    fullDir = op.join(args.outDir, 'smooth_order', 'full')
+    os.makedirs(fullDir, exist_ok=True)
+    print('Smoothing full run (volumes {} to {})'.format(drop_min, drop_min + drop_size - 1))
+    full_file = susan_smooth(args.in_file, args.mask_file, args.fwhm, drop_min, drop_size, fullDir)
+    
+    # smooth each half and compare with the same volumes of the smoothed full run
+    results = []
+    for splithalf_id, (t_min, t_size) in enumerate(halves, 1):
+        splitDir = op.join(args.outDir, 'smooth_order', 'splithalf{}'.format(splithalf_id))
+        os.makedirs(splitDir, exist_ok=True)
+        print('Smoothing half {} (volumes {} to {})'.format(splithalf_id, drop_min + t_min, drop_min + t_min + t_size - 1))
+        split_file = susan_smooth(args.in_file, args.mask_file, args.fwhm, drop_min + t_min, t_size, splitDir)
+        
+        stats = compare_smoothed(nib.load(split_file), load_view(full_file, t_min, t_size), mask)
+        results.append(dict({'splithalf': splithalf_id, 't_min': drop_min + t_min, 't_size': t_size}, **stats))
+    
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    
+    out_file = op.join(args.outDir, 'smooth_order_differences.csv')
+    results.to_csv(out_file, index=False)
+    print('Differences saved to {}'.format(out_file))
+
+# execute code when file is run as script (the conditional statement is TRUE when script is run in python)
+if __name__ == '__main__':
+    main()
@@ -15,7 +15,7 @@ from niflow.nipype1.workflows.fmri.fsl.estimate import create_fixed_effects_flow
 import nipype.interfaces.io as nio
 from nipype import Workflow, Node, MapNode, IdentityInterface, Function, DataSink, JoinNode, SelectFiles
 from itertools import combinations
-import nibabel as nib
+import sys
 import os
 import os.path as op
 import glob
@@ -24,6 +24,129 @@ import pandas as pd
 import argparse
 import shutil
 
+# add misc folder to path to import shared workflow scheduler and fixed effects functions
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from workflow_scheduler import read_plugin_settings, run_workflows
+from fixed_effects import combine_folds, average_psc_folds
+
+# define function to extract contrasts from contrasts.tsv file (used by the contrastgen node and the native fixed effects engine)
+def read_contrasts(projDir, task, contrast_opts):
+    import os.path as op
+    import pandas as pd 
+
+    contrasts = []
+    
+    # read in data contrasts file
+    contrasts_file = op.join(projDir, 'files', 'contrast_files', 'contrasts.tsv')
+        
+    # raise error if contrasts file not found
+    if not op.exists(contrasts_file):
+        raise FileNotFoundError('Contrasts file {} not found.'.format(contrasts_file))
+    
+    # read in contrasts file
+    contrast_info = pd.read_csv(contrasts_file, sep='\t')
+        
+    # set contrasts condition column to lowercase to avoid case errors and allow users flexibility when specifying events in config and contrasts files
+    contrast_info['desc'] = contrast_info['desc'].str.lower()
+    contrast_info['conds'] = contrast_info['conds'].str.lower()
+        
+    # select contrasts of interest specified in config file
+    contrast_info = contrast_info[contrast_info['desc'].isin(contrast_opts)]
+
+    # for each row
+    for index, row in contrast_info.iterrows():
+        # skip a row specifies a contrast for a different task (i.e., not pixar)
+        if row[0] != task:
+            continue
+        
+        # extract task contrasts
+        contrasts.append([
+            row[1],
+            'T',
+            [cond for cond in row[2].split(' ')],
+            [float(w) for w in row[3].split(' ')]
+        ])
+    
+    # raise error if there are no contrasts in the file for the current task
+    if not contrasts:
+        raise AttributeError('No contrasts found for task {}'.format(task))
+                    
+    return contrasts
+
+# define function to average percent signal change maps across runs for each fold (each run is loaded once for all folds)
+def combine_psc(resultsDir, sub, folds, contrast_opts, splithalf_id):
+    pscDir = op.join(resultsDir, '{}'.format(sub), 'psc')
+    if not op.isdir(pscDir):
+        return
+    
+    # create psc combined folder
+    os.makedirs(op.join(pscDir, 'combined'), exist_ok=True)
+    
+    # runs included in any fold
+    runs = sorted(set(r for fold in folds for r in fold))
+    
+    # loop over contrasts
+    for c in contrast_opts:
+        print('Averaging percent signal change over:')
+        psc_files = {}
+        for psc_run in runs:
+            if splithalf_id != 0:
+                psc_files[psc_run] = op.join(pscDir, 'run{}_splithalf{}'.format(psc_run, splithalf_id), '{}_psc.nii.gz'.format(c))
+            else:
+                psc_files[psc_run] = op.join(pscDir, 'run{}'.format(psc_run), '{}_psc.nii.gz'.format(c))
+            print('run {}: {}'.format(psc_run, psc_files[psc_run]))
+        
+        # mean psc output file name for each fold (named by the runs in the fold)
+        mean_psc_files = []
+        for fold in folds:
+            run_names = '_'.join(map(str, fold))
+            if splithalf_id != 0:
+                mean_psc_files.append(op.join(pscDir, 'combined', '{}_psc_runs-{}_splithalf{}_averaged.nii.gz'.format(c, run_names, splithalf_id)))
+            else:
+                mean_psc_files.append(op.join(pscDir, 'combined', '{}_psc_runs-{}_averaged.nii.gz'.format(c, run_names)))
+        
+        average_psc_folds(psc_files, folds, mean_psc_files)
+
+# define function to combine runs for every fold using the native fixed effects engine (each run is loaded once for all folds)
+def combine_runs_native(projDir, derivDir, resultsDir, sub, ses, task, folds, contrast_opts, splithalf_id, space_name, n_threads=1):
+    # define subject output directory
+    subDir = op.join(resultsDir, '{}'.format(sub))
+    
+    # raise an error if the firstlevel output directory doesn't exist
+    if not op.exists(subDir):
+        raise FileNotFoundError('No firstlevel outputs found for {}'.format(sub))
+    
+    # define mask file name, depending on whether session information is in directory/file names
+    if ses != 'no': # if session was provided
+        funcDir = op.join(derivDir, '{}'.format(sub), 'ses-{}'.format(ses), 'func')
+        mni_mask = op.join(funcDir, '{}_ses-{}_space-{}_desc-brain_mask_allruns-BOLDmask.nii.gz'.format(sub, ses, space_name))
+    else: # if session was 'no'
+        funcDir = op.join(derivDir, '{}'.format(sub), 'func')
+        mni_mask = op.join(funcDir, '{}_space-{}_desc-brain_mask_allruns-BOLDmask.nii.gz'.format(sub, space_name))
+    
+    # copy mask file to subject resultsDir (as done by the FSL fixed effects workflow)
+    shutil.copy(mni_mask, op.join(subDir, 'preproc'))
+    
+    # model directory of each run included in any fold
+    runs = sorted(set(r for fold in folds for r in fold))
+    if splithalf_id == 0:
+        run_dirs = {r: op.join(subDir, 'model', 'run{}'.format(r)) for r in runs}
+        combinedDir = op.join(subDir, 'model', 'combined_runs')
+    else:
+        run_dirs = {r: op.join(subDir, 'model', 'run{}_splithalf{}'.format(r, splithalf_id)) for r in runs}
+        combinedDir = op.join(subDir, 'model', 'combined_runs', 'splithalf{}'.format(splithalf_id))
+    
+    # add fold subfolder in combined_runs directory if runs are being combined in different folds
+    if len(folds) > 1:
+        out_dirs = [op.join(combinedDir, 'fold{}'.format(fold_id + 1)) for fold_id in range(len(folds))]
+    else:
+        out_dirs = [combinedDir]
+    
+    print('Combining runs {} in {} fold(s) with native fixed effects: {}'.format(runs, len(folds), folds))
+    contrasts = read_contrasts(projDir, task, contrast_opts)
+    
+    return combine_folds(run_dirs, folds, contrasts, op.join(subDir, 'preproc', op.basename(mni_mask)), out_dirs, n_threads)
+
 # define average runs workflow function
 def combine_runs_workflow(projDir, derivDir, resultsDir, subDir, workDir, sub, ses, task, num_folds, fold_id, runs, events, contrast_opts, splithalf_id, space_name, name='{}_task-{}_combineruns_fold{}'):
     
@@ -31,45 +154,6 @@ def combine_runs_workflow(projDir, derivDir, resultsDir, subDir, workDir, sub, s
     wf = Workflow(name=name.format(sub, task, fold_id),
                   base_dir=workDir)
                   
-    # combine percent signal change runs if psc folder exists
-    pscDir = op.join(resultsDir, '{}'.format(sub), 'psc')
-    if op.isdir(pscDir):
-        # create psc combined folder
-        os.makedirs(op.join(pscDir, 'combined'), exist_ok=True)
-        
-        # save run names for output file naming
-        run_names = '_'.join(map(str, runs))
-        
-        # loop over contrasts
-        for c in contrast_opts:
-            # loop through psc run folders
-            print('Averaging percent signal change over:')
-            psc_runs = []
-            for psc_run in runs:
-                if splithalf_id != 0:
-                    # grab run file
-                    psc_run_file = op.join(pscDir, 'run{}_splithalf{}'.format(psc_run, splithalf_id), '{}_psc.nii.gz'.format(c))
-                    # mean psc output file name
-                    mean_psc_file = op.join(pscDir, 'combined', '{}_psc_runs-{}_splithalf{}_averaged.nii.gz'.format(c, run_names, splithalf_id))
-                
-                if splithalf_id == 0:
-                    # grab run file
-                    psc_run_file = op.join(pscDir, 'run{}'.format(psc_run), '{}_psc.nii.gz'.format(c))
-                    # mean psc output file name
-                    mean_psc_file = op.join(pscDir, 'combined', '{}_psc_runs-{}_averaged.nii.gz'.format(c, run_names))
-                
-                psc_runs.append(psc_run_file)
-                print('run {}: {}'.format(psc_run, psc_run_file))
-            
-            # load, stack, and average data
-            psc_data = [nib.load(f).get_fdata() for f in psc_runs]
-            psc_stack = np.stack(psc_data, axis=-1)
-            psc_mean = np.mean(psc_stack, axis=-1)
-            psc_mean_img = nib.Nifti1Image(psc_mean, affine=nib.load(psc_runs[0]).affine)
-            
-            print('Saving averaged percent signal change map: {}'.format(mean_psc_file))
-            nib.save(psc_mean_img, mean_psc_file)
-      
     # create output directory for combined runs
     if splithalf_id == 0:
         combinedDir = op.join(subDir, 'model', 'combined_runs')
@@ -128,50 +212,6 @@ def combine_runs_workflow(projDir, derivDir, resultsDir, subDir, workDir, sub, s
         
         return sf.run().outputs
     
-    # define contrasts node to extract contrasts from contrasts.tsv file
-    def read_contrasts(projDir, task, contrast_opts):
-        import os.path as op
-        import pandas as pd 
-
-        contrasts = []
-        
-        # read in data contrasts file
-        contrasts_file = op.join(projDir, 'files', 'contrast_files', 'contrasts.tsv')
-            
-        # raise error if contrasts file not found
-        if not op.exists(contrasts_file):
-            raise FileNotFoundError('Contrasts file {} not found.'.format(contrasts_file))
-        
-        # read in contrasts file
-        contrast_info = pd.read_csv(contrasts_file, sep='\t')
-            
-        # set contrasts condition column to lowercase to avoid case errors and allow users flexibility when specifying events in config and contrasts files
-        contrast_info['desc'] = contrast_info['desc'].str.lower()
-        contrast_info['conds'] = contrast_info['conds'].str.lower()
-            
-        # select contrasts of interest specified in config file
-        contrast_info = contrast_info[contrast_info['desc'].isin(contrast_opts)]
-
-        # for each row
-        for index, row in contrast_info.iterrows():
-            # skip a row specifies a contrast for a different task (i.e., not pixar)
-            if row[0] != task:
-                continue
-            
-            # extract task contrasts
-            contrasts.append([
-                row[1],
-                'T',
-                [cond for cond in row[2].split(' ')],
-                [float(w) for w in row[3].split(' ')]
-            ])
-        
-        # raise error if there are no contrasts in the file for the current task
-        if not contrasts:
-            raise AttributeError('No contrasts found for task {}'.format(task))
-                        
-        return contrasts     
-    
     # define substitutes node
     def substitutes(contrasts):
         """Datasink output path substitutes"""
@@ -359,6 +399,11 @@ def main(argv=None):
     space=config_file.loc['space',1]
     loocv=config_file.loc['leave_one_out',1]
     
+    # fixed effects engine (fsl by default)
+    combine_engine = 'fsl'
+    if 'combine_engine' in config_file.index and config_file.loc['combine_engine',1] is not None:
+        combine_engine = config_file.loc['combine_engine',1]
+    
     # define working directory
     workDir = op.join(resultsDir, 'processing')
     
@@ -386,7 +431,11 @@ def main(argv=None):
         file_1.write('\n')
         file_1.write('Subject runs were averaged using the combine_runs.py script and options specified in the config file: {} \n'.format(args.config))
 
+    # read nipype plugin settings (number of processes, memory, and node resource estimates) from config file
+    plugin_settings = read_plugin_settings(config_file, args.plugin)
+    
     # for each subject in the list of subjects
+    workflows = []
     for index, sub in enumerate(args.subjects):
         for splithalf_id in splithalves:
             # check that run info was provided in subject list, otherwise throw an error
@@ -437,6 +486,14 @@ def main(argv=None):
             num_folds = len(folds)
             print('Runs will be combined in {} fold(s)'.format(num_folds))
             
+            # average percent signal change maps for all folds
+            combine_psc(resultsDir, sub, folds, contrast_opts, splithalf_id)
+            
+            # combine all folds in one pass if the native fixed effects engine was requested
+            if combine_engine == 'native':
+                combine_runs_native(args.projDir, derivDir, resultsDir, sub, ses, task, folds, contrast_opts, splithalf_id, space_name, plugin_settings['plugin_args']['n_procs'])
+                continue
+            
             for fold_id, fold in enumerate(folds):
                 print('Combining runs: {}'.format(fold))
                 fold_runs = list(map(int, fold)) # convert to integers
@@ -448,10 +505,11 @@ def main(argv=None):
                 wf.config['execution'] = {'crashfile_format': 'txt',
                                           'remove_unnecessary_outputs': False,
                                           'keep_inputs': True}
-
-                # run multiproc
-                args_dict = {'n_procs' : 4}
-                wf.run(plugin='MultiProc', plugin_args = args_dict)
+                workflows.append(wf)
+    
+    # run workflows (multiproc unless plugin specified in script call)
+    if workflows:
+        run_workflows(workflows, workDir, plugin_settings)
 
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':
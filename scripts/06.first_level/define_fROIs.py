@@ -23,6 +23,10 @@ from nilearn import masking
 import nilearn
 import shutil
 
+# add misc folder to path to import shared subject executor functions
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from subject_executor import add_jobs_argument, run_subjects
+
 def process_subject(projDir, sharedDir, resultsDir, sub, runs, task, contrast_opts, splithalves, search_spaces, match_events, template, top_nvox, percent):
 
     # define search spaces dictionary
@@ -221,6 +225,7 @@ def argparser():
                         help='Specify a sparse model')
     parser.add_argument('-m', dest='plugin',
                         help='Nipype plugin to use (default: MultiProc)')
+    parser = add_jobs_argument(parser)
     return parser
 
 # define main function that parses the config file and runs the functions defined above
@@ -286,6 +291,7 @@ def main(argv=None):
         top_nvox = int(top_nvox)
         
     # for each subject in the list of subjects
+    subject_args = []
     for index, sub in enumerate(args.subjects):
         print('Defining fROIs for {}'.format(sub))
         
@@ -301,8 +307,11 @@ def main(argv=None):
         else:
             sub_runs=list(map(int, sub_runs)) # convert to integers     
         
-        # create a process_subject workflow with the inputs defined above
-        process_subject(args.projDir, sharedDir, resultsDir, sub, sub_runs, task, contrast_opts, splithalves, search_spaces, match_events, template, top_nvox, percent)
+        # save the process_subject inputs defined above for this subject
+        subject_args.append([args.projDir, sharedDir, resultsDir, sub, sub_runs, task, contrast_opts, splithalves, search_spaces, match_events, template, top_nvox, percent])
+    
+    # run process_subject for each subject (in parallel if more than 1 job was requested)
+    run_subjects(process_subject, args.subjects, subject_args, jobs=args.jobs, logDir=op.join(resultsDir, 'logs', 'define_fROIs'))
 
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':
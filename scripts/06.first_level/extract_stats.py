@@ -12,13 +12,26 @@ import os.path as op
 import os
 import glob
 import shutil
+import nibabel as nib
 import nilearn
 from nilearn import image
 from nilearn import masking
-from nilearn.maskers import NiftiMasker
+
+# add misc folder to path to import shared stats table and subject executor functions
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from stats_table import StatsTable, stats_extension
+from subject_executor import add_jobs_argument, run_subjects
+
+# define function to load an image as a 3D array (removes the 4th singleton dimension from statistical maps and fROIs)
+def load_3d(img_file):
+    img_dat = np.asanyarray(nib.load(img_file).dataobj).astype(np.float64)
+    if img_dat.ndim == 4 and img_dat.shape[3] == 1:
+        img_dat = img_dat[..., 0]
+    
+    return img_dat
 
 # define function to extract stats for each subject
-def process_subject(projDir, sharedDir, resultsDir, froiDir, sub, runs, folds, task, contrast_opts, splithalves, mask_opts, match_events, template, extract_opt, psc, top_nvox, percent):
+def process_subject(projDir, sharedDir, resultsDir, froiDir, sub, runs, folds, task, contrast_opts, splithalves, mask_opts, match_events, template, extract_opt, psc, top_nvox, percent, stats_format='csv'):
     
     # make output stats directory
     statsDir = op.join(resultsDir, '{}'.format(sub), 'stats')
@@ -26,17 +39,20 @@ def process_subject(projDir, sharedDir, resultsDir, froiDir, sub, runs, folds, t
     
     # create output file name
     if froiDir == None:
-        stats_file = op.join(statsDir, '{}_task-{}_{}_ROI_magnitudes.csv'.format(sub, task, extract_opt))
+        stats_file = op.join(statsDir, '{}_task-{}_{}_ROI_magnitudes.{}'.format(sub, task, extract_opt, stats_extension(stats_format)))
     else:
         # take the second to last element because this *should* be the localiser name (e.g., tomloc/belief-photo; langloc/sentence-nonword)
         localiser_name = op.basename(op.dirname(froiDir.rstrip('/'))) # froiDir.split('/')[-2] 
         
         # add localiser task name from froiDir to stats file name
-        stats_file = op.join(statsDir, '{}_task-{}_{}_{}_ROI_magnitudes.csv'.format(sub, task, localiser_name, extract_opt))
+        stats_file = op.join(statsDir, '{}_task-{}_{}_{}_ROI_magnitudes.{}'.format(sub, task, localiser_name, extract_opt, stats_extension(stats_format)))
         
-    # delete output file if it already exists (to ensure stats aren't appended to pre-existing files)
+    # delete output file if it already exists (to ensure stats from a previous extraction aren't left behind)
     if op.isfile(stats_file):
         os.remove(stats_file)
+    
+    # initialise table to collect stats (saved once all stats have been extracted)
+    stats_table = StatsTable()
         
     # define combined run directory for this subject
     combinedDir = op.join(resultsDir, '{}'.format(sub), 'model', 'combined_runs')
@@ -217,25 +233,22 @@ def process_subject(projDir, sharedDir, resultsDir, froiDir, sub, runs, folds, t
                         
             print('Model directory: {}'.format(modelDir))
             
+            # read mni file dimensions from the header (used only to check whether resampling is required)
+            mni_shape = nib.load(mni_file).shape
+            
+            # initialise ROI masks and mask names for this run/splithalf
+            roi_bins = []
+            mask_names = []
+            
             # for each ROI search space
             for r, roi in enumerate(roi_masks):
                 
-                # load and binarize mni file
-                mni_img = image.load_img(mni_file)
-                mni_bin = mni_img.get_fdata() # get image data (as floating point data)
-                mni_bin[mni_bin >= 1] = 1 # for values equal to or greater than 1, make 1 (values less than 1 are already 0)
-                mni_bin = image.new_img_like(mni_img, mni_bin) # create a new image of the same class as the initial image
-                
-                # load roi mask
-                mask_img = image.load_img(roi)
-                mask_bin = mask_img.get_fdata()
-                
-                # ensure that mask/ROI is binarized
-                mask_bin[mask_bin >= 1] = 1 # for values equal to or greater than 1, make 1 (values less than 1 are already 0)
-                mask_bin = image.new_img_like(mask_img, mask_bin) # create a new image of the same class as the initial image
+                # load roi mask (squeezed to 3 dimensions)
+                roi_file = roi[0] if isinstance(roi, list) else roi
+                mask_bin = load_3d(roi_file)
                 
                 # the masks should already be resampled, but check if this is true and resample if not
-                if mni_img.shape[0:3] != mask_bin.shape[0:3]:
+                if mni_shape[0:3] != mask_bin.shape[0:3]:
                     print('WARNING: the search space provided has different dimensions than the functional data!')
                     
                     # make directory to save resampled rois
@@ -243,7 +256,7 @@ def process_subject(projDir, sharedDir, resultsDir, froiDir, sub, runs, folds, t
                     os.makedirs(roiDir, exist_ok=True)
                     
                     # extract file name
-                    roi_name = str(roi).replace('/','-').split('-')[-1]                    
+                    roi_name = str(roi).replace('/','-').split('-')[-1]
                     
                     roi_name = roi_name.split('.nii')[0]
                     resampled_file = op.join(roiDir, '{}_resampled.nii.gz'.format(roi_name))
@@ -251,211 +264,191 @@ def process_subject(projDir, sharedDir, resultsDir, froiDir, sub, runs, folds, t
                     # check if file already exists
                     if op.isfile(resampled_file):
                         print('Found previously resampled {} ROI in output directory'.format(roi_name))
-                        mask_bin = image.load_img(resampled_file)
                     else:
-                        # resample image
+                        # binarize and resample image
                         print('Resampling {} search space to match functional data'.format(roi_name))
-                        mask_bin = image.resample_to_img(mask_bin, mni_img, interpolation='nearest')
-                        mask_bin.to_filename(resampled_file)
+                        mask_img = image.load_img(roi_file)
+                        mask_dat = mask_img.get_fdata()
+                        mask_dat[mask_dat >= 1] = 1 # for values equal to or greater than 1, make 1 (values less than 1 are already 0)
+                        mask_img = image.new_img_like(mask_img, mask_dat) # create a new image of the same class as the initial image
+                        mask_img = image.resample_to_img(mask_img, mni_file, interpolation='nearest')
+                        mask_img.to_filename(resampled_file)
+                    
+                    mask_bin = load_3d(resampled_file)
                 
-                # for each contrast
-                for c in contrast_opts:
-                    # extract mask name in a format that will match contrast naming
-                    if 'fROI' in mask_opts[r]:
-                        mask_name = mask_opts[r].split('-')[1].lower()
+                # ensure that mask/ROI is binarized
+                roi_bins.append(mask_bin > 0)
+                
+                # extract mask name in a format that will match contrast naming
+                if 'fROI' in mask_opts[r]:
+                    mask_names.append(mask_opts[r].split('-')[1].lower())
+                elif 'aROI' in mask_opts[r]:
+                    mask_names.append(mask_opts[r].split('-')[1].lower())
+                else:
+                    mask_names.append(mask_opts[r])
+            
+            # define the union of all ROI voxels (only these voxels are read from the statistical maps)
+            union_bin = np.any(roi_bins, axis=0)
+            
+            # define which contrasts are needed for each ROI
+            roi_contrasts = []
+            for r, mask_name in enumerate(mask_names):
+                if match_events == 'yes': # if the search space (lowercase) is contained within the contrast_opts specified
+                    for c in contrast_opts:
+                        if mask_name not in c:
+                            print('Skipping {} search space for the {} contrast'.format(mask_opts[r], c))
+                    roi_contrasts.append([c for c in contrast_opts if mask_name in c])
+                else:
+                    roi_contrasts.append(contrast_opts)
+            
+            contrasts = [c for c in contrast_opts if any(c in rc for rc in roi_contrasts)]
+            
+            # use more transparent run label for cases when stats are extracted from combined data
+            if combined == 'yes':
+                if folds == 'yes':
+                    run_label = run_id
+                else:
+                    run_label = 0
+            else:
+                run_label = run_id
+            
+            # decide whether to label column 'run' or 'fold' depending on whether folds is 'yes'
+            label_type = 'fold' if folds == 'yes' else 'run'
+            
+            # load each statistical map once and stack the union voxels (contrasts x voxels)
+            zstats = np.zeros((len(contrasts), union_bin.sum()))
+            tstats = np.zeros((len(contrasts), union_bin.sum()))
+            pscs = np.zeros((len(contrasts), union_bin.sum()))
+            
+            for ci, c in enumerate(contrasts):
+                # psc file (if requested)
+                if psc == 'yes':
+                    # if not combined results
+                    if combined == 'no':
+                        if splithalf_id != 0:
+                            pscDir = op.join(resultsDir, '{}'.format(sub), 'psc', 'run{}_splithalf{}'.format(run_id, splithalf_id))
+                        else:
+                            pscDir = op.join(resultsDir, '{}'.format(sub), 'psc', 'run{}'.format(run_id))
                         
-                    elif 'aROI' in mask_opts[r]:
-                        mask_name = mask_opts[r].split('-')[1].lower()
+                        # define PSC file name
+                        psc_file = op.join(pscDir, '{}_psc.nii.gz'.format(c))
                     
-                    else:
-                        mask_name = mask_opts[r]
+                    # if combined results
+                    if combined == 'yes':
+                        # define combined psc directory
+                        pscDir = op.join(resultsDir, '{}'.format(sub), 'psc', 'combined')
+                        
+                        # throw an error if combined psc directory isn't found
+                        if not op.isdir(pscDir):
+                            raise FileNotFoundError('No combined percent signal change outputs found for {}'.format(sub))
+                        
+                        if folds == 'yes':
+                           # read in subject fold info file to get list of runs in each fold
+                           fold_info_file = op.join(resultsDir, '{}'.format(sub), 'fold_info.tsv')
+                           print('Looking up runs in fold{} using: {}'.format(run_id, fold_info_file))
+                           
+                           fold_info = pd.read_csv(fold_info_file, sep='\t')
+                           runs_str = fold_info.loc[fold_info['fold'] == 'fold{}'.format(run_id), 'runs'].values[0]
+                           psc_runs = list(map(int, runs_str.split(',')))
+                        
+                        else:
+                            psc_runs = runs
+                        
+                        # save run names for finding correct file
+                        run_names = '_'.join(map(str, psc_runs))
+                        
+                        # load PSC file depending on whether run was splithalved
+                        if splithalf_id != 0:
+                            # mean psc output file name
+                            psc_file = op.join(pscDir, '{}_psc_runs-{}_splithalf{}_averaged.nii.gz'.format(c, run_names, splithalf_id))
+                        
+                        if splithalf_id == 0:
+                            # mean psc output file name
+                            psc_file = op.join(pscDir, '{}_psc_runs-{}_averaged.nii.gz'.format(c, run_names))
+                    
+                    # load psc file
+                    print('Extracting percent signal change for {} contrast using: {}'.format(c, psc_file))
+                    pscs[ci] = load_3d(psc_file)[union_bin]
+                
+                # z-stats copes file
+                zcope_file = glob.glob(op.join(modelDir, '*_{}_zstat.nii.gz'.format(c)))[0]
+                zstats[ci] = load_3d(zcope_file)[union_bin]
+                
+                # t-stats copes file
+                tcope_file = glob.glob(op.join(modelDir, '*_{}_tstat.nii.gz'.format(c)))[0]
+                tstats[ci] = load_3d(tcope_file)[union_bin]
+            
+            # for each ROI search space
+            for r, roi in enumerate(roi_masks):
+                
+                # select the ROI voxels from the union voxels
+                roi_vox = roi_bins[r][union_bin]
+                
+                # for each contrast
+                for c in roi_contrasts[r]:
+                    print('Extracting stats from {} mask within {} contrast'.format(mask_opts[r], c))
+                    ci = contrasts.index(c)
+                    
+                    # mask contrast values with roi
+                    zvals = zstats[ci, roi_vox]
+                    tvals = tstats[ci, roi_vox]
+                    pscvals = pscs[ci, roi_vox]
                     
-                    if match_events == 'yes' and mask_name not in c: # if the search space (lowercase) is contained within the contrast_opts specified
-                        print('Skipping {} search space for the {} contrast'.format(mask_opts[r], c))
-                    else: 
-                        print('Extracting stats from {} mask within {} contrast'.format(mask_opts[r], c))
+                    # mask and extract values depending on extract_opt
+                    if extract_opt == 'mean': # if mean requested
                         
-                        # psc file (if requested)
-                        if psc == 'yes':
-                            # if not combined results
-                            if combined == 'no':
-                                if splithalf_id != 0:                                
-                                    pscDir = op.join(resultsDir, '{}'.format(sub), 'psc', 'run{}_splithalf{}'.format(run_id, splithalf_id))
-                                else:
-                                    pscDir = op.join(resultsDir, '{}'.format(sub), 'psc', 'run{}'.format(run_id))
-                            
-                                # define PSC file name
-                                psc_file = op.join(pscDir, '{}_psc.nii.gz'.format(c))
-                                
-                            # if combined results
-                            if combined == 'yes':
-                                # define combined psc directory
-                                pscDir = op.join(resultsDir, '{}'.format(sub), 'psc', 'combined')
-                                
-                                # throw an error if combined psc directory isn't found
-                                if not op.isdir(pscDir):
-                                    raise FileNotFoundError('No combined percent signal change outputs found for {}'.format(sub))
-                                
-                                if folds == 'yes':
-                                   # read in subject fold info file to get list of runs in each fold
-                                   fold_info_file = op.join(resultsDir, '{}'.format(sub), 'fold_info.tsv')
-                                   print('Looking up runs in fold{} using: {}'.format(run_id, fold_info_file))
-                                   
-                                   fold_info = pd.read_csv(fold_info_file, sep='\t')
-                                   runs_str = fold_info.loc[fold_info['fold'] == 'fold{}'.format(run_id), 'runs'].values[0]
-                                   psc_runs = list(map(int, runs_str.split(',')))
-                                
-                                else:
-                                    psc_runs = runs
-                                
-                                # save run names for finding correct file
-                                run_names = '_'.join(map(str, psc_runs))
-                                
-                                # load PSC file depending on whether run was splithalved
-                                if splithalf_id != 0:
-                                    # mean psc output file name
-                                    psc_file = op.join(pscDir, '{}_psc_runs-{}_splithalf{}_averaged.nii.gz'.format(c, run_names, splithalf_id))
-                                    
-                                if splithalf_id == 0:
-                                    # mean psc output file name
-                                    psc_file = op.join(pscDir, '{}_psc_runs-{}_averaged.nii.gz'.format(c, run_names))
-                                
-                            # load psc file
-                            print('Extracting percent signal change for {} contrast using: {}'.format(c, psc_file))
-                            psc_img = image.load_img(psc_file)
-                            
-                        # z-stats copes file
-                        zcope_file = glob.glob(op.join(modelDir, '*_{}_zstat.nii.gz'.format(c)))
-                        zcope_img = image.load_img(zcope_file)
+                        # take the mean of voxels within mask (zero values are excluded, as they are outside of the brain)
+                        mean_zval = np.nanmean(zvals[zvals != 0]) # z-stats
+                        mean_tval = np.nanmean(tvals[tvals != 0]) # t-stats
                         
-                        # t-stats copes file
-                        tcope_file = glob.glob(op.join(modelDir, '*_{}_tstat.nii.gz'.format(c)))
-                        tcope_img = image.load_img(tcope_file)
+                        # if mean psc values were requested
+                        if psc == 'yes':
+                            mean_psc = np.nanmean(pscvals[pscvals != 0]) # psc values
                         
-                        # squeeze the statistical map to remove the 4th singleton dimension if using anatomical/atlas ROI
-                        # this dimension is not adding any information, so this is fine to do; the 3D map of stats values is preserved.
-                        # this step isn't necessary for fROIs because they were defined using the functional data and also have a 4th singleton dimension
-                        if not 'fROI' in mask_opts[r] and not 'FS' in mask_opts[r] and not 'aROI' in mask_opts[r]:
-                            zcope_img = image.math_img('np.squeeze(img)', img=zcope_img)
-                            tcope_img = image.math_img('np.squeeze(img)', img=tcope_img)
-                            
-                        # remove the 4th singleton dimension from all files if extracting PSC (only 3 dimensions)
+                        print('Mean z-stat within {}: {}'. format(mask_opts[r], mean_zval))
+                        print('Mean t-stat within {}: {}'. format(mask_opts[r], mean_tval))
                         if psc == 'yes':
-                            zcope_img = image.math_img('np.squeeze(img)', img=zcope_img)
-                            tcope_img = image.math_img('np.squeeze(img)', img=tcope_img)
-                            psc_img = image.math_img('np.squeeze(img)', img=psc_img)
-                            mask_bin = image.math_img('np.squeeze(img)', img=mask_bin)
+                            print('Mean percent signal change within {}: {}'. format(mask_opts[r], mean_psc))
                         
-                        # use more transparent run label for cases when stats are extracted from combined data
-                        if combined == 'yes':
-                            if folds == 'yes':
-                                run_label = run_id
-                            else:
-                                run_label = 0
-                        else:
-                            run_label = run_id
-                            
-                        # decide whether to label column 'run' or 'fold' depending on whether folds is 'yes'
-                        label_type = 'fold' if folds == 'yes' else 'run'
+                        row = {'sub': sub,
+                               'task': task,
+                               label_type: run_label}
+                        if splithalf_id != 0:
+                            row['half'] = splithalf_id
+                        row.update({'mask': mask_opts[r],
+                                    'roi_file': roi[0] if isinstance(roi, list) else roi,
+                                    'contrast': c,
+                                    'mean_tval': mean_tval,
+                                    'mean_zval': mean_zval})
+                        if psc == 'yes':
+                            row['mean_psc'] = mean_psc
                         
-                        # mask and extract values depending on extract_opt
-                        if extract_opt == 'mean': # if mean requested
-                                                
-                            # if mean psc values were requested
-                            if psc == 'yes':
-                                masked_pscimg = image.math_img('img1 * img2', img1 = psc_img, img2 = mask_bin)
-                                masked_pscdata = masked_pscimg.get_fdata()
-                                mean_psc = np.nanmean(masked_pscdata[masked_pscdata != 0]) # psc values                             
+                        # add row to stats table
+                        stats_table.append(**row)
+                    
+                    # return voxelwise values
+                    else:
+                        # add columns with sub, task, run, split, and mask info and voxel values (one row per voxel; non-finite values are set to 0, as done by NiftiMasker)
+                        rows = {'sub': '{}'.format(sub),
+                                'task': task,
+                                label_type: run_label}
+                        if splithalf_id != 0:
+                            rows['half'] = splithalf_id
+                        rows.update({'contrast': c,
+                                     'mask': mask_opts[r],
+                                     'voxel_index': np.arange(len(zvals))})
+                        if psc == 'yes':
+                            rows['psc'] = np.where(np.isfinite(pscvals), pscvals, 0)
+                        rows.update({'t-stat': np.where(np.isfinite(tvals), tvals, 0),
+                                     'z-stat': np.where(np.isfinite(zvals), zvals, 0)})
                         
-                            # mask contrast image with roi image                         
-                            ## z-stats
-                            masked_zimg = image.math_img('img1 * img2', img1 = zcope_img, img2 = mask_bin)
-                            masked_zdata = masked_zimg.get_fdata()
-                            
-                            ## t-stats
-                            masked_timg = image.math_img('img1 * img2', img1 = tcope_img, img2 = mask_bin)
-                            masked_tdata = masked_timg.get_fdata()
-                            
-                            # take the mean of voxels within mask
-                            mean_zval = np.nanmean(masked_zdata[masked_zdata != 0]) # z-stats
-                            mean_tval = np.nanmean(masked_tdata[masked_tdata != 0]) # t-stats
-                            
-                            # save masked file (optional data checking step)
-                            #masked_zdata_file = op.join(modelDir, '{}_{}_masked_zdata.nii.gz'.format(mask_opts[r],c))
-                            #masked_zimg.to_filename(masked_zdata_file)
-                            
-                            print('Mean z-stat within {}: {}'. format(mask_opts[r], mean_zval))
-                            print('Mean t-stat within {}: {}'. format(mask_opts[r], mean_tval))
-                            if psc == 'yes':
-                                print('Mean percent signal change within {}: {}'. format(mask_opts[r], mean_psc))
-                                
-                            if splithalf_id != 0:
-                                df_row = pd.DataFrame({'sub': sub,
-                                                       'task': task,
-                                                       label_type: run_label,
-                                                       'half': splithalf_id,
-                                                       'mask': mask_opts[r],
-                                                       'roi_file': roi,
-                                                       'contrast': c,
-                                                       'mean_tval': mean_tval,
-                                                       'mean_zval': mean_zval}, index=[0])
-                            
-                            else:
-                                df_row = pd.DataFrame({'sub': sub,
-                                                       'task': task,
-                                                       label_type: run_label,
-                                                       'mask': mask_opts[r],
-                                                       'roi_file': roi,
-                                                       'contrast': c,
-                                                       'mean_tval': mean_tval,                                                     
-                                                       'mean_zval': mean_zval}, index=[0])
-                            
-                            if psc == 'yes':
-                                df_row['mean_psc'] = mean_psc
-                                
-                            if not op.isfile(stats_file): # if the stats output file doesn't exist
-                                # save current row as file
-                                df_row.to_csv(stats_file, index=False, header='column_names')
-                            else: # if the stats output file exists
-                                # append current row without header labels
-                                df_row.to_csv(stats_file, mode='a', index=False, header=False)
-
-                        # return voxelwise values
-                        else:
-                            # mask contrast image with roi image and return 2D array
-                            masker = NiftiMasker(mask_img=mask_bin)
-                            ## psc
-                            if psc == 'yes':
-                                masked_pscdata = masker.fit_transform(psc_img)
-                            ## z-stats
-                            masked_zdata = masker.fit_transform(zcope_img)
-                            ## t-stats
-                            masked_tdata = masker.fit_transform(tcope_img)
-                            
-                            # convert to data frame
-                            ## z-stats
-                            masked_df = pd.DataFrame(masked_zdata).transpose()
-                            masked_df = masked_df.rename(columns={0: 'z-stat'})
-                            
-                            # add columns with t-stats, run, task, split, and mask info
-                            masked_df.insert(loc=0, column='t-stat', value=pd.DataFrame(masked_tdata).transpose())
-                            if psc == 'yes':
-                                masked_df.insert(loc=0, column='psc', value=pd.DataFrame(masked_pscdata).transpose())
-                            masked_df.insert(loc=0, column='voxel_index', value=range(len(masked_df)))
-                            masked_df.insert(loc=0, column='mask', value=mask_opts[r])
-                            masked_df.insert(loc=0, column='contrast', value=c)
-                            if splithalf_id != 0:
-                                masked_df.insert(loc=0, column='half', value=splithalf_id)
-                            masked_df.insert(loc=0, column=label_type, value=run_label)
-                            masked_df.insert(loc=0, column='task', value=task)
-                            masked_df.insert(loc=0, column='sub', value='{}'.format(sub))
-                            
-                            if not op.isfile(stats_file): # if the stats output file doesn't exist
-                                # save dataframe
-                                masked_df.to_csv(stats_file, index=False, header='column_names')
-                            else:
-                                # append current row without header labels
-                                masked_df.to_csv(stats_file, mode='a', index=False, header=False)
+                        # add rows to stats table
+                        stats_table.append(**rows)
+    
+    # save stats table
+    if len(stats_table) > 0:
+        stats_table.write(stats_file)
+        print('Stats saved to {}'.format(stats_file))
                                 
 # define command line parser function
 def argparser():
@@ -478,6 +471,7 @@ def argparser():
                         help='Specify a sparse model')
     parser.add_argument('-m', dest='plugin',
                         help='Nipype plugin to use (default: MultiProc)')
+    parser = add_jobs_argument(parser)
     return parser
 
 # define main function that parses the config file and runs the functions defined above
@@ -512,6 +506,12 @@ def main(argv=None):
     top_nvox=config_file.loc['top_nvox',1]
     extract_opt=config_file.loc['extract',1]
     
+    # file format for stats tables: csv or parquet (optional, default csv)
+    if 'stats_format' in config_file.index and config_file.loc['stats_format',1] is not None:
+        stats_format=config_file.loc['stats_format',1]
+    else:
+        stats_format='csv'
+    
     # lowercase contrast_opts to avoid case errors - allows flexibility in how users specify contrasts in config and contrasts files
     contrast_opts = [c.lower() for c in contrast_opts]
     
@@ -543,6 +543,7 @@ def main(argv=None):
         raise IOError('Results directory {} not found.'.format(resultsDir))
         
     # for each subject in the list of subjects
+    subject_args = []
     for index, sub in enumerate(args.subjects):
         print('Extracting stats for {}'.format(sub))
         
@@ -558,8 +559,11 @@ def main(argv=None):
         else:
             sub_runs=list(map(int, sub_runs)) # convert to integers
         
-        # create a process_subject workflow with the inputs defined above
-        process_subject(args.projDir, sharedDir, resultsDir, froiDir, sub, sub_runs, folds, task, contrast_opts, splithalves, mask_opts, match_events, template, extract_opt, psc, top_nvox, percent)
+        # save the process_subject inputs defined above for this subject
+        subject_args.append([args.projDir, sharedDir, resultsDir, froiDir, sub, sub_runs, folds, task, contrast_opts, splithalves, mask_opts, match_events, template, extract_opt, psc, top_nvox, percent, stats_format])
+    
+    # run process_subject for each subject (in parallel if more than 1 job was requested)
+    run_subjects(process_subject, args.subjects, subject_args, jobs=args.jobs, logDir=op.join(resultsDir, 'logs', 'extract_stats'))
 
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':
@@ -25,10 +25,17 @@ import glob
 import shutil
 from datetime import datetime
 
+# add misc folder to path to import shared workflow scheduler functions
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from workflow_scheduler import read_plugin_settings, run_workflows
+from storage_policy import working_ext
+from smooth_cache import read_cache_settings
+from qc_ledger import subject_scans
+
 # define first level workflow function
 def create_firstlevel_workflow(projDir, derivDir, workDir, outDir, 
                                sub, task, ses, multiecho, runs, events_files, events, modulators, contrast_opts, timecourses,
-                               regressor_opts, smoothing_kernel_size, smoothDir, hpf, TR, dropvols, splithalves, space_name, sparse,
+                               regressor_opts, smoothing_kernel_size, smoothDir, hpf, TR, dropvols, splithalves, space_name, sparse, glm_engine='fsl', glm_threads=1, design_engine='fsl', median_method='exact', smooth_cache=None, smooth_order='split',
                                name='{}_task-{}_levelone'):
     """Processing pipeline"""
     
@@ -156,41 +163,11 @@ def create_firstlevel_workflow(projDir, derivDir, workDir, outDir,
     datasource.inputs.multiecho = multiecho
     datasource.inputs.space_name = space_name
 
-    # if drop volumes requested
-    if dropvols != 0:
-        # compute values for dropping volumes (if requested)
-        def compute_extractroi_params(dropvols, nVols):
-            if dropvols > 0:
-                # drop from start
-                print('Dropping {} volumes from the beginning of the functional run'.format(dropvols))
-                t_min = dropvols
-                t_size = -1
-            elif dropvols < 0:
-                # drop from end
-                print('Dropping {} volumes from the end of the functional run'.format(abs(dropvols)))
-                t_min = 0
-                t_size = nVols
-            else:
-                t_min = 0
-                t_size = -1
-                
-            return t_min, t_size
-            
-        compute_roi_params = Node(Function(input_names=['dropvols',
-                                                        'nVols'],
-                                           output_names=['t_min',
-                                                         't_size'],
-                                           function=compute_extractroi_params),
-                                           name='dropvolumes')
-        compute_roi_params.inputs.dropvols = dropvols
-
-        roi = Node(fsl.ExtractROI(), name='extractroi')
-        
-        wf.connect([(datasource, compute_roi_params, [('nVols', 'nVols')]),
-                    (compute_roi_params, roi, [('t_min', 't_min'),('t_size', 't_size')]),
-                    (datasource, roi, [('mni_file', 'in_file')])])
-    # else:
-        # roi_file = datasource.outputs.mni_file
+    # report dropped volumes (the volumes are dropped by the mni_split node, along with any split halves, so no extra copy of the data is made)
+    if dropvols > 0:
+        print('Dropping {} volumes from the beginning of the functional run'.format(dropvols))
+    elif dropvols < 0:
+        print('Dropping {} volumes from the end of the functional run'.format(abs(dropvols)))
         
     # define function to process data into halves for analysis (if requested in config file)
     def process_data_files(sub, task, mni_file, event_file, timecourses, art_file, confound_file, regressor_opts, run_id, splithalf_id, TR, dropvols, nVols, outDir):
@@ -328,8 +305,14 @@ def create_firstlevel_workflow(projDir, derivDir, workDir, outDir,
             outliers = outliers[outliers > max(droppedVols)] # select outliers from second half
             outliers = outliers-max(droppedVols+1) # outlier volume ids relative to start of run
 
-        # get number of volumes in current run
-        curVols = load(mni_file).shape[3]
+        # get number of volumes in current run after dropping volumes (read from the file header, so the data are not loaded)
+        fileVols = load(mni_file).shape[3]
+        if dropvols > 0:
+            curVols = fileVols - dropvols
+        elif dropvols < 0:
+            curVols = min(fileVols, nVols)
+        else:
+            curVols = fileVols
  
         # process full timeseries if the current run is already split data
         if curVols < nVols:
@@ -339,15 +322,21 @@ def create_firstlevel_workflow(projDir, derivDir, workDir, outDir,
 
         # save outliers (split or not) as text file in outDir for modeling
         outliers.to_csv(outlier_file, index=False, header=False)
+        
+        # save stimuli and confounds as files in the node directory (files are passed to the modelinfo node rather than dataframes, so the node inputs can be hashed when workflows are rerun)
+        stimuli_file = op.join(os.getcwd(), 'stimuli.tsv')
+        confounds_file = op.join(os.getcwd(), 'confounds.tsv')
+        pd.DataFrame(stimuli).to_csv(stimuli_file, sep='\t', index=False, na_rep='n/a')
+        confounds.to_csv(confounds_file, sep='\t', index=False, na_rep='n/a')
 
         # return processed data - either split or full run depending on 'splithalf' parameter in config file
-        return t_min, t_size, stimuli, confounds, regressor_names, outlier_file
+        return t_min, t_size, stimuli_file, confounds_file, regressor_names, outlier_file
          
     # set up splitdata Node with specified outputs
     splitdata = Node(Function(output_names=['t_min',
                                             't_size',
-                                            'stimuli',
-                                            'confounds',
+                                            'stimuli_file',
+                                            'confounds_file',
                                             'regressor_names',
                                             'outlier_file'],
                               function=process_data_files), name='splitdata')
@@ -366,22 +355,89 @@ def create_firstlevel_workflow(projDir, derivDir, workDir, outDir,
     splitdata.inputs.sub = sub
     splitdata.inputs.regressor_opts = regressor_opts
     splitdata.inputs.timecourses = timecourses
-    if dropvols != 0: # pass file with dropped volumes if requested
-        wf.connect(roi, 'roi_file', splitdata, 'mni_file')
-    else: # otherwise pass preprocessed data file
-        wf.connect(datasource, 'mni_file', splitdata, 'mni_file')
+    wf.connect(datasource, 'mni_file', splitdata, 'mni_file')
 
-    # set up extractROI node to segment runs based on output from splitdata Node (output is called 'roi_file')
-    mni_split = Node(fsl.ExtractROI(), name='mni_split')
+    # when smoothing the full run before splitting, the smoothed runs are shared through a cache in the working directory if no cache directory was specified
+    if run_smoothing and smooth_order == 'full' and not smooth_cache:
+        smooth_cache = {'cache_dir': op.join(workDir, 'smooth_cache'), 'cache_gb': 100}
+    
+    # define function to select the volumes to analyse (dropped volumes and split halves are combined into a single range of the preprocessed data file)
+    def select_volumes(in_file, dropvols, nVols, t_min, t_size, materialize, out_ext, misc_dir):
+        import os
+        import sys
+        from nibabel import load
+        
+        # import temporal view functions
+        sys.path.append(misc_dir)
+        from temporal_view import view_range, save_view, save_reference
+        
+        # combine dropped volumes and split half volumes (number of volumes is read from the file header)
+        t_min, t_size = view_range(load(in_file).shape[3], dropvols, nVols, t_min, t_size)
+        print('Selected volumes {} to {} of {}'.format(t_min, t_min + t_size - 1, in_file))
+        
+        # save the first selected volume as a reference image for later scripts
+        ref_file = save_reference(in_file, t_min, os.getcwd(), out_ext)
+        
+        # save the selected volumes only if a file is needed (e.g., for smoothing with FSL), otherwise later nodes read the volumes from the input file
+        if materialize:
+            return save_view(in_file, t_min, t_size, os.getcwd(), out_ext), 0, -1, ref_file
+        
+        return in_file, t_min, t_size, ref_file
+    
+    # set up node to select volumes based on output from splitdata Node (roi_file is the input file unless a file with the selected volumes is needed, ref_file is a 3D reference image)
+    mni_split = Node(Function(input_names=['in_file', 'dropvols', 'nVols', 't_min', 't_size', 'materialize', 'out_ext', 'misc_dir'],
+                              output_names=['roi_file', 't_min', 't_size', 'ref_file'],
+                              function=select_volumes), name='mni_split')
+    mni_split.inputs.dropvols = dropvols
+    mni_split.inputs.materialize = run_smoothing and not smooth_cache # SUSAN smoothing needs a file with the selected volumes (the cached smoothing node reads the volumes itself)
+    mni_split.inputs.out_ext = working_ext()
+    mni_split.inputs.misc_dir = op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc')
+    wf.connect(datasource, 'mni_file', mni_split, 'in_file')
+    wf.connect(datasource, 'nVols', mni_split, 'nVols')
     wf.connect(splitdata, 't_min', mni_split, 't_min')
     wf.connect(splitdata, 't_size', mni_split, 't_size')
-    if dropvols != 0: # pass file with dropped volumes if requested
-        wf.connect(roi, 'roi_file',  mni_split, 'in_file')
-    else: # otherwise pass preprocessed data file
-        wf.connect(datasource, 'mni_file', mni_split, 'in_file')
 
     # if requested, smooth before running model
-    if run_smoothing:
+    if run_smoothing and smooth_cache:
+        # define function to smooth data with SUSAN, reusing previously smoothed data from the cache (see misc/smooth_cache.py)
+        def smooth_data(in_file, mask_file, fwhm, t_min, t_size, dropvols, nVols, smooth_order, cache_dir, cache_gb, out_ext, misc_dir):
+            import os
+            import sys
+            from nibabel import load
+            sys.path.append(misc_dir)
+            from smooth_cache import smooth_run
+            from temporal_view import dropped_range
+            
+            # smooth the full run (after dropping volumes) and return the range of the selected volumes in the smoothed file, or smooth only the selected volumes
+            if smooth_order == 'full':
+                drop_min, drop_size = dropped_range(load(in_file).shape[3], dropvols, nVols)
+                smoothed_file = smooth_run(in_file, mask_file, fwhm, drop_min, drop_size, os.getcwd(), cache_dir=cache_dir, cache_gb=cache_gb, out_ext=out_ext)
+                t_min = t_min - drop_min
+            else:
+                smoothed_file = smooth_run(in_file, mask_file, fwhm, t_min, t_size, os.getcwd(), cache_dir=cache_dir, cache_gb=cache_gb, out_ext=out_ext)
+                t_min, t_size = 0, -1
+            
+            # returned as a list to match the output of the smoothing workflow
+            return [smoothed_file], t_min, t_size
+        
+        smooth = Node(Function(input_names=['in_file', 'mask_file', 'fwhm', 't_min', 't_size', 'dropvols', 'nVols', 'smooth_order', 'cache_dir', 'cache_gb', 'out_ext', 'misc_dir'],
+                               output_names=['smoothed_files', 't_min', 't_size'],
+                               function=smooth_data), name='smooth')
+        smooth.inputs.fwhm = smoothing_kernel_size
+        smooth.inputs.dropvols = dropvols
+        smooth.inputs.smooth_order = smooth_order
+        smooth.inputs.cache_dir = smooth_cache['cache_dir']
+        smooth.inputs.cache_gb = smooth_cache['cache_gb']
+        smooth.inputs.out_ext = working_ext()
+        smooth.inputs.misc_dir = op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc')
+        wf.connect(datasource, 'mni_mask', smooth, 'mask_file')
+        wf.connect(mni_split, 'roi_file', smooth, 'in_file')
+        wf.connect(mni_split, 't_min', smooth, 't_min')
+        wf.connect(mni_split, 't_size', smooth, 't_size')
+        wf.connect(datasource, 'nVols', smooth, 'nVols')
+        smooth_output = 'smoothed_files'
+    
+    elif run_smoothing:
         # create_susan_smooth refers to FSL's Susan algorithm for smoothing data
         smooth = create_susan_smooth()
         
@@ -394,10 +450,20 @@ def create_firstlevel_workflow(projDir, derivDir, workDir, outDir,
         smooth.inputs.inputnode.fwhm = smoothing_kernel_size
         wf.connect(datasource, 'mni_mask', smooth, 'inputnode.mask_file')
         wf.connect(mni_split, 'roi_file', smooth, 'inputnode.in_files')
+        smooth_output = 'outputnode.smoothed_files'
     
     # define grand mean scaling function
-    def grand_mean_scaling(functional_data, mask_file):
-        from nipype.interfaces.fsl import BinaryMaths, ImageStats
+    def grand_mean_scaling(functional_data, mask_file, median_method, t_min, t_size, out_ext, misc_dir):
+        import os
+        import os.path as op
+        import sys
+        import numpy as np
+        import nibabel as nib
+        
+        # import temporal view and parallel gzip writer functions
+        sys.path.append(misc_dir)
+        from temporal_view import load_view, iter_volume_blocks
+        from parallel_gzip import save_nifti, save_nifti_blocks
         
         print('Grand mean scaling the data')
         
@@ -405,14 +471,72 @@ def create_firstlevel_workflow(projDir, derivDir, workDir, outDir,
         if isinstance(functional_data, list):
             functional_data = functional_data[0]
         
-        # calculate global median (across time and voxels)
-        getmedian = ImageStats()
-        getmedian.inputs.in_file = functional_data
-        getmedian.inputs.mask_file = mask_file
-        getmedian.inputs.op_string = '-P 50' # median of non-zero voxels
-        #getmedian.inputs.op_string = '-M' # mean of non-zero voxels
-        calc_median = getmedian.run()
-        global_median = float(calc_median.outputs.out_stat)
+        # load mask
+        mask = np.asanyarray(nib.load(mask_file).dataobj)
+        mask = mask.reshape(mask.shape[:3]) > 0
+        
+        # scaled data are saved with a file name ending in _maths to match the previous fslmaths output, which is renamed _scaled by the datasink
+        out_file = op.join(os.getcwd(), op.basename(functional_data).split('.nii')[0] + '_maths' + out_ext)
+        
+        # calculate global median (across time and voxels) of non-zero voxels within the mask
+        # the median is selected as the value at position int(n/2) of the sorted values, as done by fslstats -P 50
+        if median_method == 'histogram':
+            # histogram selection: the selected volumes are read from the file in blocks (voxels are saved in fortran order), so only 1 block of volumes is held in memory
+            # the file is read 3 times (to count values in bins, to sort the values in the bin with the median, and to scale and save the data), so this is slower than the exact selection and only useful when a run doesn't fit in memory
+            # values are binned by the leading bits of their float32 representation (ordered so the bins follow the values), so the range of the values doesn't need to be read first
+            mask_vox = mask.ravel(order='F')
+            def bin_keys(vals):
+                bits = vals.view(np.uint32)
+                return np.where(bits >> 31, ~bits, bits | np.uint32(0x80000000)) >> 12
+            
+            n = 0
+            counts = np.zeros(2**20, dtype=np.int64)
+            for block in iter_volume_blocks(functional_data, t_min, t_size):
+                vals = block[:, mask_vox]
+                vals = vals[vals != 0]
+                counts += np.bincount(bin_keys(vals), minlength=2**20)
+                n += vals.size
+            
+            k = int(n * 0.5)
+            b = np.searchsorted(np.cumsum(counts), k, side='right')
+            below = counts[:b].sum()
+            
+            bin_vals = []
+            for block in iter_volume_blocks(functional_data, t_min, t_size):
+                vals = block[:, mask_vox]
+                vals = vals[vals != 0]
+                bin_vals.append(vals[bin_keys(vals) == b])
+            global_median = float(np.sort(np.concatenate(bin_vals))[k - below])
+            
+            print('Calculated global median: {}'.format(global_median))
+            
+            # calculate scaling factor
+            scale_factor = 10000 / global_median
+            
+            print('Scaling factor: {}'.format(scale_factor))
+            
+            # scale (run will then have a mean ~10,000) and mask each block of volumes as it is saved
+            def scaled_blocks():
+                for block in iter_volume_blocks(functional_data, t_min, t_size):
+                    block *= scale_factor
+                    block[:, ~mask_vox] = 0
+                    yield block
+            
+            header = load_view(functional_data, t_min, t_size).header.copy()
+            header.set_data_dtype(np.float32)
+            header.set_slope_inter(1, 0)
+            save_nifti_blocks(header, scaled_blocks(), out_file)
+            
+            return out_file
+        
+        # exact selection: load selected volumes (the data are read once and then scaled and masked in memory)
+        img = load_view(functional_data, t_min, t_size)
+        dat = img.get_fdata(dtype=np.float32)
+        
+        # select the median from all masked values
+        vals = dat[mask]
+        vals = vals[vals != 0]
+        global_median = float(np.partition(vals, int(vals.size * 0.5))[int(vals.size * 0.5)])
         
         print('Calculated global median: {}'.format(global_median))
         
@@ -421,32 +545,56 @@ def create_firstlevel_workflow(projDir, derivDir, workDir, outDir,
         
         print('Scaling factor: {}'.format(scale_factor))
         
-        # applying the scaling (run will then have a mean ~10,000)
-        scaled = BinaryMaths()
-        scaled.inputs.in_file = functional_data
-        scaled.inputs.operation = 'mul'
-        scaled.inputs.operand_value = scale_factor
-        scale_run = scaled.run()
+        # applying the scaling (run will then have a mean ~10,000) and mask in the same step, so only 1 output file is written
+        dat *= scale_factor
+        dat[~mask] = 0
         
-        return scale_run.outputs.out_file
+        # save scaled data
+        out_img = nib.Nifti1Image(dat, img.affine, img.header)
+        out_img.set_data_dtype(np.float32)
+        save_nifti(out_img, out_file)
+        
+        return out_file
         
     meanscaling = Node(Function(output_names=['out_file'],
                                 function=grand_mean_scaling), name='meanscaling')
+    meanscaling.inputs.median_method = median_method
+    meanscaling.inputs.misc_dir = op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc')
+    meanscaling.inputs.t_min = 0
+    meanscaling.inputs.t_size = -1
+    meanscaling.inputs.out_ext = working_ext()
     
     wf.connect(datasource, 'mni_mask', meanscaling, 'mask_file')
     # pass data to meanscaling depending on whether smoothing was requested
     if run_smoothing:
     # pass smoothed output files as functional runs to meanscaling
-        wf.connect(smooth, 'outputnode.smoothed_files', meanscaling, 'functional_data')
+        wf.connect(smooth, smooth_output, meanscaling, 'functional_data')
+        if smooth_cache: # selected volumes of the smoothed file
+            wf.connect(smooth, 't_min', meanscaling, 't_min')
+            wf.connect(smooth, 't_size', meanscaling, 't_size')
     else: 
        # pass unsmoothed output files as functional runs to meanscaling
         wf.connect(mni_split, 'roi_file', meanscaling, 'functional_data')
+        wf.connect(mni_split, 't_min', meanscaling, 't_min')
+        wf.connect(mni_split, 't_size', meanscaling, 't_size')
     
     # define model configuration function
-    def gen_model_info(stimuli, events, modulators, timecourses, confounds, regressor_names):
+    def gen_model_info(stimuli_file, events, modulators, timecourses, confounds_file, regressor_names):
         """Defines `SpecifyModel` information from BIDS events."""
+        import pandas as pd
+        from pandas.errors import EmptyDataError
         from nipype.interfaces.base import Bunch
         
+        # read stimuli and confounds saved by the splitdata node (files are empty if there are no stimuli or regressors)
+        try:
+            stimuli = pd.read_csv(stimuli_file, sep='\t', na_values='n/a')
+        except EmptyDataError:
+            stimuli = []
+        try:
+            confounds = pd.read_csv(confounds_file, sep='\t', na_values='n/a')
+        except EmptyDataError:
+            confounds = pd.DataFrame()
+        
         print('Using the following regressors in the model: {}'.format(regressor_names))
 
         # if there are stimuli/events to process (ie not timecourse regressors)
@@ -515,8 +663,8 @@ def create_firstlevel_workflow(projDir, derivDir, workDir, outDir,
     modelinfo.inputs.modulators = modulators
     modelinfo.inputs.timecourses = timecourses
     # from splitdata node add event and confound files and splithalf_id as input to modelinfo node
-    wf.connect(splitdata, 'stimuli', modelinfo, 'stimuli')
-    wf.connect(splitdata, 'confounds', modelinfo, 'confounds')
+    wf.connect(splitdata, 'stimuli_file', modelinfo, 'stimuli_file')
+    wf.connect(splitdata, 'confounds_file', modelinfo, 'confounds_file')
     wf.connect(splitdata, 'regressor_names', modelinfo, 'regressor_names')
     
     # if sparse model requested (allows model generation for sparse and sparse-clustered acquisition experiments)
@@ -596,39 +744,101 @@ def create_firstlevel_workflow(projDir, derivDir, workDir, outDir,
     contrastgen.inputs.projDir = projDir
     contrastgen.inputs.task = task
     contrastgen.inputs.contrast_opts = contrast_opts
-
-    # provide first-level design parameters
-    level1design = Node(fsl.Level1Design(), name='level1design')
-    level1design.inputs.interscan_interval = TR
-    level1design.inputs.bases = {'dgamma': {'derivs': False}}
-    level1design.inputs.model_serial_correlations = True
-    wf.connect(modelspec, 'session_info', level1design, 'session_info')
-    if contrast_opts != 'no': # pass contrasts if requested in config file
-        wf.connect(contrastgen, 'contrasts', level1design, 'contrasts')
-
-    # use FSL FEAT for GLM
-    modelgen = Node(fsl.FEATModel(), name='modelgen')
-    wf.connect(level1design, 'fsf_files', modelgen, 'fsf_file')
-    wf.connect(level1design, 'ev_files', modelgen, 'ev_files')
-
-    # MapNode is a special version of Node that will create an instance of the Node [here ApplyMask()] for every item in the list from the input
-    # interfield defines which input should be iterated over
-    # after running, the outputs are collected into a list to pass to the next Node
-    masker = MapNode(fsl.ApplyMask(), name='masker', iterfield=['in_file'])
-    wf.connect(datasource, 'mni_mask', masker, 'mask_file')
-    
-    # pass scaled data to masker                     
-    wf.connect(meanscaling, 'out_file', masker, 'in_file')
-    
-    # configure GLM over design matrics
-    glm = MapNode(fsl.FILMGLS(), name='filmgls', iterfield=['in_file'])
-    if run_smoothing: 
-        glm.inputs.mask_size = smoothing_kernel_size
-        glm.inputs.smooth_autocorr = True
-    wf.connect(masker, 'out_file', glm, 'in_file')
-    wf.connect(modelgen, 'design_file', glm, 'design_file')
-    wf.connect(modelgen, 'con_file', glm, 'tcon_file')
-    wf.connect(modelgen, 'fcon_file', glm, 'fcon_file')
+    
+    # build design using FSL Level1Design and FEATModel (default) or the native python design builder (if requested in config file; not available for sparse models)
+    native_design = (design_engine == 'native') and not sparse
+    if design_engine == 'native' and sparse:
+        print('WARNING: the native design builder does not support sparse models, so design matrices will be built using FSL Level1Design and FEATModel')
+    if native_design:
+        print('Design matrices will be built using the native python design builder')
+        
+        # define function to build design matrix and contrast files in python
+        def build_native_design(session_info, functional_runs, contrasts, TR, cache_dir, misc_dir):
+            import os
+            import sys
+            from nibabel import load
+            sys.path.append(misc_dir)
+            from design_builder import build_design
+            
+            # number of volumes in the run
+            func_file = functional_runs[0] if isinstance(functional_runs, list) else functional_runs
+            nVols = load(func_file).shape[3]
+            
+            design_file, con_file, pe_names = build_design(session_info[0], nVols, TR, contrasts, os.getcwd(), cache_dir=cache_dir)
+            
+            return design_file, con_file, pe_names
+        
+        # convolved task regressors are cached in the working directory and shared across runs and subjects
+        modelgen = Node(Function(input_names=['session_info', 'functional_runs', 'contrasts', 'TR', 'cache_dir', 'misc_dir'],
+                                 output_names=['design_file', 'con_file', 'pe_names'],
+                                 function=build_native_design),
+                        name='modelgen')
+        modelgen.inputs.TR = TR
+        modelgen.inputs.cache_dir = op.join(workDir, 'design_cache')
+        modelgen.inputs.misc_dir = op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc')
+        wf.connect(modelspec, 'session_info', modelgen, 'session_info')
+        wf.connect(meanscaling, 'out_file', modelgen, 'functional_runs')
+        wf.connect(contrastgen, 'contrasts', modelgen, 'contrasts')
+    
+    else:
+        # provide first-level design parameters
+        level1design = Node(fsl.Level1Design(), name='level1design')
+        level1design.inputs.interscan_interval = TR
+        level1design.inputs.bases = {'dgamma': {'derivs': False}}
+        level1design.inputs.model_serial_correlations = True
+        wf.connect(modelspec, 'session_info', level1design, 'session_info')
+        if contrast_opts != 'no': # pass contrasts if requested in config file
+            wf.connect(contrastgen, 'contrasts', level1design, 'contrasts')
+    
+        # use FSL FEAT for GLM
+        modelgen = Node(fsl.FEATModel(), name='modelgen')
+        wf.connect(level1design, 'fsf_files', modelgen, 'fsf_file')
+        wf.connect(level1design, 'ev_files', modelgen, 'ev_files')
+    
+    # fit GLM using FSL FILMGLS (default) or the native python GLM (if requested in config file)
+    if glm_engine == 'native':
+        print('GLM will be fit using the native python GLM with {} thread(s)'.format(glm_threads))
+        
+        # define function to fit the GLM in python
+        def native_glm(in_file, mask_file, design_file, tcon_file, smooth_autocorr, fwhm, n_threads, out_ext, misc_dir):
+            import os
+            import sys
+            sys.path.append(misc_dir)
+            from native_glm import run_glm
+            
+            outputs = run_glm(in_file, design_file, tcon_file, os.getcwd(), mask_file=mask_file, smooth_autocorr=smooth_autocorr, fwhm=fwhm, n_threads=n_threads, out_ext=out_ext)
+            
+            return outputs['copes'], outputs['varcopes'], outputs['zstats'], outputs['tstats'], outputs['param_estimates'], outputs['sigmasquareds'], outputs['residual4d'], outputs['dof_file'], outputs['thresholdac'], outputs['logfile']
+        
+        # MapNode named filmgls so outputs are saved to the same locations as the FILMGLS outputs
+        glm = MapNode(Function(input_names=['in_file', 'mask_file', 'design_file', 'tcon_file', 'smooth_autocorr', 'fwhm', 'n_threads', 'out_ext', 'misc_dir'],
+                               output_names=['copes', 'varcopes', 'zstats', 'tstats', 'param_estimates', 'sigmasquareds', 'residual4d', 'dof_file', 'thresholdac', 'logfile'],
+                               function=native_glm),
+                      name='filmgls', iterfield=['in_file'], n_procs=glm_threads)
+        glm.inputs.smooth_autocorr = run_smoothing
+        glm.inputs.fwhm = smoothing_kernel_size
+        glm.inputs.n_threads = glm_threads
+        glm.inputs.out_ext = working_ext()
+        glm.inputs.misc_dir = op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc')
+        wf.connect(meanscaling, 'out_file', glm, 'in_file')
+        wf.connect(datasource, 'mni_mask', glm, 'mask_file')
+        wf.connect(modelgen, 'design_file', glm, 'design_file')
+        wf.connect(modelgen, 'con_file', glm, 'tcon_file')
+    
+    else:
+        # configure GLM over design matrics (the scaled data are already masked by the meanscaling node)
+        # MapNode is a special version of Node that will create an instance of the Node [here FILMGLS()] for every item in the list from the input
+        # interfield defines which input should be iterated over
+        # after running, the outputs are collected into a list to pass to the next Node
+        glm = MapNode(fsl.FILMGLS(), name='filmgls', iterfield=['in_file'])
+        if run_smoothing: 
+            glm.inputs.mask_size = smoothing_kernel_size
+            glm.inputs.smooth_autocorr = True
+        wf.connect(meanscaling, 'out_file', glm, 'in_file')
+        wf.connect(modelgen, 'design_file', glm, 'design_file')
+        wf.connect(modelgen, 'con_file', glm, 'tcon_file')
+        if not native_design:
+            wf.connect(modelgen, 'fcon_file', glm, 'fcon_file')
 
     # rename contrast output files with better filenames
     def substitutes(contrasts):
@@ -669,12 +879,14 @@ def create_firstlevel_workflow(projDir, derivDir, workDir, outDir,
         
         return out_file
 
-    parameter_mapping = Node(Function(function=save_parameter_names,
-                            input_names=['fsf_file'],
-                            output_names=['out_file']),
-                   name='parameter_mapping')
-                   
-    wf.connect(level1design, 'fsf_files', parameter_mapping, 'fsf_file')
+    # parameter names are saved by the native design builder
+    if not native_design:
+        parameter_mapping = Node(Function(function=save_parameter_names,
+                                input_names=['fsf_file'],
+                                output_names=['out_file']),
+                       name='parameter_mapping')
+                       
+        wf.connect(level1design, 'fsf_files', parameter_mapping, 'fsf_file')
     
     # extract components from working directory cache and store it at a different location
     sinker = Node(DataSink(), name='datasink')
@@ -693,16 +905,20 @@ def create_firstlevel_workflow(projDir, derivDir, workDir, outDir,
     # define where output files are saved
     wf.connect(meanscaling, 'out_file', sinker, 'preproc.@scaled_data') # output scaled data for psc calculation
     wf.connect(gensubs, 'out', sinker, 'substitutions')
-    wf.connect(mni_split, 'roi_file', sinker, 'preproc.@roi_file')
-    if run_smoothing:
-        wf.connect(smooth, 'outputnode.smoothed_files', sinker, 'preproc.@')
+    wf.connect(mni_split, 'ref_file', sinker, 'preproc.@roi_file') # 3D reference image (later scripts read the image dimensions and affine from this file)
+    # the smoothed data are saved so they can be reused through the smoothDir, unless the full run was smoothed before splitting it into halves (the smoothed file then includes the volumes of both halves, and is reused through the smoothing cache instead)
+    if run_smoothing and (smooth_order != 'full' or 0 in splithalves):
+        wf.connect(smooth, smooth_output, sinker, 'preproc.@')
     wf.connect(modelgen, 'design_file', sinker, 'design.@design_file')
     wf.connect(modelgen, 'con_file', sinker, 'design.@tcon_file')
-    wf.connect(modelgen, 'design_cov', sinker, 'design.@cov')
-    wf.connect(modelgen, 'design_image', sinker, 'design.@design')
-    wf.connect(level1design, 'fsf_files', sinker, 'design.@fsf')
-    wf.connect(level1design, 'ev_files', sinker, 'design.@ev')
-    wf.connect(parameter_mapping, 'out_file', sinker, 'model.@pe_names')
+    if native_design:
+        wf.connect(modelgen, 'pe_names', sinker, 'model.@pe_names')
+    else:
+        wf.connect(modelgen, 'design_cov', sinker, 'design.@cov')
+        wf.connect(modelgen, 'design_image', sinker, 'design.@design')
+        wf.connect(level1design, 'fsf_files', sinker, 'design.@fsf')
+        wf.connect(level1design, 'ev_files', sinker, 'design.@ev')
+        wf.connect(parameter_mapping, 'out_file', sinker, 'model.@pe_names')
     wf.connect(glm, 'copes', sinker, 'model.@copes')
     wf.connect(glm, 'dof_file', sinker, 'model.@dof')
     wf.connect(glm, 'logfile', sinker, 'model.@log')
@@ -718,7 +934,7 @@ def create_firstlevel_workflow(projDir, derivDir, workDir, outDir,
 # define function to extract subject-level data for workflow
 def process_subject(TR, projDir, derivDir, outDir, workDir, 
                     sub, task, ses, ignore_motion, multiecho, sub_runs, events, modulators, contrast_opts, timecourses,
-                    regressor_opts, smoothing_kernel_size, smoothDir, hpf, dropvols, splithalf, space_name, sparse):
+                    regressor_opts, smoothing_kernel_size, smoothDir, hpf, dropvols, splithalf, space_name, sparse, glm_engine='fsl', glm_threads=1, design_engine='fsl', median_method='exact', smooth_cache=None, smooth_order='split', incremental=False):
     """Grab information and start nipype workflow
     We want to parallelize runs for greater efficiency
     """
@@ -727,34 +943,19 @@ def process_subject(TR, projDir, derivDir, outDir, workDir,
     # define subject output directory
     subDir = op.join(outDir, '{}'.format(sub))
     
-    # identify scan and events files
+    # identify events files
     if ses != 'no': # if session was provided
         print('Session information provided. Assuming data are organized into session folders.')
         
-        # identify scans file (from derivDir bc artifact information is saved in the processed scans.tsv file)
-        scans_tsv = glob.glob(op.join(derivDir, '{}'.format(sub), 'ses-{}'.format(ses), 'func', '*_scans.tsv'))[0]
-        
         # identify events file
         events_all = glob.glob(op.join(derivDir, '{}'.format(sub), 'ses-{}'.format(ses), 'func', '{}_ses-{}_task-{}*_events.tsv'.format(sub, ses, task)))
        
     else: # if session was 'no'
-        # identify scans file (from derivDir bc artifact information is saved in the processed scans.tsv file)
-        scans_tsv = glob.glob(op.join(derivDir, '{}'.format(sub), 'func', '*_scans.tsv'))[0]
-        
         # identify events file
         events_all = glob.glob(op.join(derivDir, '{}'.format(sub), 'func', '{}_task-{}*_events.tsv'.format(sub, task)))
 
-    # return error if scan file not found
-    if not os.path.isfile(scans_tsv):
-        raise IOError('scans file {} not found.'.format(scans_tsv))
-        
-    # read in scans file
-    scans_df = pd.read_csv(scans_tsv, sep='\t')
-
-    # extract task and run information from filenames in scans.tsv file
-    scans_df['task'] = scans_df['filename'].str.split('task-', expand=True).loc[:,1]
-    scans_df['task'] = scans_df['task'].str.split('_', expand=True)[0]
-    scans_df['run'] = scans_df['filename'].apply(lambda x: x.split('run-')[1].split('_')[0] if 'run-' in x else None)
+    # read run information (from the QC ledger saved by mark_motion_exclusions.py, or from the subject's scans.tsv file if the subject isn't in the ledger)
+    scans_df = subject_scans(derivDir, sub, ses)
     
     # remove runs tagged with excessive motion if requested
     if ignore_motion == 'no':
@@ -822,14 +1023,14 @@ def process_subject(TR, projDir, derivDir, outDir, workDir,
     if not events_files:
         raise FileNotFoundError('No event files found for {}'.format(sub))
     
-    # delete prior processing directories because cache files can interfere with workflow
+    # delete prior processing directories because cache files can interfere with workflow (unless incremental is yes in the config file, in which case nodes whose inputs haven't changed reuse their previous outputs)
     subworkDir = op.join(workDir, '{}_task-{}_levelone'.format(sub, task))
-    if os.path.exists(subworkDir):
+    if os.path.exists(subworkDir) and not incremental:
         shutil.rmtree(subworkDir)
  
     # call firstlevel workflow with extracted subject-level data
     wf = create_firstlevel_workflow(projDir, derivDir, workDir, subDir, 
-                                    sub, task, ses, multiecho, keepruns, events_files, events, modulators, contrast_opts, timecourses, regressor_opts, smoothing_kernel_size, smoothDir, hpf, TR, dropvols, splithalves, space_name, sparse)                                    
+                                    sub, task, ses, multiecho, keepruns, events_files, events, modulators, contrast_opts, timecourses, regressor_opts, smoothing_kernel_size, smoothDir, hpf, TR, dropvols, splithalves, space_name, sparse, glm_engine, glm_threads, design_engine, median_method, smooth_cache, smooth_order)                                    
     return wf
 
 # define command line parser function
@@ -886,13 +1087,40 @@ def main(argv=None):
     smoothing_kernel_size=int(config_file.loc['smoothing',1])
     hpf=int(config_file.loc['hpf',1])
     contrast_opts=config_file.loc['contrast',1].replace(' ','').split(',')
-    events=list(set(config_file.loc['events',1].replace(' ','').replace(',','-').split('-')))
+    events=sorted(set(config_file.loc['events',1].replace(' ','').replace(',','-').split('-')))
     modulators=config_file.loc['modulators',1]
     timecourses=config_file.loc['timecourses',1].replace(' ', '').split(',')
     regressor_opts=config_file.loc['regressors',1].replace(' ','').split(',')
     splithalf=config_file.loc['splithalf',1]
     space=config_file.loc['space',1]
     overwrite=config_file.loc['overwrite',1]
+    
+    # method used to calculate the global median for grand mean scaling (exact by default, or histogram to read and save the data in blocks so the run is never held in memory, which is slower because the file is read 3 times)
+    median_method = 'exact'
+    if 'scaling_median' in config_file.index and config_file.loc['scaling_median',1] is not None:
+        median_method = config_file.loc['scaling_median',1]
+    
+    # directory and size limit of the smoothed data cache (smoothed data are not cached by default)
+    smooth_cache = read_cache_settings(config_file)
+    
+    # order of smoothing and splitting runs into halves: split (split runs then smooth each half, default) or full (smooth the full run once, then split)
+    smooth_order = 'split'
+    if 'smooth_order' in config_file.index and config_file.loc['smooth_order',1] is not None:
+        smooth_order = config_file.loc['smooth_order',1]
+    
+    # design engine (fsl by default)
+    design_engine = 'fsl'
+    if 'design_engine' in config_file.index and config_file.loc['design_engine',1] is not None:
+        design_engine = config_file.loc['design_engine',1]
+    
+    # GLM engine (fsl by default) and number of threads used by the native GLM
+    glm_engine = 'fsl'
+    if 'glm_engine' in config_file.index and config_file.loc['glm_engine',1] is not None:
+        glm_engine = config_file.loc['glm_engine',1]
+    
+    glm_threads = 1
+    if 'glm_threads' in config_file.index and config_file.loc['glm_threads',1] is not None:
+        glm_threads = int(config_file.loc['glm_threads',1])
 
     # print if BIDS directory is not found
     if not op.exists(bidsDir):
@@ -967,7 +1195,11 @@ def main(argv=None):
     # define subjects - if none are provided in the script call, they are extracted from the BIDS directory layout information
     subjects = args.subjects if args.subjects else layout.get_subjects()
 
+    # read nipype plugin settings (number of processes, memory, and node resource estimates) from config file
+    plugin_settings = read_plugin_settings(config_file, args.plugin)
+    
     # for each subject in the list of subjects
+    workflows = []
     for index, sub in enumerate(subjects):
         # check that run info was provided in subject list, otherwise throw an error
         if not args.runs:
@@ -984,17 +1216,16 @@ def main(argv=None):
         # create a process_subject workflow with the inputs defined above
         wf = process_subject(TR, args.projDir, derivDir, outDir, workDir, 
                              sub, task, ses, ignore_motion, multiecho, sub_runs, events, modulators, contrast_opts, timecourses,
-                             regressor_opts, smoothing_kernel_size, smoothDir, hpf, dropvols, splithalf, space_name, args.sparse)
+                             regressor_opts, smoothing_kernel_size, smoothDir, hpf, dropvols, splithalf, space_name, args.sparse, glm_engine, glm_threads, design_engine, median_method, smooth_cache, smooth_order, plugin_settings['incremental'] == 'yes')
    
         # configure workflow options
         wf.config['execution'] = {'crashfile_format': 'txt',
                                   'remove_unnecessary_outputs': False,
                                   'keep_inputs': True}
-
-        # run multiproc unless plugin specified in script call
-        plugin = args.plugin if args.plugin else 'MultiProc'
-        args_dict = {'n_procs' : 4}
-        wf.run(plugin=plugin, plugin_args = args_dict)
+        workflows.append(wf)
+    
+    # run workflows (multiproc unless plugin specified in script call)
+    run_workflows(workflows, workDir, plugin_settings)
 
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':
@@ -10,9 +10,9 @@ Nesting of functions: main > argparser > process_subject > create_timecourse_wor
 Requirement: BIDS dataset (including events.tsv), derivatives directory with fMRIPrep outputs, and modeling files
 
 """
-from nipype.interfaces import fsl
 from nipype import Workflow, Node, IdentityInterface, Function, DataSink, JoinNode, MapNode
 import nilearn
+import sys
 import os
 import os.path as op
 import numpy as np
@@ -20,13 +20,19 @@ import argparse
 from bids.layout import BIDSLayout
 from niflow.nipype1.workflows.fmri.fsl import create_susan_smooth
 import pandas as pd
-import glob
 import shutil
 from datetime import datetime
 
+# add misc folder to path to import shared workflow scheduler functions
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from workflow_scheduler import read_plugin_settings, run_workflows
+from storage_policy import working_ext
+from smooth_cache import read_cache_settings
+from qc_ledger import subject_scans
+
 # define first level workflow function
 def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, subDir, 
-                               sub, task, ses, multiecho, runs, regressor_opts, mask_opts, smoothing_kernel_size, resultsDir, smoothDir, froiDir, hpf, filter_opt, TR, detrend,standardize, template, extract_opt, dropvols, splithalves, space_name, top_nvox, percent,
+                               sub, task, ses, multiecho, runs, regressor_opts, mask_opts, smoothing_kernel_size, resultsDir, smoothDir, froiDir, hpf, filter_opt, TR, detrend,standardize, template, extract_opt, dropvols, splithalves, space_name, top_nvox, percent, smooth_cache=None, smooth_order='split',
                                name='{}_task-{}_timecourses'):
     """Processing pipeline"""
 
@@ -294,11 +300,9 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
     datasource.inputs.top_nvox = top_nvox
     datasource.inputs.percent = percent
 
-    # if drop volumes requested
+    # report dropped volumes (the volumes are dropped by the mni_split node, along with any split halves, so no extra copy of the data is made)
     if dropvols != 0:
         print('Dropping {} volumes from the beginning of the functional run.'.format(dropvols))
-        roi = Node(fsl.ExtractROI(t_min=dropvols, t_size=-1), name='extractroi')
-        wf.connect(datasource, 'mni_file', roi, 'in_file')
 
     # define function to process data into halves for analysis (if requested in config file)
     def process_data_files(sub, mni_file, art_file, confound_file, regressor_opts, task, run_id, splithalf_id, TR, nVols, dropvols, subDir):
@@ -428,8 +432,8 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
             vol_indx = vol_indx[vol_indx > max(droppedVols)] # select included volumes from second half
             vol_indx = vol_indx-max(droppedVols+1) # volume ids relative to start of run
 
-        # get number of volumes in current run
-        curVols = load(mni_file).shape[3]
+        # get number of volumes in current run after dropping volumes (read from the file header, so the data are not loaded)
+        curVols = load(mni_file).shape[3] - max(dropvols, 0)
  
         # process full timeseries if the current run is already split data
         if curVols < nVols:
@@ -464,22 +468,89 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
     splitdata.inputs.sub = sub
     splitdata.inputs.task = task
     splitdata.inputs.regressor_opts = regressor_opts
-    if dropvols != 0: # pass file with dropped volumes if requested
-        wf.connect(roi, 'roi_file', splitdata, 'mni_file')
-    else: # otherwise pass preprocessed data file
-        wf.connect(datasource, 'mni_file', splitdata, 'mni_file')
+    wf.connect(datasource, 'mni_file', splitdata, 'mni_file')
+        
+    # when smoothing the full run before splitting, the smoothed runs are shared through a cache in the working directory if no cache directory was specified
+    if run_smoothing and smooth_order == 'full' and not smooth_cache:
+        smooth_cache = {'cache_dir': op.join(workDir, 'smooth_cache'), 'cache_gb': 100}
+    
+    # define function to select the volumes to analyse (dropped volumes and split halves are combined into a single range of the preprocessed data file)
+    def select_volumes(in_file, dropvols, nVols, t_min, t_size, materialize, out_ext, misc_dir):
+        import os
+        import sys
+        from nibabel import load
+        
+        # import temporal view functions
+        sys.path.append(misc_dir)
+        from temporal_view import view_range, save_view, save_reference
         
-    # set up extractROI node to segment runs based on output from splitdata Node (output is called 'roi_file')
-    mni_split = Node(fsl.ExtractROI(), name='mni_split')
+        # combine dropped volumes and split half volumes (number of volumes is read from the file header)
+        t_min, t_size = view_range(load(in_file).shape[3], max(dropvols, 0), nVols, t_min, t_size)
+        print('Selected volumes {} to {} of {}'.format(t_min, t_min + t_size - 1, in_file))
+        
+        # save the first selected volume as a reference image for later scripts
+        ref_file = save_reference(in_file, t_min, os.getcwd(), out_ext)
+        
+        # save the selected volumes only if a file is needed (e.g., for smoothing with FSL), otherwise later nodes read the volumes from the input file
+        if materialize:
+            return save_view(in_file, t_min, t_size, os.getcwd(), out_ext), 0, -1, ref_file
+        
+        return in_file, t_min, t_size, ref_file
+    
+    # set up node to select volumes based on output from splitdata Node (roi_file is the input file unless a file with the selected volumes is needed, ref_file is a 3D reference image)
+    mni_split = Node(Function(input_names=['in_file', 'dropvols', 'nVols', 't_min', 't_size', 'materialize', 'out_ext', 'misc_dir'],
+                              output_names=['roi_file', 't_min', 't_size', 'ref_file'],
+                              function=select_volumes), name='mni_split')
+    mni_split.inputs.dropvols = dropvols
+    mni_split.inputs.materialize = run_smoothing and not smooth_cache # SUSAN smoothing needs a file with the selected volumes (the cached smoothing node reads the volumes itself)
+    mni_split.inputs.out_ext = working_ext()
+    mni_split.inputs.misc_dir = op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc')
+    wf.connect(datasource, 'mni_file', mni_split, 'in_file')
+    wf.connect(datasource, 'nVols', mni_split, 'nVols')
     wf.connect(splitdata, 't_min', mni_split, 't_min')
     wf.connect(splitdata, 't_size', mni_split, 't_size')
-    if dropvols != 0: # pass file with dropped volumes if requested
-        wf.connect(roi, 'roi_file',  mni_split, 'in_file')
-    else: # otherwise pass preprocessed data file
-        wf.connect(datasource, 'mni_file', mni_split, 'in_file')
 
     # if requested, smooth before running model
-    if run_smoothing:
+    if run_smoothing and smooth_cache:
+        # define function to smooth data with SUSAN, reusing previously smoothed data from the cache (see misc/smooth_cache.py)
+        def smooth_data(in_file, mask_file, fwhm, t_min, t_size, dropvols, nVols, smooth_order, cache_dir, cache_gb, out_ext, misc_dir):
+            import os
+            import sys
+            from nibabel import load
+            sys.path.append(misc_dir)
+            from smooth_cache import smooth_run
+            from temporal_view import dropped_range
+            
+            # smooth the full run (after dropping volumes) and return the range of the selected volumes in the smoothed file, or smooth only the selected volumes
+            if smooth_order == 'full':
+                drop_min, drop_size = dropped_range(load(in_file).shape[3], dropvols, nVols)
+                smoothed_file = smooth_run(in_file, mask_file, fwhm, drop_min, drop_size, os.getcwd(), cache_dir=cache_dir, cache_gb=cache_gb, out_ext=out_ext)
+                t_min = t_min - drop_min
+            else:
+                smoothed_file = smooth_run(in_file, mask_file, fwhm, t_min, t_size, os.getcwd(), cache_dir=cache_dir, cache_gb=cache_gb, out_ext=out_ext)
+                t_min, t_size = 0, -1
+            
+            # returned as a list to match the output of the smoothing workflow
+            return [smoothed_file], t_min, t_size
+        
+        smooth = Node(Function(input_names=['in_file', 'mask_file', 'fwhm', 't_min', 't_size', 'dropvols', 'nVols', 'smooth_order', 'cache_dir', 'cache_gb', 'out_ext', 'misc_dir'],
+                               output_names=['smoothed_files', 't_min', 't_size'],
+                               function=smooth_data), name='smooth')
+        smooth.inputs.fwhm = smoothing_kernel_size
+        smooth.inputs.dropvols = max(dropvols, 0)
+        smooth.inputs.smooth_order = smooth_order
+        smooth.inputs.cache_dir = smooth_cache['cache_dir']
+        smooth.inputs.cache_gb = smooth_cache['cache_gb']
+        smooth.inputs.out_ext = working_ext()
+        smooth.inputs.misc_dir = op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc')
+        wf.connect(datasource, 'mni_mask', smooth, 'mask_file')
+        wf.connect(mni_split, 'roi_file', smooth, 'in_file')
+        wf.connect(mni_split, 't_min', smooth, 't_min')
+        wf.connect(mni_split, 't_size', smooth, 't_size')
+        wf.connect(datasource, 'nVols', smooth, 'nVols')
+        smooth_output = 'smoothed_files'
+    
+    elif run_smoothing:
         # create_susan_smooth refers to FSL's Susan algorithm for smoothing data
         smooth = create_susan_smooth()
         
@@ -492,9 +563,10 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
         smooth.inputs.inputnode.fwhm = smoothing_kernel_size
         wf.connect(datasource, 'mni_mask', smooth, 'inputnode.mask_file')
         wf.connect(mni_split, 'roi_file', smooth, 'inputnode.in_files')
+        smooth_output = 'outputnode.smoothed_files'
 
     # define function to denoise data
-    def denoise_data(imgs, mni_mask, motion_params, vol_indx, outliers, TR, hpf, filter_opt, detrend, standardize,  subDir, sub, run_id, splithalf_id, task):
+    def denoise_data(imgs, mni_mask, motion_params, vol_indx, outliers, TR, hpf, filter_opt, detrend, standardize,  subDir, sub, run_id, splithalf_id, task, t_min, t_size, misc_dir):
         import nibabel as nib
         from nibabel import load
         import nilearn
@@ -503,6 +575,12 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
         import numpy as np
         import os
         import os.path as op
+        import sys
+        
+        # import temporal view and parallel gzip writer functions
+        sys.path.append(misc_dir)
+        from temporal_view import load_view
+        from parallel_gzip import save_nifti
         
         # define run name depending on whether run info is in file name
         if run_id != 0:
@@ -535,6 +613,9 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
         if isinstance(imgs, list):
             imgs=imgs[0]        
         
+        # load the selected volumes (only these volumes are read from the file)
+        imgs = load_view(imgs, t_min, t_size)
+        
         # process options from config file
         if detrend == 'yes':
             detrend_opt = True
@@ -566,44 +647,30 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
         # process signal data with parameters specified in config file
         denoised_data = image.clean_img(imgs, mask_img=mni_mask, confounds=motion_params, detrend=detrend_opt, standardize=standardize_opt, **kwargs_opts)
         
-        # save denoised data
-        nib.save(denoised_data, denoise_file)
-        
-        # load denoised data and extract dimension info
-        denoise_img = image.load_img(denoised_data)
-        img_dim = denoise_img.shape
-        
-        # load input data and extract volume info
-        input_img = image.load_img(imgs)
-        curVols = input_img.shape[3]
-        
-        # create vector of volumes for indexing
-        all_vols_vec = np.arange(curVols, dtype=np.int64)
-        
-        # create nan volume
-        nan_vol = np.empty((img_dim[:-1]))
-        nan_vol[:] = np.nan
-        nan_img = image.new_img_like(denoise_img, nan_vol, affine=denoise_img.affine)
+        # save denoised data (compressed using multiple threads)
+        save_nifti(denoised_data, denoise_file)
+
+        # extract volume info from the input header (avoids loading the input data array)
+        curVols = imgs.shape[3]
+
+        # boolean vector of retained volumes (True where the volume was kept by clean_img)
+        keep_vols = np.zeros(curVols, dtype=bool)
+        keep_vols[np.asarray(vol_indx, dtype=np.int64)] = True
 
         # pad denoised data with nan vols where vols were scrubbed
-        d=0 # index for denoised data which has a volume for index in vol_indx [curVols - outliers]
-        pad_imgs = list()
-        for vol in all_vols_vec: # for each volume
-            if vol in vol_indx:
-                tmp_vol = image.index_img(denoise_img, d)
-                pad_imgs.append(tmp_vol)
-                d += 1
-            else:
-                tmp_vol = nan_img
-                pad_imgs.append(tmp_vol)
-        
-        # concatente list of 3D imgs to one 4D img
-        pad_concat = image.concat_imgs(pad_imgs)
-       
-        # save padded data
-        nib.save(pad_concat, pad_file)
-        
-        return denoised_data, pad_concat
+        # the cleaned samples are written into one preallocated nan array in a single assignment (denoised data has one volume per retained index, in order)
+        denoised_arr = np.asanyarray(denoised_data.dataobj)
+        pad_arr = np.full(denoised_arr.shape[:3] + (curVols,), np.nan, dtype=np.float32)
+        pad_arr[..., keep_vols] = denoised_arr
+        del denoised_arr
+
+        # save padded data using the denoised header (no intermediate 3D images are created)
+        pad_img = nib.Nifti1Image(pad_arr, denoised_data.affine, denoised_data.header)
+        pad_img.set_data_dtype(np.float32)
+        save_nifti(pad_img, pad_file)
+
+        # return file paths rather than images so the arrays are not pickled into the node results
+        return denoise_file, pad_file
     
     # process signal, passing generated confounds
     cleansignal = Node(Function(output_names=['denoised_data',
@@ -624,14 +691,22 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
     cleansignal.inputs.standardize = standardize
     cleansignal.inputs.filter_opt = filter_opt
     cleansignal.inputs.subDir = subDir
+    cleansignal.inputs.misc_dir = op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc')
+    cleansignal.inputs.t_min = 0
+    cleansignal.inputs.t_size = -1
     
     # pass data to cleansignal depending on whether smoothing was requested
     if run_smoothing:
         # pass smoothed output files as functional runs to denoise function
-        wf.connect(smooth, 'outputnode.smoothed_files', cleansignal, 'imgs')
+        wf.connect(smooth, smooth_output, cleansignal, 'imgs')
+        if smooth_cache: # selected volumes of the smoothed file
+            wf.connect(smooth, 't_min', cleansignal, 't_min')
+            wf.connect(smooth, 't_size', cleansignal, 't_size')
     else: 
        # pass unsmoothed output files as functional runs to modelspec
         wf.connect(mni_split, 'roi_file', cleansignal, 'imgs')
+        wf.connect(mni_split, 't_min', cleansignal, 't_min')
+        wf.connect(mni_split, 't_size', cleansignal, 't_size')
     
     def extract_timecourse(denoised_data, pad_concat, roi_masks, mask_opts, extract_opt, outDir, subDir, sub, run_id, splithalf_id, task, nVols, vol_indx):
         import nibabel as nib
@@ -667,8 +742,8 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
             mask_bin[mask_bin >= 1] = 1 # for values equal to or greater than 1, make 1 (values less than 1 are already 0)
             mask_bin = image.new_img_like(mask_img, mask_bin) # create a new image of the same class as the initial image
             
-            # the masks should already be resampled, but check if this is true and resample if not
-            if denoised_data.shape[0:3] != mask_bin.shape[0:3]:
+            # the masks should already be resampled, but check if this is true and resample if not (shape is read from the denoised file header)
+            if nib.load(denoised_data).shape[0:3] != mask_bin.shape[0:3]:
                 print('WARNING: the mask provided has different dimensions than the functional data!')
                 
                 # make directory to save resampled rois
@@ -760,44 +835,28 @@ def create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, su
                                           ('_roi','')]          
     
     # define where output files are saved
-    wf.connect(mni_split, 'roi_file', sinker, 'preproc.@roi_file')
-    if run_smoothing:
-        wf.connect(smooth, 'outputnode.smoothed_files', sinker, 'preproc.@')  
+    wf.connect(mni_split, 'ref_file', sinker, 'preproc.@roi_file') # 3D reference image (later scripts read the image dimensions and affine from this file)
+    # the smoothed data are saved so they can be reused through the smoothDir, unless the full run was smoothed before splitting it into halves (the smoothed file then includes the volumes of both halves, and is reused through the smoothing cache instead)
+    if run_smoothing and (smooth_order != 'full' or 0 in splithalves):
+        wf.connect(smooth, smooth_output, sinker, 'preproc.@')  
         
     return wf
 
 # define function to extract subject-level data for workflow
 def process_subject(TR, sharedDir, projDir, derivDir, outDir, workDir, 
-                    sub, task, ses, ignore_motion, multiecho, sub_runs, regressor_opts, mask_opts, smoothing_kernel_size,resultsDir,smoothDir, froiDir, hpf, filter_opt, detrend, standardize, template, extract_opt, dropvols, splithalf, space_name, top_nvox, percent):    
+                    sub, task, ses, ignore_motion, multiecho, sub_runs, regressor_opts, mask_opts, smoothing_kernel_size,resultsDir,smoothDir, froiDir, hpf, filter_opt, detrend, standardize, template, extract_opt, dropvols, splithalf, space_name, top_nvox, percent, smooth_cache=None, smooth_order='split'):    
     """Grab information and start nipype workflow
     We want to parallelize runs for greater efficiency
     """
     # define subject output directory
     subDir = op.join(outDir, '{}'.format(sub))
     
-    # identify scan and events files
     if ses != 'no': # if session was provided
         print('Session information provided. Assuming data are organized into session folders.')
         
-        # identify scans file (from derivDir bc artifact information is saved in the processed scans.tsv file)
-        scans_tsv = glob.glob(op.join(derivDir, '{}'.format(sub), 'ses-{}'.format(ses), 'func', '*_scans.tsv'))[0]
-        
-    else: # if session was 'no'
-        # identify scans file (from derivDir bc artifact information is saved in the processed scans.tsv file)
-        scans_tsv = glob.glob(op.join(derivDir, '{}'.format(sub), 'func', '*_scans.tsv'))[0]
-        
-    # return error if scan file not found
-    if not os.path.isfile(scans_tsv):
-        raise IOError('scans file {} not found.'.format(scans_tsv))
-
-    # read in scans file
-    scans_df = pd.read_csv(scans_tsv, sep='\t')
-
-    # extract task and run information from filenames in scans.tsv file
-    scans_df['task'] = scans_df['filename'].str.split('task-', expand=True).loc[:,1]
-    scans_df['task'] = scans_df['task'].str.split('_', expand=True)[0]
-    scans_df['run'] = scans_df['filename'].apply(lambda x: x.split('run-')[1].split('_')[0] if 'run-' in x else None)
-
+    # read run information (from the QC ledger saved by mark_motion_exclusions.py, or from the subject's scans.tsv file if the subject isn't in the ledger)
+    scans_df = subject_scans(derivDir, sub, ses)
+    
     # remove runs tagged with excessive motion if requested
     if ignore_motion == 'no':
         print('Will exclude runs tagged as having excessive motion')
@@ -830,7 +889,7 @@ def process_subject(TR, sharedDir, projDir, derivDir, outDir, workDir,
 
     # call timecourse workflow with extracted subject-level data
     wf = create_timecourse_workflow(sharedDir, projDir, derivDir, workDir, outDir, subDir, sub,
-                                    task, ses, multiecho, keepruns, regressor_opts, mask_opts, smoothing_kernel_size, resultsDir, smoothDir, froiDir, hpf, filter_opt, TR, detrend, standardize, template, extract_opt, dropvols, splithalves, space_name, top_nvox, percent)  
+                                    task, ses, multiecho, keepruns, regressor_opts, mask_opts, smoothing_kernel_size, resultsDir, smoothDir, froiDir, hpf, filter_opt, TR, detrend, standardize, template, extract_opt, dropvols, splithalves, space_name, top_nvox, percent, smooth_cache, smooth_order)  
                                     
                                     
     return wf
@@ -910,6 +969,14 @@ def main(argv=None):
     # lowercase regressor options - allows flexibility in how users specify in config file
     regressor_opts = [r.lower() for r in regressor_opts]
     
+    # directory and size limit of the smoothed data cache (smoothed data are not cached by default)
+    smooth_cache = read_cache_settings(config_file)
+    
+    # order of smoothing and splitting runs into halves: split (split runs then smooth each half, default) or full (smooth the full run once, then split)
+    smooth_order = 'split'
+    if 'smooth_order' in config_file.index and config_file.loc['smooth_order',1] is not None:
+        smooth_order = config_file.loc['smooth_order',1]
+    
     # flag whether top n or top n % of voxels should be extracted and set value to integer
     if top_nvox.endswith('-percent'):
         percent = 'yes'
@@ -986,7 +1053,11 @@ def main(argv=None):
     # define subjects - if none are provided in the script call, they are extracted from the BIDS directory layout information
     subjects = args.subjects if args.subjects else layout.get_subjects()
 
+    # read nipype plugin settings (number of processes, memory, and node resource estimates) from config file
+    plugin_settings = read_plugin_settings(config_file, args.plugin)
+    
     # for each subject in the list of subjects
+    workflows = []
     for index, sub in enumerate(subjects):
         # check that run info was provided in subject list, otherwise throw an error
         if not args.runs:
@@ -1002,16 +1073,16 @@ def main(argv=None):
               
         # create a process_subject workflow with the inputs defined above
         wf = process_subject(TR, sharedDir, args.projDir, derivDir, outDir, workDir, sub,
-                             task, ses, ignore_motion, multiecho, sub_runs, regressor_opts, mask_opts, smoothing_kernel_size, resultsDir, smoothDir, froiDir, hpf, filter_opt, detrend, standardize, template, extract_opt, dropvols, splithalf, space_name, top_nvox, percent)
+                             task, ses, ignore_motion, multiecho, sub_runs, regressor_opts, mask_opts, smoothing_kernel_size, resultsDir, smoothDir, froiDir, hpf, filter_opt, detrend, standardize, template, extract_opt, dropvols, splithalf, space_name, top_nvox, percent, smooth_cache, smooth_order)
    
         # configure workflow options
         wf.config['execution'] = {'crashfile_format': 'txt',
                                   'remove_unnecessary_outputs': False,
                                   'keep_inputs': True}
-
-        # run multiproc
-        args_dict = {'n_procs' : 4}
-        wf.run(plugin='MultiProc', plugin_args = args_dict)
+        workflows.append(wf)
+    
+    # run workflows (multiproc unless plugin specified in script call)
+    run_workflows(workflows, workDir, plugin_settings)
 
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':
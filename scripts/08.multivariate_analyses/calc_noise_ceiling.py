@@ -14,6 +14,7 @@ import os.path as op
 import os
 from scipy.stats import rankdata
 from scipy.spatial.distance import squareform
+from kendall_tau import kendall_tau_a, kendall_tau_batch
 
 def calc_noise_ceiling(projDir, sharedDir, resultsDir, subjects, conditions, mask_opts):
     
@@ -96,18 +97,15 @@ def calc_noise_ceiling(projDir, sharedDir, resultsDir, subjects, conditions, mas
         print('Saved {} group average RDMs to: {}'.format(roi, group_sqeuc_file))
         
         # STEP 1: calculate upper bound by correlating each subject RDM with the rank-transformed group RDM
-        # tau-a using custom function
+        # tau-a using shared function (group RDM is scored against all subject RDMs in one call)
         ## correlation distance
-        tau_cor_upper = [kendall_tau_a(cor_rdms[s], group_cor_rdm)
-        for s in range(len(cor_rdms))]
+        tau_cor_upper = list(kendall_tau_batch(group_cor_rdm, np.array(cor_rdms)))
         
         ## euclidean distance
-        tau_euc_upper = [kendall_tau_a(euc_rdms[s], group_euc_rdm)
-        for s in range(len(euc_rdms))]
+        tau_euc_upper = list(kendall_tau_batch(group_euc_rdm, np.array(euc_rdms)))
         
         ## squared euclidean distance
-        tau_sqeuc_upper = [kendall_tau_a(sqeuc_rdms[s], group_sqeuc_rdm)
-        for s in range(len(euc_rdms))]
+        tau_sqeuc_upper = list(kendall_tau_batch(group_sqeuc_rdm, np.array(sqeuc_rdms)))
         
         # take average across subjects as the upper bound
         upper_cor = np.mean(tau_cor_upper)
@@ -220,30 +218,6 @@ def vectorise_rdm(rdm_file, diag):
     # k=0 will include diagonal; k=1 will exclude diagonal
     return rdm_mat.values[np.triu_indices_from(rdm_mat, k=diag)]
 
-# define function to calculate Kendall's tau-a
-def kendall_tau_a(sub_vec, group_vec):
-    
-    n = len(sub_vec)
-    
-    # pairwise differences
-    sub_diff = sub_vec[:, None] - sub_vec
-    group_diff = group_vec[:, None] - group_vec
-    
-    # calculate concordance/discordance
-    discord = sub_diff * group_diff
-    
-    # take the upper triangle only (excluding diagonal)
-    tri_indx = np.triu_indices(n, k=1)
-    
-    # extract concordant and discordant values
-    C = np.sum(discord[tri_indx] > 0)
-    D = np.sum(discord[tri_indx] < 0)
-    
-    # use values in kendall's tau-a formula
-    tau_a = (C - D) / (n * (n - 1) / 2)
-    
-    return tau_a
-    
 # define command line parser function
 def argparser():
     # create an instance of ArgumentParser
@@ -17,6 +17,11 @@ import json
 from itertools import combinations
 from itertools import chain
 from scipy.stats import pearsonr, spearmanr
+from kendall_tau import kendall_tau_a
+
+# add misc folder to path to import shared subject executor functions
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from subject_executor import add_jobs_argument, run_subjects, SubjectsFailedError
 
 def calc_fold_reliability(projDir, resultsDir, sub, sub_runs, mask_opts, fold_stats, rdm_stats):
     
@@ -239,33 +244,6 @@ def get_descriptives(rdm_df):
             'lower_mean': lower_mean,
             'rdm_mean': mat_nodiag_mean}
     
-# define function to calculate Kendall's tau-a
-def kendall_tau_a(x_vec, y_vec):
-    n = len(x_vec)
-    
-    # pairwise differences
-    x_diff = x_vec[:, None] - x_vec
-    y_diff = y_vec[:, None] - y_vec
-    
-    # calculate concordance/discordance
-    #discord = x_diff * y_diff
-    discord = np.sign(x_diff) * np.sign(y_diff)
-    
-    # take the upper triangle only (excluding diagonal)
-    tri_indx = np.triu_indices(n, k=1)
-    
-    # extract concordant and discordant values
-    # C = np.sum(discord[tri_indx] > 0)
-    # D = np.sum(discord[tri_indx] < 0)
-    # numerator (ties naturally become 0 because sign(0)=0)
-    numerator = np.sum(discord[tri_indx])
-    
-    # use values in kendall's tau-a formula
-    # tau_a = (C - D) / (n * (n - 1) / 2)
-    tau_a = numerator / (n * (n - 1) / 2)
-    
-    return tau_a
-    
 # define command line parser function
 def argparser():
     # create an instance of ArgumentParser
@@ -283,6 +261,7 @@ def argparser():
                         help='Configuration file')                                            
     parser.add_argument('-m', dest='plugin',
                         help='Nipype plugin to use (default: MultiProc)')
+    parser = add_jobs_argument(parser)
     return parser
     
 # define main function that parses the config file and runs the functions defined above
@@ -314,11 +293,8 @@ def main(argv=None):
     if not op.exists(resultsDir):
         raise IOError('Results directory {} not found.'.format(resultsDir))
     
-    # initialise outputs
-    fold_stats = []
-    rdm_stats = []
-        
     # for each subject in the list of subjects
+    subject_args = []
     for index, sub in enumerate(args.subjects):
         print('Checking fold reliability for {}'.format(sub))
         
@@ -331,8 +307,21 @@ def main(argv=None):
         sub_runs=sub_runs.replace(' ','').split(',') # split runs by separators
         sub_runs=list(map(int, sub_runs)) # convert to integers
     
-        # create a calc fold workflow with the inputs defined above
-        calc_fold_reliability(args.projDir, resultsDir, sub, sub_runs, mask_opts, fold_stats, rdm_stats)
+        # save the calc_fold_reliability inputs defined above for this subject
+        subject_args.append([args.projDir, resultsDir, sub, sub_runs, mask_opts])
+    
+    # run calc_fold_reliability for each subject (in parallel if more than 1 job was requested)
+    # fold and rdm stats for each subject are merged in subject order
+    # when processing in parallel, if processing failed for any subject, the stats of the other subjects are saved before the error is raised (one at a time, the first error stops processing)
+    subject_error = None
+    try:
+        results = run_subjects(calc_fold_reliability, args.subjects, subject_args, jobs=args.jobs,
+                               logDir=op.join(resultsDir, 'logs', 'check_fold_reliability'), accumulators=['fold_stats', 'rdm_stats'])
+    except SubjectsFailedError as err:
+        subject_error = err
+        results = err.results
+    fold_stats = results['fold_stats']
+    rdm_stats = results['rdm_stats']
     
     # define group rsa directory to save outputs
     groupDir = op.join(resultsDir, 'group_rdms')
@@ -346,6 +335,9 @@ def main(argv=None):
     fold_df.to_csv(op.join(groupDir, 'fold_reliabilities.csv'), index=False)
     rdm_df.to_csv(op.join(groupDir, 'rdm_descriptives.csv'), index=False)
     
+    if subject_error is not None:
+        raise subject_error
+    
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':
     main()
@@ -13,8 +13,10 @@ import argparse
 import os.path as op
 import os
 from itertools import combinations
+from multiprocessing import Pool
+from kendall_tau import kendall_tau_batch
 
-def calc_roi_reliability(projDir, resultsDir, subjects, mask_opts, niter, nperm):
+def calc_roi_reliability(projDir, resultsDir, subjects, mask_opts, niter, nperm, seed=0, jobs=1):
     
     # check that subject list includes at least 2 subjects
     if len(subjects) < 2:
@@ -31,7 +33,7 @@ def calc_roi_reliability(projDir, resultsDir, subjects, mask_opts, niter, nperm)
     roi_data_cor = {}
     roi_data_euc = {}
     roi_data_sqeuc = {}
-
+    
     # read in all subject RDMs and save as stacked dataframe
     for roi in mask_opts:
         # initalise subject RDMs dataframes
@@ -65,208 +67,140 @@ def calc_roi_reliability(projDir, resultsDir, subjects, mask_opts, niter, nperm)
     # define all possible ROI pairs
     roi_pairs = list(combinations(mask_opts, 2))
     
-    # initialise outputs
-    all_iter = []
-    all_perm = []
-    all_results = []
+    # draw all random subject splits at once (iterations x subjects) so every ROI pair uses the same splits
+    rng = np.random.default_rng(seed)
+    print('Drawing random subject splits and permutation signs using seed {}'.format(seed))
+    subject_idx = rng.permuted(np.tile(np.arange(len(subjects)), (int(niter), 1)), axis=1)
+    
+    # use number of subjects to determine how large each half should be (odd number sample sizes will result in uneven groups)
+    half = len(subjects) // 2
+    
+    # convert splits to weight matrices (iterations x subjects) so that group means can be calculated with matrix products
+    weights1 = np.zeros((int(niter), len(subjects)))
+    weights2 = np.full((int(niter), len(subjects)), 1 / (len(subjects) - half))
+    np.put_along_axis(weights1, subject_idx[:, :half], 1 / half, axis=1)
+    np.put_along_axis(weights2, subject_idx[:, :half], 0, axis=1)
     
-    # loop over ROIs 
+    # generate random vectors of 1s and -1s for the sign-flip permutation test (permutations x iterations)
+    signs = rng.choice([-1, 1], size=(int(nperm), int(niter)))
+    
+    # define inputs for each ROI pair (only the data for the two ROIs are passed)
+    pair_args = []
     for roi1, roi2 in roi_pairs:
-        # initialise outputs
-        iter_results = []
-        
-        print('Calculating split half RDM reliability for ROI pair: {} - {}'.format(roi1, roi2))
-            
-        # start iteration loop
-        for i in range(int(niter)):
-            
-            # shuffle subject indices
-            subject_idx = np.random.permutation(len(subjects))
-            
-            # use number of subjects to determine how large each half should be (odd number sample sizes will result in uneven groups)
-            half = len(subject_idx) // 2
-            
-            # select subject groups
-            group1 = subject_idx[:half]
-            group2 = subject_idx[half:]
-            
-            # print out subject indices as an optional data checking step
-            #print('Subject indices for group 1 {}'.format(group1))
-            #print('Subject indices for group 2 {}'.format(group2))
-            
-            # calculate difference scores (and return within and across variables for data checking)  
-            within_cor, across_cor, diff_cor = calc_diff_score(roi_data_cor, roi1, roi2, group1, group2)
-            within_euc, across_euc, diff_euc = calc_diff_score(roi_data_euc, roi1, roi2, group1, group2)
-            within_sqeuc, across_sqeuc, diff_sqeuc = calc_diff_score(roi_data_sqeuc, roi1, roi2, group1, group2)
-            
-            # append iteration outputs
-            # correlation
-            iter_results.append({'roi1': roi1,
-                                 'roi2': roi2,
-                                 'iteration_num': i,
-                                 'metric': 'correlation',
-                                 'within': within_cor,
-                                 'across': across_cor,
-                                 'difference': diff_cor})
-            
-            # euclidean
-            iter_results.append({'roi1': roi1,
-                                 'roi2': roi2,
-                                 'iteration_num': i,
-                                 'metric': 'euclidean',
-                                 'within': within_euc,
-                                 'across': across_euc,
-                                 'difference': diff_euc})
-            
-            # squared euclidean
-            iter_results.append({'roi1': roi1,
-                                 'roi2': roi2,
-                                 'iteration_num': i,
-                                 'metric': 'squared_euclidean',
-                                 'within': within_sqeuc,
-                                 'across': across_sqeuc,
-                                 'difference': diff_sqeuc})
-            
-        # convert iteration results to dataframe
-        iter_df = pd.DataFrame(iter_results)
-        
-        # calculate discrim index separately for each metric (correlation and euclidean) by taking the mean difference score
-        discrim_df = (iter_df.groupby(['roi1', 'roi2', 'metric'])['difference']
-                             .agg(['mean']).reset_index()
-                             .rename(columns={'mean': 'discrim_index'}))
-        
-        print('{}'.format(discrim_df[['metric', 'discrim_index']]))
-        
-        # permutation test
-        print('Running permutation test using {} permutations'.format(int(nperm)))
-        
-        # initialise outputs
-        perm_results = []
-        
-        # extract difference scores
-        diff_cor_vec = iter_df.query("metric == 'correlation'")['difference'].values
-        diff_euc_vec = iter_df.query("metric == 'euclidean'")['difference'].values
-        diff_sqeuc_vec = iter_df.query("metric == 'squared_euclidean'")['difference'].values
-        
-        for p in range(int(nperm)):
-            # generate a random vector the same length as the difference score vector (i.e., number of iterations) of 1s and -1s
-            signs = np.random.choice([-1, 1], size=int(niter))
-            
-            # generate a mean score for this iteration and store all values
-            # correlation
-            perm_results.append({'roi1': roi1,
-                                 'roi2': roi2,
-                                 'perm_num': p,
-                                 'metric': 'correlation',
-                                 'perm_discrim_index': np.mean(diff_cor_vec * signs)})
-            
-            # euclidean
-            perm_results.append({'roi1': roi1,
-                                 'roi2': roi2,
-                                 'perm_num': p,
-                                 'metric': 'euclidean',
-                                 'perm_discrim_index': np.mean(diff_euc_vec * signs)})
-                                 
-            # squared euclidean
-            perm_results.append({'roi1': roi1,
-                                 'roi2': roi2,
-                                 'perm_num': p,
-                                 'metric': 'squared_euclidean',
-                                 'perm_discrim_index': np.mean(diff_sqeuc_vec * signs)})
-        
-        # convert permutation results to dataframe
-        perm_df = pd.DataFrame(perm_results)
-        
-        # merge perm_df with discrim_df
-        p_values = (perm_df.merge(discrim_df, on=['roi1', 'roi2', 'metric']))
-        
-        # compute a p-value based on the proportion of permuted values that are larger than the observed discrim_index 
-        # (i.e., proportion of permuted statistics that are at least as extreme as the observed statistic)
-        p_values = (p_values.groupby(['roi1', 'roi2', 'metric'])
-                            .apply(lambda x: (x['perm_discrim_index'] >= x['discrim_index'].iloc[0]).mean()).reset_index(name='p_value'))
-        
-        # merge into results dataframe
-        results_df = discrim_df.merge(p_values, on=['roi1', 'roi2', 'metric'])
-        
-        # append results for this ROI pair
-        all_iter.extend(iter_results)
-        all_perm.extend(perm_results)
-        all_results.append(results_df)
-
-    # convert results to dataframes
-    iter_df = pd.DataFrame(all_iter)
-    perm_df = pd.DataFrame(all_perm)
-    results_df = pd.concat(all_results, ignore_index=True)
+        pair_data = {'correlation': {roi: roi_data_cor[roi] for roi in [roi1, roi2]},
+                     'euclidean': {roi: roi_data_euc[roi] for roi in [roi1, roi2]},
+                     'squared_euclidean': {roi: roi_data_sqeuc[roi] for roi in [roi1, roi2]}}
+        pair_args.append((pair_data, roi1, roi2, weights1, weights2, signs))
+    
+    # run ROI pairs in parallel if requested
+    if jobs > 1:
+        print('Running {} ROI pairs using {} processes'.format(len(roi_pairs), jobs))
+        with Pool(jobs) as pool:
+            pair_results = pool.starmap(calc_pair_reliability, pair_args)
+    else:
+        pair_results = [calc_pair_reliability(*a) for a in pair_args]
+    
+    # convert results to dataframes (in ROI pair order)
+    iter_df = pd.concat([r[0] for r in pair_results], ignore_index=True)
+    perm_df = pd.concat([r[1] for r in pair_results], ignore_index=True)
+    results_df = pd.concat([r[2] for r in pair_results], ignore_index=True)
     
     # save results
     iter_df.to_csv(op.join(relDir, 'splithalf-iterations.csv'), index=False)
     perm_df.to_csv(op.join(relDir, 'splithalf-permutations.csv'), index=False)
     results_df.to_csv(op.join(relDir, 'splithalf-results.csv'), index=False)
 
-# define function to vectorise the RDMs
-def vectorise_rdm(rdm_file, diag):
-    # load rdm
-    rdm_mat = pd.read_csv(rdm_file, sep=',')
+# define function to calculate split-half reliability for one ROI pair across all iterations and permutations
+def calc_pair_reliability(roi_data, roi1, roi2, weights1, weights2, signs):
     
-    # returns the upper triangle as vector
-    # k=0 will include diagonal; k=1 will exclude diagonal
-    return rdm_mat.values[np.triu_indices_from(rdm_mat, k=diag)]
+    print('Calculating split half RDM reliability for ROI pair: {} - {}'.format(roi1, roi2))
     
-# define function to calculate Kendall's tau-a
-def kendall_tau_a(x_vec, y_vec):
-    n = len(x_vec)
+    niter = weights1.shape[0]
+    nperm = signs.shape[0]
+    metrics = ['correlation', 'euclidean', 'squared_euclidean']
     
-    # pairwise differences
-    x_diff = x_vec[:, None] - x_vec
-    y_diff = y_vec[:, None] - y_vec
+    # calculate difference scores for all iterations (and return within and across variables for data checking)
+    within = {}
+    across = {}
+    difference = {}
+    for metric in metrics:
+        within[metric], across[metric], difference[metric] = calc_diff_score(roi_data[metric], roi1, roi2, weights1, weights2)
     
-    # calculate concordance/discordance
-    #discord = x_diff * y_diff
-    discord = np.sign(x_diff) * np.sign(y_diff)
+    # combine iteration outputs (rows are ordered by iteration and then metric)
+    iter_df = pd.DataFrame({'roi1': roi1,
+                            'roi2': roi2,
+                            'iteration_num': np.repeat(np.arange(niter), len(metrics)),
+                            'metric': np.tile(metrics, niter),
+                            'within': np.column_stack([within[m] for m in metrics]).ravel(),
+                            'across': np.column_stack([across[m] for m in metrics]).ravel(),
+                            'difference': np.column_stack([difference[m] for m in metrics]).ravel()})
     
-    # take the upper triangle only (excluding diagonal)
-    tri_indx = np.triu_indices(n, k=1)
+    # calculate discrim index separately for each metric (correlation and euclidean) by taking the mean difference score
+    discrim_df = pd.DataFrame({'roi1': roi1,
+                               'roi2': roi2,
+                               'metric': sorted(metrics),
+                               'discrim_index': [np.mean(difference[m]) for m in sorted(metrics)]})
     
-    # extract concordant and discordant values
-    # C = np.sum(discord[tri_indx] > 0)
-    # D = np.sum(discord[tri_indx] < 0)
-    # numerator (ties naturally become 0 because sign(0)=0)
-    numerator = np.sum(discord[tri_indx])
+    print('{}'.format(discrim_df[['metric', 'discrim_index']]))
     
-    # use values in kendall's tau-a formula
-    # tau_a = (C - D) / (n * (n - 1) / 2)
-    tau_a = numerator / (n * (n - 1) / 2)
+    # permutation test
+    print('Running permutation test using {} permutations'.format(nperm))
     
-    return tau_a
+    # generate a mean score for each permutation by applying the random signs to the difference scores (permutations x metrics)
+    perm_vals = signs @ np.column_stack([difference[m] for m in metrics]) / niter
     
-# define function to calculate difference score
-# this is done with a function to avoid having to duplicate everything for correlation and euclidean RDMs
-def calc_diff_score(roi_data, roi1, roi2, group1, group2):
+    perm_df = pd.DataFrame({'roi1': roi1,
+                            'roi2': roi2,
+                            'perm_num': np.repeat(np.arange(nperm), len(metrics)),
+                            'metric': np.tile(metrics, nperm),
+                            'perm_discrim_index': perm_vals.ravel()})
+    
+    # compute a p-value based on the proportion of permuted values that are larger than the observed discrim_index 
+    # (i.e., proportion of permuted statistics that are at least as extreme as the observed statistic)
+    p_values = [np.mean(perm_vals[:, metrics.index(m)] >= np.mean(difference[m])) for m in sorted(metrics)]
+    
+    # merge into results dataframe
+    results_df = discrim_df.assign(p_value=p_values)
+    
+    return iter_df, perm_df, results_df
 
-    ## calculate mean neural pattern
+# define function to vectorise the RDMs
+def vectorise_rdm(rdm_file, diag):
+    # load rdm
+    rdm_mat = pd.read_csv(rdm_file, sep=',')
+    
+    # returns the upper triangle as vector
+    # k=0 will include diagonal; k=1 will exclude diagonal
+    return rdm_mat.values[np.triu_indices_from(rdm_mat, k=diag)]
+    
+# define function to calculate difference scores for all iterations
+# this is done with a function to avoid having to duplicate everything for correlation and euclidean RDMs
+def calc_diff_score(roi_data, roi1, roi2, weights1, weights2):
+    
+    ## calculate mean neural pattern for each half in every iteration (iterations x RDM values)
     # roi 1
-    roi1_half1 = roi_data[roi1][group1].mean(axis=0)
-    roi1_half2 = roi_data[roi1][group2].mean(axis=0)
+    roi1_half1 = weights1 @ roi_data[roi1]
+    roi1_half2 = weights2 @ roi_data[roi1]
     
     # roi 2
-    roi2_half1 = roi_data[roi2][group1].mean(axis=0)
-    roi2_half2 = roi_data[roi2][group2].mean(axis=0)
+    roi2_half1 = weights1 @ roi_data[roi2]
+    roi2_half2 = weights2 @ roi_data[roi2]
     
     ## calculate within roi correlations (tau-a)
-    within_tau1 = kendall_tau_a(roi1_half1, roi1_half2)
-    within_tau2 = kendall_tau_a(roi2_half1, roi2_half2)
+    within_tau1 = kendall_tau_batch(roi1_half1, roi1_half2)
+    within_tau2 = kendall_tau_batch(roi2_half1, roi2_half2)
     
     # calculate within ROI average
     within = (within_tau1 + within_tau2) / 2
     
     ## calculate across roi correlations (tau-a)
-    across_tau1 = kendall_tau_a(roi1_half1, roi2_half2)
-    across_tau2 = kendall_tau_a(roi2_half1, roi1_half2)
+    across_tau1 = kendall_tau_batch(roi1_half1, roi2_half2)
+    across_tau2 = kendall_tau_batch(roi2_half1, roi1_half2)
     
     # calculate across ROI average
     across = (across_tau1 + across_tau2) / 2
-
-    # calculate difference score and append to list
+    
+    # calculate difference score
     difference = within - across
     
     # return all metrics
@@ -289,6 +223,8 @@ def argparser():
                         help='Configuration file')                                            
     parser.add_argument('-m', dest='plugin',
                         help='Nipype plugin to use (default: MultiProc)')
+    parser.add_argument('-j', dest='jobs', type=int, default=1,
+                        help='Number of ROI pairs to process in parallel (default: 1)')
     return parser
     
 # define main function that parses the config file and runs the functions defined above
@@ -315,6 +251,12 @@ def main(argv=None):
     niter=config_file.loc['splithalf_iterations',1]
     nperm=int(config_file.loc['npermutations',1])
     
+    # random seed for subject splits and permutations (optional, default 0)
+    if 'random_seed' in config_file.index and config_file.loc['random_seed',1] is not None:
+        seed = int(config_file.loc['random_seed',1])
+    else:
+        seed = 0
+    
     # print if results directory is not specified or found
     if resultsDir == None:
         raise IOError('No resultsDir was specified in config file, but is required to calculate a noise ceiling!')
@@ -323,7 +265,7 @@ def main(argv=None):
         raise IOError('Results directory {} not found.'.format(resultsDir))
     
     # create a calc roi workflow with the inputs defined above
-    calc_roi_reliability(args.projDir, resultsDir, args.subjects, mask_opts, niter, nperm)
+    calc_roi_reliability(args.projDir, resultsDir, args.subjects, mask_opts, niter, nperm, seed, args.jobs)
     
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':
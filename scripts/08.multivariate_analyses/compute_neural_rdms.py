@@ -8,6 +8,7 @@ More information on what this script is doing - beyond the commented code - is p
 
 """
 import sys
+import json
 import pandas as pd
 import numpy as np
 import argparse
@@ -22,19 +23,66 @@ import glob
 import shutil
 import datetime
 import math
+import hashlib
+from collections import OrderedDict
+from functools import partial
+import nibabel as nib
 from nilearn import image
-from nilearn.maskers import NiftiMasker
 import nilearn
 
-def generate_rdm(projDir, sharedDir, resultsDir, froiDir, sub, task, runs, folds, multi_noise_norm, splithalves, conditions, mask_opts, template, normalise, top_nvox, percent, shrink_vals):
+# add misc folder to path to import shared subject executor functions
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from subject_executor import add_jobs_argument, run_subjects, SubjectsFailedError
+
+# define class to hold image data in memory so that each image is only loaded (and decompressed) once per subject
+class ImageCache:
+    # least recently used images are dropped once the cached arrays exceed max_gb
+    def __init__(self, max_gb=4):
+        self.max_bytes = float(max_gb) * 1024**3
+        self.nbytes = 0
+        self.arrays = OrderedDict()
+    
+    # return the image data array for a file, loading it if it isn't already cached
+    def get(self, img_file):
+        if img_file in self.arrays:
+            self.arrays.move_to_end(img_file)
+            return self.arrays[img_file]
+        
+        # load image data in its stored data type (the same values extracted by NiftiMasker)
+        img_arr = np.asanyarray(nib.load(img_file).dataobj)
+        
+        # remove the 4th singleton dimension (e.g., statistical maps and fROIs) so all arrays are 3D
+        if img_arr.ndim == 4 and img_arr.shape[3] == 1:
+            img_arr = img_arr[..., 0]
+        
+        # drop least recently used arrays until there is space for this one
+        while self.arrays and self.nbytes + img_arr.nbytes > self.max_bytes:
+            old_file, old_arr = self.arrays.popitem(last=False)
+            self.nbytes -= old_arr.nbytes
+        
+        self.arrays[img_file] = img_arr
+        self.nbytes += img_arr.nbytes
+        
+        return img_arr
+
+def generate_rdm(projDir, sharedDir, resultsDir, froiDir, sub, task, runs, folds, multi_noise_norm, splithalves, conditions, mask_opts, template, normalise, top_nvox, percent, shrink_vals, cache_gb=4, pattern_format=('npy',)):
+    
+    # initialise image cache for this subject
+    img_cache = ImageCache(cache_gb)
+    
+    # initialise residual blocks (run x ROI) shared by all folds for this subject
+    resid_blocks = {}
     
     # make output rsa directories
     rsaDir = op.join(resultsDir, '{}'.format(sub), 'rsa')
     vectorsDir = op.join(rsaDir, 'condition_vectors')
     rdmDir = op.join(rsaDir, 'neural_rdms')
+    whiteningDir = op.join(rsaDir, 'whitening_cache')
     os.makedirs(rsaDir, exist_ok=True)
     os.makedirs(vectorsDir, exist_ok=True)
     os.makedirs(rdmDir, exist_ok=True)
+    if multi_noise_norm == 'yes':
+        os.makedirs(whiteningDir, exist_ok=True)
     
     # initalise list of condition vectors to calculate RDMs across runs/folds
     patterns = {}
@@ -194,32 +242,39 @@ def generate_rdm(projDir, sharedDir, resultsDir, froiDir, sub, task, runs, folds
             
             print('Model directory: {}'.format(modelDir))
             
+            # read mni file dimensions from the header (used only to check whether resampling is required)
+            mni_shape = nib.load(mni_file).shape
+            
+            # initialise the ROI masks and pattern variables for this run/fold
+            mask_names = []
+            roi_bins = []
+            roi_patterns = []
+            
             # for each ROI search space
             for r, roi in enumerate(roi_masks):
                 
-                # initialise the pattern variable for this ROI
-                roi_patterns = []
-                
-                # load and binarize mni file
-                mni_img = image.load_img(mni_file)
-                mni_bin = mni_img.get_fdata() # get image data (as floating point data)
-                mni_bin[mni_bin >= 1] = 1 # for values equal to or greater than 1, make 1 (values less than 1 are already 0)
-                mni_bin = image.new_img_like(mni_img, mni_bin) # create a new image of the same class as the initial image
-                
-                # load roi mask
-                mask_img = image.load_img(roi)
-                mask_bin = mask_img.get_fdata()
+                # extract mask name in a format that will match contrast naming
+                if 'fROI' in mask_opts[r]:
+                    mask_name = mask_opts[r].split('-')[1].lower()
+                else:
+                    mask_name = mask_opts[r]
                 
-                # ensure that mask/ROI is binarized
-                mask_bin[mask_bin >= 1] = 1 # for values equal to or greater than 1, make 1 (values less than 1 are already 0)
-                mask_bin = image.new_img_like(mask_img, mask_bin) # create a new image of the same class as the initial image
+                if 'aROI' in mask_opts[r]:
+                    mask_name = mask_opts[r].split('-')[1].lower()
+                else:
+                    mask_name = mask_opts[r]
                 
                 # extract file name
                 roi_name = mask_opts[r].split('-')[-1]
-                print('Extracting stats from {} using {}'.format(roi_name, roi[0]))
+                roi_file = roi[0] if isinstance(roi, list) else roi
+                print('Extracting stats from {} using {}'.format(roi_name, roi_file))
+                
+                # load roi mask (from the cache if it was already loaded for another run/fold)
+                mask_file = roi_file
+                mask_arr = img_cache.get(mask_file)
                 
                 # the masks should already be resampled, but check if this is true and resample if not
-                if mni_img.shape[0:3] != mask_bin.shape[0:3]:
+                if mni_shape[0:3] != mask_arr.shape[0:3]:
                     print('WARNING: the search space provided has different dimensions than the functional data!')
                     
                     # make directory to save resampled rois
@@ -230,76 +285,101 @@ def generate_rdm(projDir, sharedDir, resultsDir, froiDir, sub, task, runs, folds
                     
                     # check if file already exists
                     if os.path.isfile(resampled_file):
-                        print('Found previously resampled {} ROI in output directory'.format(roi_name[r]))
-                        mask_bin = image.load_img(resampled_file)
+                        print('Found previously resampled {} ROI in output directory'.format(roi_name))
                     else:
-                        # resample image
-                        print('Resampling {} search space to match functional data'.format(roi_name[r]))
-                        mask_bin = image.resample_to_img(mask_bin, mni_img, interpolation='nearest')
+                        # binarize and resample image
+                        print('Resampling {} search space to match functional data'.format(roi_name))
+                        mask_img = image.load_img(roi_file)
+                        mask_bin = mask_img.get_fdata()
+                        mask_bin[mask_bin >= 1] = 1 # for values equal to or greater than 1, make 1 (values less than 1 are already 0)
+                        mask_bin = image.new_img_like(mask_img, mask_bin) # create a new image of the same class as the initial image
+                        mask_bin = image.resample_to_img(mask_bin, mni_file, interpolation='nearest')
                         mask_bin.to_filename(resampled_file)
+                    
+                    mask_file = resampled_file
+                    mask_arr = img_cache.get(mask_file)
                 
-                masker = NiftiMasker(mask_img=mask_bin)
+                # ensure that mask/ROI is binarized
+                mask_bin = mask_arr > 0
+                
+                mask_names.append(mask_name)
+                roi_bins.append(mask_bin)
+                roi_patterns.append([])
+            
+            # apply multivariate noise normalisation if requested
+            if multi_noise_norm == 'yes':
+                print('Calculating whitening matrices based on residuals for multivariate noise normalisation')
+                whitening_matrices, shrink_vals = calc_whitening_matrix(resultsDir, vectorsDir, whiteningDir, sub, run_id, mask_opts, roi_bins, resid_blocks, shrink_vals)
+            
+            # for each item/condition, load the statistical map once and apply every ROI mask to the in-memory data
+            for c in conditions:
                 
-                # apply multivariate noise normalisation if requested
                 if multi_noise_norm == 'yes':
-                    print('Calculating whitening matrix based on residuals for multivariate noise normalisation')
-                    whitening_matrix, shrink_vals = calc_whitening_matrix(resultsDir, vectorsDir, sub, run_id, mask_opts[r], masker, shrink_vals)
-
-                # for each item/condition
-                for c in conditions:
-                    
-                    # extract mask name in a format that will match contrast naming
-                    if 'fROI' in mask_opts[r]:
-                        mask_name = mask_opts[r].split('-')[1].lower()
-                    else:
-                        mask_name = mask_opts[r]
-                    
-                    if 'aROI' in mask_opts[r]:
-                        mask_name = mask_opts[r].split('-')[1].lower()
-                    else:
-                        mask_name = mask_opts[r]
-                    
-                    if multi_noise_norm == 'yes':
-                        print('Extracting betas from {} condition'.format(c))
-                        # copes file
-                        cope_file = glob.glob(op.join(modelDir, '*_{}_cope.nii.gz'.format(c)))[0]
-                        cope_img = image.load_img(cope_file)
-                    else:
-                        print('Extracting t-stats from {} condition'.format(c))
-                    
-                        # t-stats file
-                        cope_file = glob.glob(op.join(modelDir, '*_{}_tstat.nii.gz'.format(c)))[0]
-                        cope_img = image.load_img(cope_file)
-                    
-                    # squeeze the statistical map to remove the 4th singleton dimension if using anatomical/atlas ROI
-                    # this dimension is not adding any information, so this is fine to do; the 3D map of stats values is preserved.
-                    # this step isn't necessary for fROIs because they were defined using the functional data and also have a 4th singleton dimension
-                    if not 'fROI' in mask_opts[r] and not 'FS' in mask_opts[r] and not 'aROI' in mask_opts[r]:
-                        cope_img = image.math_img('np.squeeze(img)', img=cope_img)
-                        
-                    # extract t-stats vector of voxel values
-                    # mask condition image with roi image and return 2D array
-                    vec = masker.fit_transform(cope_img).squeeze()
+                    print('Extracting betas from {} condition'.format(c))
+                    # copes file
+                    cope_file = glob.glob(op.join(modelDir, '*_{}_cope.nii.gz'.format(c)))[0]
+                else:
+                    print('Extracting t-stats from {} condition'.format(c))
+                    # t-stats file
+                    cope_file = glob.glob(op.join(modelDir, '*_{}_tstat.nii.gz'.format(c)))[0]
+                
+                # the 4th singleton dimension of the statistical map is dropped when the image is cached; the 3D map of stats values is preserved
+                cope_arr = img_cache.get(cope_file)
+                
+                # for each ROI search space
+                for r, mask_bin in enumerate(roi_bins):
+                    # extract vector of voxel values within the roi (non-finite values are set to 0, as done by NiftiMasker)
+                    vec = cope_arr[mask_bin].astype(np.float64)
+                    vec[~np.isfinite(vec)] = 0
                     
                     # apply multivariate noise normalisation if requested
                     if multi_noise_norm == 'yes':
                         print('Applying multivariate noise normalisation')
-                        vec = apply_multi_norm(whitening_matrix, vec)
+                        vec = apply_multi_norm(whitening_matrices[r], vec)
                     
                     # add the pattern for this condition to the patterns variable for this roi
-                    roi_patterns.append(vec)
-                
+                    roi_patterns[r].append(vec)
+            
+            # for each ROI search space
+            for r, mask_name in enumerate(mask_names):
                 # save condition vectors for this ROI
-                save_patterns(sub, task, roi_patterns, mask_name, run_id, splithalf_id, conditions, vectorsDir)
+                save_patterns(sub, task, roi_patterns[r], mask_name, run_id, splithalf_id, conditions, vectorsDir, pattern_format)
                 
                 # store the condition vectors for this ROI and run/fold for RDM calculation
-                patterns[(mask_name, run_id, splithalf_id)] = np.array(roi_patterns)
+                patterns[(mask_name, run_id, splithalf_id)] = np.array(roi_patterns[r])
                 
     # calculate dissimilarity across runs/folds (or within a run/fold)
     calc_dissimilarity(sub, task, patterns, conditions, rdmDir, normalise)
 
-# define function to calculate the whitening matrix to use for multivariate noise normalisation
-def calc_whitening_matrix(resultsDir, vectorsDir, sub, run_id, roi_name, roi_mask, shrink_vals):
+# define function to extract residuals for voxels in each ROI, loading each run's residuals only once per subject
+def extract_residuals(resultsDir, sub, fold_runs, roi_keys, roi_bins, resid_blocks):
+    
+    # loop over each run in the fold
+    for run in fold_runs:
+        # find ROIs that have not been extracted from this run yet (runs shared across folds are reused)
+        missing = [r for r, key in enumerate(roi_keys) if (run, key) not in resid_blocks]
+        if not missing:
+            print('Using previously extracted residuals from run{}'.format(run))
+            continue
+        
+        # load run residuals file
+        resid_file = op.join(resultsDir, '{}'.format(sub), 'model', 'run{}'.format(run), 'res4d.nii.gz')
+        resid_arr = np.asanyarray(nib.load(resid_file).dataobj)
+        
+        # extract residuals timeseries for voxels in each ROI (non-finite values are set to 0, as done by NiftiMasker)
+        for r in missing:
+            resid_vec = resid_arr[roi_bins[r]].T.astype(np.float64)
+            resid_vec[~np.isfinite(resid_vec)] = 0
+            print('Dimensions of extracted residuals from run{} (timepoints x voxels): {}'.format(run, resid_vec.shape))
+            
+            resid_blocks[(run, roi_keys[r])] = resid_vec
+        
+        del resid_arr
+    
+    return resid_blocks
+
+# define function to calculate the whitening matrices to use for multivariate noise normalisation
+def calc_whitening_matrix(resultsDir, vectorsDir, whiteningDir, sub, run_id, roi_names, roi_bins, resid_blocks, shrink_vals):
     
     # read in subject fold info file to get list of runs in each fold
     fold_info_file = op.join(resultsDir, '{}'.format(sub), 'fold_info.tsv')
@@ -308,71 +388,109 @@ def calc_whitening_matrix(resultsDir, vectorsDir, sub, run_id, roi_name, roi_mas
     runs_str = fold_info.loc[fold_info['fold'] == 'fold{}'.format(run_id), 'runs'].values[0]
     fold_runs = [int(x) for x in str(runs_str).split(',')]
     
-    # initialise fold-level residual output
-    resid_fold = []
-    
-    # loop over each run in the fold
-    for r, run in enumerate(fold_runs):
-        # load run residuals file
+    # identify the residual files in this fold by their modification times and sizes
+    fold_key = []
+    for run in fold_runs:
         resid_file = op.join(resultsDir, '{}'.format(sub), 'model', 'run{}'.format(run), 'res4d.nii.gz')
-        resid_img = image.load_img(resid_file)
+        resid_stat = os.stat(resid_file)
+        fold_key.append('{}:{}:{}'.format(resid_file, resid_stat.st_mtime_ns, resid_stat.st_size))
+    fold_key = '|'.join(fold_key)
+    
+    # identify each ROI by a hash of its voxels
+    roi_keys = [hashlib.sha1(str(b.shape).encode() + np.packbits(b).tobytes()).hexdigest() for b in roi_bins]
+    
+    # define cache files for the whitening matrices (any change to the residuals or ROIs results in a new file)
+    cache_files = []
+    for r, roi_name in enumerate(roi_names):
+        cache_key = hashlib.sha1('{}|{}'.format(fold_key, roi_keys[r]).encode()).hexdigest()
+        cache_files.append(op.join(whiteningDir, 'fold{}_{}_{}.npz'.format(run_id, roi_name, cache_key[:16])))
+    
+    # extract residuals for the ROIs that do not have cached whitening matrices
+    pending = [r for r in range(len(roi_bins)) if not op.isfile(cache_files[r])]
+    if pending:
+        resid_blocks = extract_residuals(resultsDir, sub, fold_runs, [roi_keys[r] for r in pending], [roi_bins[r] for r in pending], resid_blocks)
+    
+    # initialise output
+    whitening_matrices = []
+    
+    # for each ROI
+    for r, roi_name in enumerate(roi_names):
+        cov_file = op.join(vectorsDir, 'residuals-fold{}_{}_shrunken-covariance.csv'.format(run_id, roi_name))
         
-        # extract residuals timeseries for voxels in ROI
-        resid_vec = roi_mask.fit_transform(resid_img).squeeze()
-        print('Dimensions of extracted residuals from run{} (timepoints x voxels): {}'.format(run, resid_vec.shape))
+        if r in pending:
+            # concatenate residuals from the runs in this fold
+            resid_fold = np.concatenate([resid_blocks[(run, roi_keys[r])] for run in fold_runs], axis=0)
+            print('Dimensions of concatenated residuals (timepoints across runs in fold x voxels): {}'.format(resid_fold.shape))
+            
+            # estimate shrinkage factor from the residual timeseries
+            lw = LedoitWolf()
+            lw.fit(resid_fold)
+            print('Estimated shrinkage factor: {}'.format(lw.shrinkage_))
+            
+            # apply shrinkage factor to variance-covariance matrix
+            cov_shrunk = lw.covariance_
+            shrinkage = float(lw.shrinkage_)
+            num_timepoints = resid_fold.shape[0]
+            
+            # if we want to apply the same shrinkage factor and not use a data-driven estimate
+            # # generate voxel variance-covariance matrix
+            # cov = np.cov(resid_fold, rowvar=False)
+            
+            # # extract diagonal (preserves within voxel variance, sets covariance to 0)
+            # diag_cov = np.diag(np.diag(cov))
+            
+            # # apply shrinkage factor
+            # cov_shrunk = shrinkage * diag_cov + (1-shrinkage) * cov
+            
+            # save variance-covariance matrix to vectorsDir
+            # cov_df = pd.DataFrame(cov)
+            # cov_df.to_csv(op.join(vectorsDir, 'residuals-fold{}_{}_variance-covariance.csv'.format(run_id, roi_name)), sep=',', index=False, header=False)
+            
+            cov_shrunk_df = pd.DataFrame(cov_shrunk)
+            cov_shrunk_df.to_csv(cov_file, sep=',', index=False, header=False)
+            
+            # compute whitening transform (using eigendecomposition)
+            eigvals, eigvecs = np.linalg.eigh(cov_shrunk)
+            
+            # compute the inverse square roots
+            inv_sqrt = np.diag(1 / np.sqrt(eigvals))
+            
+            # construct the whitening matrix
+            # this is the inverse square root of the shrunken covariance matrix that we use for the whitening step
+            whitening = eigvecs @ inv_sqrt @ eigvecs.T
+            
+            # save whitening matrix and shrinkage estimate to the cache (written to a temporary file first so an interrupted run can't leave a partial file)
+            tmp_file = '{}.tmp'.format(cache_files[r])
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, whitening=whitening, covariance=cov_shrunk, shrinkage=shrinkage, num_timepoints=num_timepoints)
+            os.replace(tmp_file, cache_files[r])
         
-        # concatenate residuals from this run with other runs
-        resid_fold.append(resid_vec)
-   
-    # confirm dimensions of concatenated residuals
-    resid_fold = np.concatenate(resid_fold, axis=0)
-    print('Dimensions of concatenated residuals (timepoints across runs in fold x voxels): {}'.format(resid_fold.shape))
-    
-    # estimate shrinkage factor from the residual timeseries
-    lw = LedoitWolf()
-    lw.fit(resid_fold)
-    print('Estimated shrinkage factor: {}'.format(lw.shrinkage_))
-    
-    # apply shrinkage factor to variance-covariance matrix
-    cov_shrunk = lw.covariance_
-    
-    # if we want to apply the same shrinkage factor and not use a data-driven estimate
-    # # generate voxel variance-covariance matrix
-    # cov = np.cov(resid_fold, rowvar=False)
-    
-    # # extract diagonal (preserves within voxel variance, sets covariance to 0)
-    # diag_cov = np.diag(np.diag(cov))
-    
-    # # apply shrinkage factor
-    # cov_shrunk = shrinkage * diag_cov + (1-shrinkage) * cov
-    
-    # save variance-covariance matrix to vectorsDir
-    # cov_df = pd.DataFrame(cov)
-    # cov_df.to_csv(op.join(vectorsDir, 'residuals-fold{}_{}_variance-covariance.csv'.format(run_id, roi_name)), sep=',', index=False, header=False)
-    
-    cov_shrunk_df = pd.DataFrame(cov_shrunk)
-    cov_shrunk_df.to_csv(op.join(vectorsDir, 'residuals-fold{}_{}_shrunken-covariance.csv'.format(run_id, roi_name)), sep=',', index=False, header=False)
-    
-    # save shrinkage factor
-    shrink_vals.append({'sub': sub,
-                        'fold': run_id,
-                        'roi': roi_name,
-                        'shrinkage_factor': float(lw.shrinkage_),
-                        'num_runs': len(fold_runs),
-                        'num_timepoints': resid_fold.shape[0]})
-    
-    # compute whitening transform (using eigendecomposition)
-    eigvals, eigvecs = np.linalg.eigh(cov_shrunk)
-    
-    # compute the inverse square roots
-    inv_sqrt = np.diag(1 / np.sqrt(eigvals))
-    
-    # construct the whitening matrix
-    # this is the inverse square root of the shrunken covariance matrix that we use for the whitening step
-    whitening = eigvecs @ inv_sqrt @ eigvecs.T
-    
-    return whitening, shrink_vals
+        else:
+            # load previously computed whitening matrix and shrinkage estimate
+            print('Using cached whitening matrix for fold{} {}: {}'.format(run_id, roi_name, cache_files[r]))
+            with np.load(cache_files[r]) as cached:
+                whitening = cached['whitening']
+                shrinkage = float(cached['shrinkage'])
+                num_timepoints = int(cached['num_timepoints'])
+                
+                # save the shrunken variance-covariance matrix if it was removed from vectorsDir
+                if not op.isfile(cov_file):
+                    pd.DataFrame(cached['covariance']).to_csv(cov_file, sep=',', index=False, header=False)
+            
+            print('Estimated shrinkage factor: {}'.format(shrinkage))
+        
+        # save shrinkage factor
+        shrink_vals.append({'sub': sub,
+                            'fold': run_id,
+                            'roi': roi_name,
+                            'shrinkage_factor': shrinkage,
+                            'num_runs': len(fold_runs),
+                            'num_timepoints': num_timepoints})
+        
+        whitening_matrices.append(whitening)
     
+    return whitening_matrices, shrink_vals
+
 # define function to implement multivariate noise normalisation
 def apply_multi_norm(whitening_matrix, beta_vec):
     
@@ -381,37 +499,52 @@ def apply_multi_norm(whitening_matrix, beta_vec):
     
     return whitened_beta_vec
 
-# define function to wrangle and save run/fold RDM data into a useable csv format
-def save_patterns(sub, task, patterns, mask_name, run_id, splithalf_id, conditions, vectorsDir):
+# define function to wrangle and save run/fold condition vectors (conditions x voxels)
+def save_patterns(sub, task, patterns, mask_name, run_id, splithalf_id, conditions, vectorsDir, pattern_format=('npy',)):
     patterns = np.array(patterns)
     print('Shape of extracted vector data (conditions x voxels): {}'.format(patterns.shape))
     
-    rows = []
-    for c, cond in enumerate(conditions):
+    # define output file prefix
+    if splithalf_id !=0:
+        vector_prefix = op.join(vectorsDir, '{}_task-{}_fold-{}_splithalf-{}_{}_condition_vectors'.format(sub, task, run_id, splithalf_id, mask_name))
+    else:
+        vector_prefix = op.join(vectorsDir, '{}_task-{}_fold-{}_{}_condition_vectors'.format(sub, task, run_id, mask_name))
+    
+    # save memory-mappable numpy file and/or compressed numpy file with a json sidecar describing the rows
+    if 'npz' in pattern_format or 'npy' in pattern_format:
+        info = {'sub': sub,
+                'task': task,
+                'fold': int(run_id),
+                'splithalf': int(splithalf_id),
+                'ROI': mask_name,
+                'conditions': list(conditions),
+                'shape': list(patterns.shape),
+                'dtype': str(patterns.dtype)}
+        
+        if 'npz' in pattern_format:
+            np.savez_compressed('{}.npz'.format(vector_prefix), patterns=patterns, conditions=np.array(conditions))
+            info['npz'] = op.basename('{}.npz'.format(vector_prefix))
+        
+        if 'npy' in pattern_format:
+            np.save('{}.npy'.format(vector_prefix), patterns)
+            info['npy'] = op.basename('{}.npy'.format(vector_prefix))
+        
+        with open('{}.json'.format(vector_prefix), 'w') as f:
+            json.dump(info, f, indent=4)
+    
+    # save csv file with one row per condition and one column per voxel (opt-in because these files are large and slow to read)
+    if 'csv' in pattern_format:
         if splithalf_id !=0:
-            row = {'sub': sub,
-                   'fold': run_id,
-                   'splithalf': splithalf_id,
-                   'condition': cond,
-                   'ROI': mask_name}
-            vector_file = op.join(vectorsDir, '{}_task-{}_fold-{}_splithalf-{}_{}_condition_vectors.csv'.format(sub, task, run_id, splithalf_id, mask_name))
+            df = pd.DataFrame({'sub': sub, 'fold': run_id, 'splithalf': splithalf_id, 'condition': conditions, 'ROI': mask_name})
         else:
-            row = {'sub': sub,
-                   'fold': run_id,
-                   'condition': cond,
-                   'ROI': mask_name}
-            vector_file = op.join(vectorsDir, '{}_task-{}_fold-{}_{}_condition_vectors.csv'.format(sub, task, run_id, mask_name))
-            
-        # add voxel values
-        voxels = patterns[c]
-        for v, vox in enumerate(voxels):
-            row['vox_{}'.format(v)] = vox
+            df = pd.DataFrame({'sub': sub, 'fold': run_id, 'condition': conditions, 'ROI': mask_name})
         
-        rows.append(row)
-                
-    df = pd.DataFrame(rows)
-    df.to_csv(vector_file, sep=',', index=False)        
-    print('Patterns saved to {}'.format(vectorsDir))  
+        # add voxel values
+        vox_df = pd.DataFrame(patterns, columns=['vox_{}'.format(v) for v in range(patterns.shape[1])])
+        df = pd.concat([df, vox_df], axis=1)
+        df.to_csv('{}.csv'.format(vector_prefix), sep=',', index=False)
+    
+    print('Patterns saved to {}'.format(vectorsDir))
 
 # define function to calculate dissimilarity metrics
 def calc_dissimilarity(sub, task, patterns, conditions, rdmDir, normalise):
@@ -614,6 +747,7 @@ def argparser():
                         help='Configuration file')                                            
     parser.add_argument('-m', dest='plugin',
                         help='Nipype plugin to use (default: MultiProc)')
+    parser = add_jobs_argument(parser)
     return parser
 
 # define main function that parses the config file and runs the functions defined above
@@ -648,6 +782,18 @@ def main(argv=None):
     top_nvox=config_file.loc['top_nvox',1]
     normalise=config_file.loc['normalise_rdms',1]
     
+    # maximum memory (in GB) used to hold images for each subject (optional, default 4 GB)
+    if 'image_cache_gb' in config_file.index and config_file.loc['image_cache_gb',1] is not None:
+        cache_gb = float(config_file.loc['image_cache_gb',1])
+    else:
+        cache_gb = 4
+    
+    # format(s) to save condition vectors in: npy (memory-mappable), npz, and/or csv (optional, default npy)
+    if 'pattern_format' in config_file.index and config_file.loc['pattern_format',1] is not None:
+        pattern_format = config_file.loc['pattern_format',1].replace(' ','').lower().split(',')
+    else:
+        pattern_format = ['npy']
+    
     # lowercase conditions to avoid case errors - allows flexibility in how users specify events in config and contrasts files
     conditions = [c.lower() for c in conditions]
     
@@ -671,10 +817,8 @@ def main(argv=None):
     if not op.exists(resultsDir):
         raise IOError('Results directory {} not found.'.format(resultsDir))
     
-    # initialise outputs
-    shrink_vals = []
-    
     # for each subject in the list of subjects
+    subject_args = []
     for index, sub in enumerate(args.subjects):
         print('Computing neural RDMs for {}'.format(sub))
         
@@ -693,8 +837,20 @@ def main(argv=None):
         else:
             print('Multiple runs or folds were specified, so neural RDMs will be combined across runs/folds.')
             
-        # create a process_subject workflow with the inputs defined above
-        generate_rdm(args.projDir, sharedDir, resultsDir, froiDir, sub, task, sub_runs, folds, multi_noise_norm, splithalves, conditions, mask_opts, template, normalise, top_nvox, percent, shrink_vals)
+        # save the generate_rdm inputs defined above for this subject
+        subject_args.append([args.projDir, sharedDir, resultsDir, froiDir, sub, task, sub_runs, folds, multi_noise_norm, splithalves, conditions, mask_opts, template, normalise, top_nvox, percent])
+    
+    # run generate_rdm for each subject (in parallel if more than 1 job was requested; each job uses its own image cache)
+    # shrinkage factors estimated for each subject are merged in subject order
+    # when processing in parallel, if processing failed for any subject, the shrinkage factors of the other subjects are saved before the error is raised (one at a time, the first error stops processing)
+    subject_error = None
+    try:
+        results = run_subjects(partial(generate_rdm, cache_gb=cache_gb, pattern_format=pattern_format), args.subjects, subject_args, jobs=args.jobs,
+                               logDir=op.join(resultsDir, 'logs', 'compute_neural_rdms'), accumulators=['shrink_vals'])
+    except SubjectsFailedError as err:
+        subject_error = err
+        results = err.results
+    shrink_vals = results['shrink_vals']
     
     # save estimated shrinkage factors if multivariate noise normalisation requested
     if multi_noise_norm == 'yes':
@@ -710,6 +866,9 @@ def main(argv=None):
         shrink_df.to_csv(shrink_file, index=False)
         
         print('Estimated shrinkage factors saved to: {}'.format(shrink_file))
+    
+    if subject_error is not None:
+        raise subject_error
         
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':
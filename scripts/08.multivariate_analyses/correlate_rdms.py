@@ -15,6 +15,11 @@ import os.path as op
 import os
 import glob
 import shutil
+from kendall_tau import kendall_tau_a
+
+# add misc folder to path to import shared subject executor functions
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from subject_executor import add_jobs_argument, run_subjects
 
 def correlate_rdms(projDir, sharedDir, dataset, resultsDir, sub, mask_opts, subject_rdms, model_rdms):
     
@@ -190,33 +195,6 @@ def vectorise_rdm(dat, diag):
     # k=0  will include diagonal; k=1 will exclude diagonal
     return dat.values[np.triu_indices_from(dat, k=diag)]
 
-# define function to calculate Kendall's tau-a
-def kendall_tau_a(neural_vec, model_vec):
-    n = len(neural_vec)
-    
-    # pairwise differences
-    neural_diff = neural_vec[:, None] - neural_vec
-    model_diff = model_vec[:, None] - model_vec
-    
-    # calculate concordance/discordance
-    #discord = neural_diff * model_diff
-    discord = np.sign(neural_diff) * np.sign(model_diff)
-    
-    # take the upper triangle only (excluding diagonal)
-    tri_indx = np.triu_indices(n, k=1)
-    
-    # extract concordant and discordant values
-    # C = np.sum(discord[tri_indx] > 0)
-    # D = np.sum(discord[tri_indx] < 0)
-    # numerator (ties naturally become 0 because sign(0)=0)
-    numerator = np.sum(discord[tri_indx])
-    
-    # use values in kendall's tau-a formula
-    # tau_a = (C - D) / (n * (n - 1) / 2)
-    tau_a = numerator / (n * (n - 1) / 2)
-    
-    return tau_a
-
 # define command line parser function
 def argparser():
     # create an instance of ArgumentParser
@@ -234,6 +212,7 @@ def argparser():
                         help='Configuration file')                                            
     parser.add_argument('-m', dest='plugin',
                         help='Nipype plugin to use (default: MultiProc)')
+    parser = add_jobs_argument(parser)
     return parser
 
 # define main function that parses the config file and runs the functions defined above
@@ -273,11 +252,15 @@ def main(argv=None):
         raise IOError('Results directory {} not found.'.format(resultsDir))
         
     # for each subject in the list of subjects
+    subject_args = []
     for index, sub in enumerate(args.subjects):
         print('Correlating neural and model RDMs for {}'.format(sub))
         
-        # create a process_subject workflow with the inputs defined above
-        correlate_rdms(args.projDir, sharedDir, dataset, resultsDir, sub, mask_opts, subject_rdms, model_rdms)
+        # save the correlate_rdms inputs defined above for this subject
+        subject_args.append([args.projDir, sharedDir, dataset, resultsDir, sub, mask_opts, subject_rdms, model_rdms])
+    
+    # run correlate_rdms for each subject (in parallel if more than 1 job was requested)
+    run_subjects(correlate_rdms, args.subjects, subject_args, jobs=args.jobs, logDir=op.join(resultsDir, 'logs', 'correlate_rdms'))
 
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':
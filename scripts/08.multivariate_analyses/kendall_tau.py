@@ -0,0 +1,136 @@
+"""
+Kendall's tau functions shared by the multivariate analysis scripts
+
+Tau is calculated with Knight's O(n log n) algorithm (sort by one vector, then count the discordant pairs as inversions in the other) rather than by building n x n difference matrices.
+Ties are handled for both tau-a (ties count as neither concordant nor discordant) and tau-b (the denominator is adjusted for ties).
+kendall_tau_batch scores one vector against each row of a matrix of vectors (or pairs up the rows of two matrices) in one call, which is used in the iteration and permutation loops.
+Tau is NaN for any pair of vectors that contains a NaN value (as with the pairwise calculation the scripts used previously), so missing values are never ranked as real values.
+
+The scripts in this folder import these functions directly (e.g., from kendall_tau import kendall_tau_a)
+
+"""
+import numpy as np
+
+# define function to rank the values in each row of a 2D array (tied values share the lowest rank)
+def _rank_rows(dat):
+    nrows, n = dat.shape
+    
+    # sort values in each row
+    order = np.argsort(dat, axis=1, kind='stable')
+    sorted_vals = np.take_along_axis(dat, order, axis=1)
+    
+    # rank of each sorted value is the position of the first value it is tied with
+    is_new = np.ones((nrows, n), dtype=bool)
+    is_new[:, 1:] = sorted_vals[:, 1:] != sorted_vals[:, :-1]
+    sorted_ranks = np.maximum.accumulate(np.where(is_new, np.arange(n), 0), axis=1)
+    
+    # return ranks in the original order
+    ranks = np.empty((nrows, n), dtype=np.int64)
+    np.put_along_axis(ranks, order, sorted_ranks, axis=1)
+    
+    return ranks
+
+# define function to count the number of tied pairs in each row of a 2D array (rows must already be sorted)
+def _count_tied_pairs(sorted_dat):
+    nrows, n = sorted_dat.shape
+    
+    # each value is tied with every preceding value in its group, so summing these gives t*(t-1)/2 for each group of t ties
+    is_new = np.ones((nrows, n), dtype=bool)
+    is_new[:, 1:] = sorted_dat[:, 1:] != sorted_dat[:, :-1]
+    group_start = np.maximum.accumulate(np.where(is_new, np.arange(n), 0), axis=1)
+    
+    return (np.arange(n) - group_start).sum(axis=1)
+
+# define function to count the pairs i < j where ranks[i] > ranks[j] in each row of a 2D array (using a bottom-up merge sort)
+def _count_inversions(ranks):
+    nrows, n = ranks.shape
+    
+    # pad rows to a power of 2 with a value larger than any rank (padding at the end adds no inversions)
+    size = 1
+    while size < n:
+        size *= 2
+    dat = np.full((nrows, size), n, dtype=np.int64)
+    dat[:, :n] = ranks
+    
+    inversions = np.zeros(nrows, dtype=np.int64)
+    width = 1
+    while width < size:
+        # pair up neighbouring sorted blocks (left, right) of the current width
+        nblocks = size // (2 * width)
+        blocks = dat.reshape(nrows, nblocks, 2, width)
+        left = blocks[:, :, 0, :]
+        right = blocks[:, :, 1, :]
+        
+        # offset each block so the left blocks of all rows form one sorted array that can be searched in one call
+        block_id = np.arange(nrows * nblocks).reshape(nrows, nblocks, 1)
+        left_keys = (left + block_id * (n + 1)).ravel()
+        right_keys = (right + block_id * (n + 1)).ravel()
+        
+        # number of values in the left block that are greater than each value in the right block
+        n_le = np.searchsorted(left_keys, right_keys, side='right').reshape(right.shape) - block_id * width
+        inversions += (width - n_le).sum(axis=(1, 2))
+        
+        # merge the blocks
+        dat = np.sort(blocks.reshape(nrows, nblocks, 2 * width), axis=2).reshape(nrows, size)
+        width *= 2
+    
+    return inversions
+
+# define function to calculate Kendall's tau between one vector and each row of a matrix (or between matching rows of two matrices)
+def kendall_tau_batch(x_vec, y_mat, variant='a'):
+    x_mat = np.atleast_2d(np.asarray(x_vec, dtype=float))
+    y_mat = np.atleast_2d(np.asarray(y_mat, dtype=float))
+    nrows, n = y_mat.shape
+    
+    if x_mat.shape[1] != n or x_mat.shape[0] not in [1, nrows]:
+        raise ValueError('Vectors must be the same length to calculate Kendall\'s tau ({} and {})'.format(x_mat.shape, y_mat.shape))
+    
+    # pairs of vectors with NaN values (tau is set to NaN for these pairs below)
+    nan_rows = np.isnan(x_mat).any(axis=1) | np.isnan(y_mat).any(axis=1)
+    
+    # rank values (ranks preserve ties, so the counts below are unchanged)
+    x_ranks = np.broadcast_to(_rank_rows(x_mat), (nrows, n))
+    y_ranks = _rank_rows(y_mat)
+    
+    # sort each row by x and then by y (pairs tied in x are ordered by y, so they are not counted as discordant)
+    order = np.lexsort((y_ranks, x_ranks), axis=-1)
+    x_sorted = np.take_along_axis(x_ranks, order, axis=1)
+    y_sorted = np.take_along_axis(y_ranks, order, axis=1)
+    
+    # total pairs, pairs tied in x, pairs tied in y, and pairs tied in both
+    n0 = n * (n - 1) / 2
+    n1 = _count_tied_pairs(np.sort(x_ranks, axis=1))
+    n2 = _count_tied_pairs(np.sort(y_ranks, axis=1))
+    n3 = _count_tied_pairs(x_sorted * n + y_sorted)
+    
+    # discordant pairs are inversions in y after sorting by x
+    D = _count_inversions(y_sorted)
+    
+    # concordant minus discordant pairs (C = n0 - n1 - n2 + n3 - D)
+    numerator = n0 - n1 - n2 + n3 - 2 * D
+    
+    # use values in kendall's tau formula
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if variant == 'a':
+            tau = numerator / n0
+        elif variant == 'b':
+            tau = numerator / np.sqrt((n0 - n1) * (n0 - n2))
+        else:
+            raise ValueError('Unrecognised Kendall\'s tau variant: {}'.format(variant))
+    
+    tau = np.asarray(tau, dtype=float)
+    tau[nan_rows] = np.nan
+    
+    return tau
+
+# define function to calculate Kendall's tau between two vectors
+def kendall_tau(x_vec, y_vec, variant='a'):
+    return float(kendall_tau_batch(x_vec, y_vec, variant)[0])
+
+# define function to calculate Kendall's tau-a
+def kendall_tau_a(x_vec, y_vec):
+    return kendall_tau(x_vec, y_vec, variant='a')
+
+# define function to calculate Kendall's tau-b
+def kendall_tau_b(x_vec, y_vec):
+    return kendall_tau(x_vec, y_vec, variant='b')
@@ -29,6 +29,9 @@ Usage() {
 	echo "sub-002 1,2"
 	echo "..."
 	echo
+	echo "Any additional options are passed to the pipeline script, e.g. to process 4 subjects in parallel (where supported):"
+	echo "./run_multivariate.sh <pipeline script> <configuration file name> <subject-run list> -j 4"
+	echo
 	echo
 	echo "This script must be run within the /RichardsonLab/ directory on the server due to space requirements."
 	echo "The script will terminiate if run outside of the /RichardsonLab/ directory."
@@ -134,4 +137,4 @@ ${singularityDir}/nipype_nilearn.simg					\
 -o ${outDir}											\
 -s ${subjs}												\
 -r ${runs}												\
--c ${projDir}/${config} | tee ${log_file}
+-c ${projDir}/${config} "${@:4}" | tee ${log_file}
@@ -0,0 +1,99 @@
+"""
+Functions to detect artifact volumes in a functional run as an alternative to the nipype rapidart ArtifactDetect node (used by mark_motion_exclusions.py)
+
+Volumes are marked as artifacts using the same options previously passed to ArtifactDetect (mask_type file, use_norm, parameter_source SPM, use_differences [True, False]):
+    1. the global intensity of each volume is the mean within the brain mask, and volumes with a z-scored (detrended) global intensity above the intensity threshold are artifacts
+    2. the composite motion norm of each volume is the largest displacement of the midpoints of the faces of a cube between successive volumes, and volumes with a norm above the norm threshold are artifacts
+The intensity is not differenced between successive volumes (use_differences[1] is False), unless use_intensity_differences is set to True.
+
+The global intensity is calculated by reading blocks of volumes from the functional file, so the full run is never loaded into memory (uncompressed files are memory mapped and compressed files are read once from start to end).
+The motion norm is calculated from the realignment parameters in the confounds file, so a motion parameters file doesn't need to be written.
+The outputs are saved with the same file names as ArtifactDetect (art.*_outliers.txt, global_intensity.*.txt, norm.*.txt).
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from artifact_detect import detect_artifacts
+
+"""
+import os
+import os.path as op
+import numpy as np
+import nibabel as nib
+from scipy import signal
+from temporal_view import iter_volume_blocks
+
+# define function to return the file name used in the ArtifactDetect output file names (file name without the extension)
+def art_file_name(in_file):
+    filename = op.basename(in_file)
+    for ext in ['.nii.gz', '.nii', '.gz']:
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return op.splitext(filename)[0]
+
+# define function to calculate the mean intensity within the mask for each volume
+def global_intensity(in_file, mask_file, block_mb=64):
+    mask = nib.load(mask_file).get_fdata(dtype=np.float32) > 0.5
+    shape = nib.load(in_file).shape
+    if mask.shape[:3] != shape[:3]:
+        raise ValueError('Mask {} has dimensions {} but the functional file {} has dimensions {}'.format(mask_file, mask.shape[:3], in_file, shape[:3]))
+    
+    # voxels are saved in fortran order
+    mask = mask.reshape(shape[:3]).ravel(order='F')
+    
+    g = []
+    for block in iter_volume_blocks(in_file, block_mb=block_mb):
+        g.append(np.nanmean(block[:, mask], axis=1, dtype=np.float64))
+    return np.concatenate(g)
+
+# define function to return the affine matrix of a set of SPM realignment parameters (3 translations in mm, 3 rotations in radians)
+def motion_affine(params):
+    rotate = lambda x: np.array([[np.cos(x), np.sin(x)], [-np.sin(x), np.cos(x)]])
+    T = np.eye(4)
+    T[0:3, -1] = params[0:3]
+    Rx = np.eye(4)
+    Rx[1:3, 1:3] = rotate(params[3])
+    Ry = np.eye(4)
+    Ry[(0, 0, 2, 2), (0, 2, 0, 2)] = rotate(params[4]).ravel()
+    Rz = np.eye(4)
+    Rz[0:2, 0:2] = rotate(params[5])
+    return T @ Rx @ Ry @ Rz
+
+# define function to calculate the composite motion norm of each volume from the realignment parameters (volumes x 6 parameters)
+def composite_norm(motion_params):
+    motion_params = np.asarray(motion_params, dtype=np.float64)
+    
+    # midpoints of the faces of a cube around the brain (mm)
+    pts = np.vstack((np.hstack((np.diag([70, 70, 75]), np.diag([-70, -110, -45]))), np.ones((1, 6))))
+    
+    # position of each point after moving, and the distance moved by each point between successive volumes
+    newpos = np.stack([(motion_affine(p) @ pts)[0:3] for p in motion_params])
+    diffs = np.concatenate((np.zeros((1,) + newpos.shape[1:]), np.diff(newpos, axis=0)), axis=0)
+    return np.sqrt((diffs**2).sum(axis=1)).max(axis=1)
+
+# define function to detect artifacts in a run, saving the outputs to out_dir (returns the outlier file and the number of outliers)
+def detect_artifacts(in_file, mask_file, motion_params, out_dir, norm_threshold, zintensity_threshold, use_intensity_differences=False, block_mb=64):
+    os.makedirs(out_dir, exist_ok=True)
+    
+    # z-score the detrended global intensity (or the differences between successive volumes when use_intensity_differences is True)
+    g = global_intensity(in_file, mask_file, block_mb)
+    if len(g) != len(motion_params):
+        raise ValueError('{} has {} volumes but there are motion parameters for {} volumes'.format(in_file, len(g), len(motion_params)))
+    gz = signal.detrend(g)
+    if use_intensity_differences:
+        gz = np.concatenate(([0], np.diff(gz)))
+    gz = (gz - np.mean(gz)) / np.std(gz)
+    iidx = np.flatnonzero(np.abs(gz) > zintensity_threshold)
+    
+    # composite motion norm
+    normval = composite_norm(motion_params)
+    tidx = np.flatnonzero(normval > norm_threshold)
+    
+    outliers = np.union1d(iidx, tidx)
+    
+    name = art_file_name(in_file)
+    art_file = op.join(out_dir, 'art.{}_outliers.txt'.format(name))
+    np.savetxt(art_file, outliers, fmt='%d', delimiter=' ')
+    np.savetxt(op.join(out_dir, 'global_intensity.{}.txt'.format(name)), g, fmt='%.2f', delimiter=' ')
+    np.savetxt(op.join(out_dir, 'norm.{}.txt'.format(name)), normval, fmt='%.4f', delimiter=' ')
+    
+    return art_file, len(outliers)
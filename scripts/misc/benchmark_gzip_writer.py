@@ -0,0 +1,86 @@
+"""
+Benchmark the parallel gzip NIfTI writer (parallel_gzip.py) against nib.save
+
+A random 4D image (or a 4D image provided by the user) is saved as a .nii.gz file with nib.save and with save_nifti, and the time and throughput (MB of uncompressed data per second) of each writer are reported.
+The files saved by save_nifti are read back with nibabel to confirm that the data match the input image.
+
+Example call:
+python benchmark_gzip_writer.py --shape 97 115 97 300 --threads 1 4 8 --repeats 3
+
+"""
+import os.path as op
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import nibabel as nib
+from parallel_gzip import save_nifti
+
+# define function to time a writer, returning the fastest time across repeats
+def time_writer(writer, repeats):
+    times = []
+    for r in range(repeats):
+        start = time.perf_counter()
+        writer()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def argparser():
+    # create an instance of ArgumentParser
+    parser = argparse.ArgumentParser()
+    # attach argument specifications to parser
+    parser.add_argument('-i', dest='in_file', default=None,
+                        help='4D image to save (default: a random image with the requested shape)')
+    parser.add_argument('--shape', dest='shape', type=int, nargs=4, default=[97, 115, 97, 200],
+                        help='Shape of the random image (default: 97 115 97 200)')
+    parser.add_argument('--threads', dest='threads', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='Numbers of threads to test (default: 1 2 4 8)')
+    parser.add_argument('--level', dest='level', type=int, default=1,
+                        help='Compression level used by save_nifti (default: 1, the level used by nib.save)')
+    parser.add_argument('--repeats', dest='repeats', type=int, default=3,
+                        help='Number of times each writer is run (the fastest time is reported)')
+    return parser
+
+def main(argv=None):
+    # call argparser function that defines command line inputs
+    parser = argparser()
+    args = parser.parse_args(argv)
+    
+    # load or generate image (random data with a smooth mean so the data compress similarly to fMRI data)
+    if args.in_file:
+        img = nib.load(args.in_file)
+        img = nib.Nifti1Image(np.asanyarray(img.dataobj), img.affine, img.header)
+    else:
+        rng = np.random.default_rng(0)
+        mean_img = rng.uniform(500, 1500, args.shape[:3]).astype(np.float32)
+        dat = mean_img[..., np.newaxis] + rng.normal(0, 20, args.shape).astype(np.float32)
+        img = nib.Nifti1Image(dat, np.eye(4))
+    dat = np.asanyarray(img.dataobj)
+    size_mb = dat.nbytes / 1024**2
+    
+    print('Saving image with shape {} ({:.0f}MB uncompressed), compression level {}'.format(dat.shape, size_mb, args.level))
+    
+    tmpDir = tempfile.mkdtemp()
+    try:
+        # default writer
+        ref_file = op.join(tmpDir, 'nibabel.nii.gz')
+        ref_time = time_writer(lambda: nib.save(img, ref_file), args.repeats)
+        print('nib.save: {:.2f}s ({:.0f}MB/s), file size {:.0f}MB'.format(ref_time, size_mb / ref_time, op.getsize(ref_file) / 1024**2))
+        
+        # parallel writer
+        for n_threads in args.threads:
+            out_file = op.join(tmpDir, 'parallel_{}.nii.gz'.format(n_threads))
+            par_time = time_writer(lambda: save_nifti(img, out_file, n_threads=n_threads, compress_level=args.level), args.repeats)
+            
+            # check that the saved data match the input
+            if not np.array_equal(np.asanyarray(nib.load(out_file).dataobj), dat):
+                raise ValueError('Data saved with {} threads do not match the input image'.format(n_threads))
+            
+            print('save_nifti ({} threads): {:.2f}s ({:.0f}MB/s, {:.1f}x nib.save), file size {:.0f}MB'.format(n_threads, par_time, size_mb / par_time, ref_time / par_time, op.getsize(out_file) / 1024**2))
+    finally:
+        shutil.rmtree(tmpDir)
+
+# execute code when file is run as script (the conditional statement is TRUE when script is run in python)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark the native GLM (native_glm.py) against FSL FILMGLS for a run
+
+The native GLM is fit to a run using the design and contrast files from the firstlevel pipeline, and the outputs are compared with the FILMGLS outputs for the same run (the model folder of the run in the resultsDir, or the results folder of a film_gls call when --film is used).
+For each output, the correlation across voxels and the median relative difference within the voxels fit by both models are reported, along with the time taken by each model.
+Because the native GLM uses an AR(1) noise model rather than the FILM Tukey taper, the estimates should agree closely but not exactly (e.g., correlations above 0.99 for the parameter estimates and copes).
+
+The autocorrelation estimates of the native GLM are smoothed with the smoothing kernel used by the firstlevel pipeline (--fwhm, from the smoothing option in the config file), as done by the pipeline when it calls the native GLM (film_gls smooths them with --sa).
+
+Example call (using the outputs of a run fit with FILMGLS):
+python benchmark_native_glm.py -i sub-01_task-x_run-01_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold_smooth_scaled.nii.gz -d design/run1/run1.mat -t design/run1/run1.con -f model/run1 --fwhm 5 --threads 4
+
+Example call (running film_gls, which requires FSL):
+python benchmark_native_glm.py -i run1_scaled.nii.gz -d run1.mat -t run1.con --fwhm 5 --film --threads 4
+
+"""
+import os.path as op
+import time
+import glob
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import nibabel as nib
+from native_glm import run_glm
+
+# define function to load a 3D output image as a vector
+def _load(in_file):
+    dat = np.asanyarray(nib.load(in_file).dataobj)
+    return dat.reshape(dat.shape[:3]).astype(np.float64).ravel()
+
+# define function to compare an output of the native GLM with the FILMGLS output within the voxels fit by both models
+def compare_output(native_file, film_file, mask):
+    native = _load(native_file)[mask]
+    film = _load(film_file)[mask]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel = np.abs(native - film) / np.abs(film)
+    return {'correlation': float(np.corrcoef(native, film)[0, 1]),
+            'median_rel_diff': float(np.nanmedian(rel[np.isfinite(rel)])),
+            'native_mean': float(native.mean()),
+            'film_mean': float(film.mean())}
+
+# define function to run film_gls with the options used by the firstlevel pipeline
+def run_film(in_file, design_file, tcon_file, out_dir, threshold=1000):
+    cmd = ['film_gls', '--in={}'.format(in_file), '--pd={}'.format(design_file), '--con={}'.format(tcon_file),
+           '--thr={}'.format(threshold), '--rn={}'.format(out_dir), '--sa']
+    subprocess.run(cmd, check=True, stdout=subprocess.PIPE)
+    return out_dir
+
+def argparser():
+    # create an instance of ArgumentParser
+    parser = argparse.ArgumentParser()
+    # attach argument specifications to parser
+    parser.add_argument('-i', dest='in_file',
+                        help='Scaled 4D run passed to the GLM')
+    parser.add_argument('-d', dest='design_file',
+                        help='Design matrix (.mat) for the run')
+    parser.add_argument('-t', dest='tcon_file',
+                        help='Contrast file (.con) for the run')
+    parser.add_argument('-m', dest='mask_file', default=None,
+                        help='Mask used by the native GLM (default: voxels above the intensity threshold)')
+    parser.add_argument('-f', dest='film_dir', default=None,
+                        help='Folder with FILMGLS outputs for the run (e.g., the model folder of the run in the resultsDir)')
+    parser.add_argument('--film', action='store_true',
+                        help='Run film_gls to create and time the FILMGLS outputs (requires FSL)')
+    parser.add_argument('--fwhm', dest='fwhm', type=float, required=True,
+                        help='Smoothing kernel size (mm) used by the firstlevel pipeline, used to smooth the native GLM autocorrelation estimates')
+    parser.add_argument('--threads', dest='threads', type=int, default=1,
+                        help='Number of threads used by the native GLM (default: 1)')
+    return parser
+
+def main(argv=None):
+    # call argparser function that defines command line inputs
+    parser = argparser()
+    args = parser.parse_args(argv)
+    
+    if not args.film and not args.film_dir:
+        raise ValueError('Provide a folder with FILMGLS outputs (-f) or run film_gls (--film)')
+    
+    tmpDir = tempfile.mkdtemp()
+    try:
+        # FILMGLS outputs
+        film_dir = args.film_dir
+        if args.film:
+            film_dir = op.join(tmpDir, 'film')
+            start = time.perf_counter()
+            run_film(args.in_file, args.design_file, args.tcon_file, film_dir)
+            print('film_gls: {:.1f}s'.format(time.perf_counter() - start))
+        
+        # native GLM outputs
+        start = time.perf_counter()
+        outputs = run_glm(args.in_file, args.design_file, args.tcon_file, op.join(tmpDir, 'native'), mask_file=args.mask_file, smooth_autocorr=True, fwhm=args.fwhm, n_threads=args.threads)
+        print('native GLM ({} threads): {:.1f}s'.format(args.threads, time.perf_counter() - start))
+        
+        # compare outputs within the voxels fit by both models (voxels with residual variance above 0)
+        film_ss = glob.glob(op.join(film_dir, 'sigmasquareds.nii*'))[0]
+        mask = (_load(outputs['sigmasquareds']) > 0) & (_load(film_ss) > 0)
+        print('Comparing outputs in {} voxels'.format(mask.sum()))
+        
+        names = ['sigmasquareds'] + [op.basename(f).split('.')[0] for f in outputs['param_estimates'] + outputs['copes'] + outputs['varcopes'] + outputs['zstats']]
+        for name in names:
+            film_file = glob.glob(op.join(film_dir, '{}.nii*'.format(name)))
+            if not film_file:
+                print('{}: no FILMGLS output found'.format(name))
+                continue
+            native_file = glob.glob(op.join(tmpDir, 'native', '{}.nii*'.format(name)))[0]
+            stats = compare_output(native_file, film_file[0], mask)
+            print('{}: correlation {:.4f}, median relative difference {:.2%} (mean native {:.3g}, FILMGLS {:.3g})'.format(name, stats['correlation'], stats['median_rel_diff'], stats['native_mean'], stats['film_mean']))
+    finally:
+        shutil.rmtree(tmpDir)
+
+# execute code when file is run as script (the conditional statement is TRUE when script is run in python)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Benchmark the scrub-padding step used in the timecourse pipeline
+
+This script generates a synthetic denoised run and compares two ways of padding scrubbed volumes with nans:
+(1) the previous per-volume approach (index_img for each retained volume, nan image for each scrubbed volume, then concat_imgs)
+(2) the vectorized approach used in timecourse_pipeline.denoise_data (one preallocated float32 nan array filled with a single boolean-mask assignment)
+
+Both outputs are checked for equality and the run times are printed. No data are written to disk.
+
+Example:
+python benchmark_scrub_padding.py -d 64 64 40 -v 800 -f 0.1
+
+"""
+import time
+import argparse
+import numpy as np
+import nibabel as nib
+from nilearn import image
+
+# define function to pad volumes one at a time (previous approach)
+def pad_per_volume(denoise_img, vol_indx, curVols):
+    # create nan volume
+    nan_vol = np.empty((denoise_img.shape[:-1]))
+    nan_vol[:] = np.nan
+    nan_img = image.new_img_like(denoise_img, nan_vol, affine=denoise_img.affine)
+
+    # pad denoised data with nan vols where vols were scrubbed
+    d=0
+    pad_imgs = list()
+    for vol in np.arange(curVols, dtype=np.int64):
+        if vol in vol_indx:
+            pad_imgs.append(image.index_img(denoise_img, d))
+            d += 1
+        else:
+            pad_imgs.append(nan_img)
+
+    return image.concat_imgs(pad_imgs)
+
+# define function to pad volumes with a single boolean-mask assignment (current approach)
+def pad_vectorized(denoise_img, vol_indx, curVols):
+    # boolean vector of retained volumes
+    keep_vols = np.zeros(curVols, dtype=bool)
+    keep_vols[np.asarray(vol_indx, dtype=np.int64)] = True
+
+    # write retained volumes into preallocated nan array
+    denoised_arr = np.asanyarray(denoise_img.dataobj)
+    pad_arr = np.full(denoised_arr.shape[:3] + (curVols,), np.nan, dtype=np.float32)
+    pad_arr[..., keep_vols] = denoised_arr
+
+    return nib.Nifti1Image(pad_arr, denoise_img.affine, denoise_img.header)
+
+# define command line parser function
+def argparser():
+    # create an instance of ArgumentParser
+    parser = argparse.ArgumentParser()
+    # attach argument specifications to the parser
+    parser.add_argument('-d', dest='dims', nargs=3, type=int, default=[64, 64, 40],
+                        help='Spatial dimensions of the synthetic run (default: 64 64 40)')
+    parser.add_argument('-v', dest='nvols', type=int, default=800,
+                        help='Number of volumes in the synthetic run (default: 800)')
+    parser.add_argument('-f', dest='scrub_frac', type=float, default=0.1,
+                        help='Fraction of volumes to scrub (default: 0.1)')
+    parser.add_argument('-n', dest='repeats', type=int, default=3,
+                        help='Number of timed repeats for each approach (default: 3)')
+    parser.add_argument('-seed', dest='seed', type=int, default=0,
+                        help='Random seed used to generate the synthetic data')
+    return parser
+
+# define main function that generates the synthetic data and times each approach
+def main(argv=None):
+    # call argparser function that defines command line inputs
+    parser = argparser()
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+
+    # select volumes to retain (scrubbed volumes are removed, as with clean_img sample_mask)
+    nscrub = int(args.nvols * args.scrub_frac)
+    scrubbed = rng.choice(args.nvols, size=nscrub, replace=False)
+    vol_indx = np.delete(np.arange(args.nvols, dtype=np.int64), scrubbed)
+
+    # generate synthetic denoised data (one volume per retained index)
+    print('Generating synthetic run: {} x {} volumes ({} scrubbed)'.format(tuple(args.dims), args.nvols, nscrub))
+    denoised = rng.standard_normal(tuple(args.dims) + (len(vol_indx),), dtype=np.float32)
+    denoise_img = nib.Nifti1Image(denoised, np.eye(4))
+
+    # time each approach
+    timings = {}
+    outputs = {}
+    for name, func in [('per-volume', pad_per_volume), ('vectorized', pad_vectorized)]:
+        times = []
+        for rep in range(args.repeats):
+            start = time.perf_counter()
+            out_img = func(denoise_img, vol_indx, args.nvols)
+            out_data = np.asanyarray(out_img.dataobj)
+            times.append(time.perf_counter() - start)
+        timings[name] = min(times)
+        outputs[name] = out_data
+        print('{}: best of {} = {:.3f}s'.format(name, args.repeats, timings[name]))
+
+    # check that both approaches produce the same padded data (nans in the same place)
+    match = np.allclose(outputs['per-volume'], outputs['vectorized'], equal_nan=True)
+    print('Outputs match: {}'.format(match))
+    print('Speedup: {:.1f}x'.format(timings['per-volume'] / timings['vectorized']))
+
+# execute code when file is run as script (the conditional statement is TRUE when script is run in python)
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,7 @@
 Compiles stats csv files within a results directory into a single csv file
 
 At the moment, this script will process any *mean* stats (skipping voxelwise stats files) for every
-subject in the resultsDir provided in the config file. The output is a single compiled_stats.csv file in the resultsDir.
+subject in the resultsDir provided in the config file. The output is a single compiled_stats.csv (or compiled_stats.parquet) file in the resultsDir.
 
 """
 import os
@@ -12,9 +12,10 @@ import argparse
 import pandas as pd
 import glob
 import sys
+from stats_table import read_stats, write_stats, stats_extension
 
 # define compilation function
-def compile_stats(projDir, resultsDir, extract_opt):
+def compile_stats(projDir, resultsDir, extract_opt, stats_format='csv'):
     
     print('Searching for {} stats files in {}'.format(extract_opt, resultsDir))
 
@@ -31,8 +32,10 @@ def compile_stats(projDir, resultsDir, extract_opt):
         
         print('Compiling stats for sub-{}'.format(sub))
 
-        # define stats files in subject folder
-        stats_files = glob.glob(op.join(result, 'stats', '*{}*.csv'.format(extract_opt)))
+        # define stats files in subject folder (parquet files are used if there are any, otherwise csv files, so stats saved in both formats aren't counted twice)
+        stats_files = glob.glob(op.join(result, 'stats', '*{}*.parquet'.format(extract_opt)))
+        if not stats_files:
+            stats_files = glob.glob(op.join(result, 'stats', '*{}*.csv'.format(extract_opt)))
         
         if not stats_files:
             print('No stats files found for sub-{}'.format(sub))
@@ -40,8 +43,8 @@ def compile_stats(projDir, resultsDir, extract_opt):
             
         # extract stats from each file in directory
         for s, stat in enumerate(stats_files):
-            # read in csv file
-            stats_dat = pd.read_csv(stat) # header=None
+            # read in csv or parquet file
+            stats_dat = read_stats(stat)
                 
             # merge with compiled stats
             compiled_stats.append(stats_dat)
@@ -52,9 +55,9 @@ def compile_stats(projDir, resultsDir, extract_opt):
     else:
         compiled_df = pd.concat(compiled_stats, ignore_index=True).sort_values(by=['sub', 'task', 'run', 'contrast', 'mask']).reset_index(drop=True)
     
-    # save as csv file in resultsDir
-    compiled_file = op.join(resultsDir, 'compiled_stats.csv')
-    compiled_df.to_csv(compiled_file, index=False)
+    # save as csv or parquet file in resultsDir
+    compiled_file = op.join(resultsDir, 'compiled_stats.{}'.format(stats_extension(stats_format)))
+    write_stats(compiled_df, compiled_file)
 
 # define command line parser function
 def argparser():
@@ -86,11 +89,17 @@ def main(argv=None):
     extract_opt=config_file.loc['extract',1]
     resultsDir=config_file.loc['resultsDir',1]
     
+    # file format for stats tables: csv or parquet (optional, default csv)
+    if 'stats_format' in config_file.index and config_file.loc['stats_format',1] is not None:
+        stats_format=config_file.loc['stats_format',1]
+    else:
+        stats_format='csv'
+    
     # remove percent signal change flag if in config file
     extract_opt = extract_opt.replace('-psc', '')
     
     # pass inputs defined above to main resampling function
-    compile_stats(args.projDir, resultsDir, extract_opt)
+    compile_stats(args.projDir, resultsDir, extract_opt, stats_format)
    
 # execute code when file is run as script (the conditional statement is TRUE when script is run in python)
 if __name__ == '__main__':
@@ -0,0 +1,193 @@
+"""
+Functions to build first-level design matrices in python as an alternative to the FSL Level1Design and FEATModel nodes (used by firstlevel_pipeline.py when design_engine is native in the config file)
+
+The design is built following the FEAT conventions:
+    1. task events are convolved with a double-gamma HRF (gamma functions with a 6s peak and a 16s undershoot, with a 1/6 undershoot ratio) and sampled in the middle of each volume
+    2. confound regressors and ART outlier spikes (added to the model information by SpecifyModel) are added without convolution
+    3. all regressors are high pass filtered (using the gaussian-weighted running line filter used by fslmaths -bptf) and demeaned
+The design.mat and design.con files are saved in the FSL format (including the PPheights used by calc_psc.py), along with pe_names.json.
+At least 1 contrast is required, as the contrast file is used by the GLM (an error is raised if no contrasts are provided for a run).
+
+Sparse models are always built with the FSL nodes: SpecifySparseModel converts the conditions into regressors that are already convolved and sampled at the acquisition times, so the conditions named in the contrasts aren't in the model information used here.
+
+The convolved task regressors only depend on the events, TR, number of volumes, and filter cutoff, so they are saved to a cache directory and reused across runs and subjects with identical paradigms.
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from design_builder import build_design
+
+"""
+import os
+import os.path as op
+import json
+import hashlib
+import numpy as np
+from functools import lru_cache
+from scipy import stats
+
+# define function to return the double-gamma HRF sampled every dt seconds (scaled to sum to 1, so a sustained block of events has a height of 1)
+def double_gamma_hrf(dt, length=32):
+    t = np.arange(0, length, dt)
+    hrf = stats.gamma.pdf(t, 6) - stats.gamma.pdf(t, 16) / 6
+    return hrf / hrf.sum()
+
+# define function to return the high pass filter matrix for a number of volumes (filter cutoff in seconds)
+@lru_cache(maxsize=None)
+def highpass_matrix(nVols, TR, hpf):
+    # the filter removes a line fit to the data within a gaussian window around each time point (window sigma in volumes, as used by fslmaths -bptf)
+    sigma = hpf / (2.0 * TR)
+    half_width = int(sigma * 3)
+    
+    t = np.arange(nVols)
+    F = np.eye(nVols)
+    for i in range(nVols):
+        idx = t[max(i - half_width, 0):min(i + half_width + 1, nVols)]
+        w = np.exp(-0.5 * ((idx - i) / sigma)**2)
+        
+        # weighted least squares line fit, evaluated at time point i
+        A = np.column_stack([np.ones(len(idx)), idx - i])
+        AtW = A.T * w
+        F[i, idx] -= np.linalg.solve(AtW @ A, AtW)[0]
+    
+    return F
+
+# define function to filter (optional) and demean the columns of a design matrix
+def filter_and_demean(X, TR, hpf):
+    if X.shape[1] == 0:
+        return X
+    if hpf and hpf > 0:
+        X = highpass_matrix(X.shape[0], float(TR), float(hpf)) @ X
+    return X - X.mean(axis=0)
+
+# define function to convolve task events with the HRF and sample the regressors at each volume
+def convolve_events(conditions, onsets, durations, amplitudes, TR, nVols, dt=0.05):
+    hrf = double_gamma_hrf(dt)
+    n_hires = int(np.ceil(nVols * TR / dt)) + 1
+    
+    # sample the middle of each volume
+    sample_idx = np.round((np.arange(nVols) * TR + TR / 2.0) / dt).astype(int)
+    
+    X = np.zeros((nVols, len(conditions)))
+    for i, cond in enumerate(conditions):
+        boxcar = np.zeros(n_hires)
+        # a single duration or amplitude applies to all events of the condition
+        durs = durations[i] if len(durations[i]) != 1 else list(durations[i]) * len(onsets[i])
+        amps = amplitudes[i] if amplitudes is not None else [1]
+        amps = amps if len(amps) != 1 else list(amps) * len(onsets[i])
+        for onset, duration, amp in zip(onsets[i], durs, amps):
+            start = int(np.round(onset / dt))
+            stop = max(int(np.round((onset + duration) / dt)), start + 1)
+            boxcar[start:stop] += amp
+        X[:, i] = np.convolve(boxcar, hrf)[:n_hires][np.minimum(sample_idx, n_hires - 1)]
+    
+    return X
+
+# define function to return the convolved and filtered task regressors (reading them from the cache directory if the same paradigm was built before)
+def task_regressors(conditions, onsets, durations, amplitudes, TR, nVols, hpf, cache_dir=None):
+    # hash the paradigm and timing information
+    paradigm = {'conditions': [str(c) for c in conditions],
+                'onsets': [[float(x) for x in o] for o in onsets],
+                'durations': [[float(x) for x in d] for d in durations],
+                'amplitudes': [[float(x) for x in a] for a in amplitudes] if amplitudes is not None else None,
+                'TR': float(TR), 'nVols': int(nVols), 'hpf': float(hpf) if hpf else 0}
+    key = hashlib.sha1(json.dumps(paradigm, sort_keys=True).encode()).hexdigest()
+    
+    if cache_dir:
+        cache_file = op.join(cache_dir, 'task_{}.npy'.format(key))
+        if op.isfile(cache_file):
+            print('Using previously convolved task regressors: {}'.format(cache_file))
+            return np.load(cache_file)
+    
+    X = filter_and_demean(convolve_events(conditions, onsets, durations, amplitudes, TR, nVols), TR, hpf)
+    
+    # save to cache (written to a temporary file first so other processes don't read a partial file)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = op.join(cache_dir, 'task_{}.{}.tmp.npy'.format(key, os.getpid()))
+        np.save(tmp_file, X)
+        os.replace(tmp_file, cache_file)
+    
+    return X
+
+# define function to calculate peak-to-peak heights of the columns of a matrix
+def pp_heights(X):
+    if X.shape[0] == 0:
+        return np.zeros(X.shape[1])
+    return X.max(axis=0) - X.min(axis=0)
+
+# define function to save a design matrix in the FSL design.mat format
+def write_design_mat(X, out_file):
+    with open(out_file, 'w') as f:
+        f.write('/NumWaves\t{}\n'.format(X.shape[1]))
+        f.write('/NumPoints\t{}\n'.format(X.shape[0]))
+        f.write('/PPheights\t\t{}\n'.format('\t'.join('{:e}'.format(h) for h in pp_heights(X))))
+        f.write('\n/Matrix\n')
+        for row in X:
+            f.write('\t'.join('{:e}'.format(v) for v in row) + '\t\n')
+
+# define function to save contrasts in the FSL design.con format
+def write_design_con(C, names, X, out_file):
+    with open(out_file, 'w') as f:
+        for i, name in enumerate(names, 1):
+            f.write('/ContrastName{}\t{}\n'.format(i, name))
+        f.write('/NumWaves\t{}\n'.format(C.shape[1]))
+        f.write('/NumContrasts\t{}\n'.format(C.shape[0]))
+        # peak-to-peak height of each contrast is the height of the design weighted by the contrast
+        f.write('/PPheights\t\t{}\n'.format('\t'.join('{:e}'.format(h) for h in pp_heights(X @ C.T))))
+        f.write('\n/Matrix\n')
+        for row in C:
+            f.write('\t'.join('{:e}'.format(v) for v in row) + '\t\n')
+
+# define function to build the design for a run from the model information (session_info returned by SpecifyModel) and save the design, contrast, and parameter name files
+def build_design(session_info, nVols, TR, contrasts, out_dir, cache_dir=None, prefix='run0'):
+    os.makedirs(out_dir, exist_ok=True)
+    
+    # filter cutoff (no filtering if the cutoff is not finite or positive)
+    hpf = session_info.get('hpf')
+    if hpf is None or not np.isfinite(hpf) or hpf <= 0:
+        hpf = 0
+    
+    blocks = []
+    names = []
+    
+    # task regressors (conditions)
+    conditions = [cond['name'] for cond in session_info.get('cond', [])]
+    if conditions:
+        onsets = [cond['onset'] for cond in session_info['cond']]
+        durations = [cond['duration'] for cond in session_info['cond']]
+        amplitudes = None
+        if all('amplitudes' in cond and cond['amplitudes'] is not None for cond in session_info['cond']):
+            amplitudes = [cond['amplitudes'] for cond in session_info['cond']]
+        blocks.append(task_regressors(conditions, onsets, durations, amplitudes, TR, nVols, hpf, cache_dir))
+        names += [str(c) for c in conditions]
+    
+    # confound and outlier regressors (outlier regressors are added to the regressors by SpecifyModel)
+    regressors = session_info.get('regress', [])
+    if regressors:
+        R = np.column_stack([np.asarray(reg['val'], dtype=np.float64) for reg in regressors])
+        blocks.append(filter_and_demean(R, TR, hpf))
+        names += [reg['name'] for reg in regressors]
+    
+    X = np.column_stack(blocks) if blocks else np.zeros((nVols, 0))
+    
+    # contrast weights (conditions that aren't in the design are ignored, as done by Level1Design)
+    if not contrasts:
+        raise ValueError('No contrasts were provided for the design in {}. The native design engine requires at least 1 contrast'.format(out_dir))
+    C = np.zeros((len(contrasts), X.shape[1]))
+    for i, con in enumerate(contrasts):
+        for cond, weight in zip(con[2], con[3]):
+            if cond in conditions:
+                C[i, conditions.index(cond)] = weight
+    con_names = [con[0] for con in contrasts]
+    
+    # save files
+    design_file = op.join(out_dir, '{}.mat'.format(prefix))
+    con_file = op.join(out_dir, '{}.con'.format(prefix))
+    pe_file = op.join(out_dir, 'pe_names.json')
+    
+    write_design_mat(X, design_file)
+    write_design_con(C, con_names, X, con_file)
+    with open(pe_file, 'w') as f:
+        json.dump({'pe{}'.format(i + 1): name for i, name in enumerate(names)}, f, indent=2)
+    
+    return design_file, con_file, pe_file
@@ -0,0 +1,115 @@
+"""
+Functions to combine runs with fixed effects in python as an alternative to the FSL fixed effects workflow (used by combine_runs.py when combine_engine is native in the config file)
+
+Fixed effects combine the runs using precision-weighted sums, as done by FLAMEO in fixed effects mode:
+    cope = sum(cope_i / varcope_i) / sum(1 / varcope_i)
+    varcope = 1 / sum(1 / varcope_i)
+    t = cope / sqrt(varcope), and z is calculated from t using the sum of the degrees of freedom of the runs
+Voxels are included in a fold if they are in the mask and all runs in the fold have a varcope above 0.
+
+Each run's copes and varcopes are loaded once for each contrast, and the sums for each fold are calculated by adding the runs in the fold, so leave-one-run-out and all-run-pairs folds don't reload the run data.
+The runs in a fold are summed directly (rather than subtracting the left out runs from the sum across all runs), so the sums are not affected by rounding errors or by non-finite values in runs that are left out.
+The same approach is used to average the percent signal change maps across the runs in each fold (see average_psc_folds).
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from fixed_effects import combine_folds
+
+"""
+import os
+import os.path as op
+import re
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+from parallel_gzip import save_nifti
+from native_glm import t_to_z
+
+# define function to calculate a sum for each fold from values saved for each run (the runs in each fold are summed directly)
+def fold_sums(run_values, folds):
+    return [sum(run_values[r] for r in fold) for fold in folds]
+
+# define function to find a contrast file saved by the firstlevel pipeline (file names are matched exactly, e.g., so con_*_a_cope doesn't match con_2_b_gt_a_cope)
+def find_contrast_file(modelDir, con_name, stat):
+    name = con_name.replace(' ', '').replace('>', '_gt_').lower()
+    pattern = re.compile(r'^con_\d+_{}_{}\.nii(\.gz)?$'.format(re.escape(name), stat))
+    matches = [f for f in sorted(os.listdir(modelDir)) if pattern.match(f)]
+    if not matches:
+        raise FileNotFoundError('No {} file found for contrast {} in {}'.format(stat, con_name, modelDir))
+    return op.join(modelDir, matches[0])
+
+# define function to load a 3D image as a float64 array
+def _load_vol(in_file):
+    dat = np.asanyarray(nib.load(in_file).dataobj)
+    return dat.reshape(dat.shape[:3]).astype(np.float64)
+
+# define function to save an array with the header of a reference image
+def _save_vol(vol, ref_img, out_file, n_threads=1):
+    out_img = nib.Nifti1Image(vol.astype(np.float32), ref_img.affine, ref_img.header)
+    out_img.set_data_dtype(np.float32)
+    return save_nifti(out_img, out_file, n_threads=n_threads)
+
+# define function to combine a contrast across runs for each fold
+def _combine_contrast(con_num, con, run_dirs, folds, mask, dofs, ref_img, out_dirs, n_threads):
+    # load each run once and calculate the precision-weighted values
+    weights = {}
+    weighted = {}
+    valid = {}
+    for run, modelDir in run_dirs.items():
+        cope = _load_vol(find_contrast_file(modelDir, con[0], 'cope'))
+        varcope = _load_vol(find_contrast_file(modelDir, con[0], 'varcope'))
+        valid[run] = (varcope > 0).astype(np.int32)
+        weights[run] = np.divide(1, varcope, out=np.zeros_like(varcope), where=varcope > 0)
+        weighted[run] = cope * weights[run]
+    
+    # output file names follow the substitutions used with the FSL fixed effects workflow
+    name = con[0].replace(' ', '').replace('>', '-').lower()
+    
+    out_files = []
+    for fold, out_dir, sum_w, sum_wc, n_valid, dof in zip(folds, out_dirs, fold_sums(weights, folds), fold_sums(weighted, folds), fold_sums(valid, folds), fold_sums(dofs, folds)):
+        fold_mask = mask & (n_valid == len(fold)) & (sum_w > 0)
+        
+        cope = np.zeros(mask.shape)
+        varcope = np.zeros(mask.shape)
+        varcope[fold_mask] = 1 / sum_w[fold_mask]
+        cope[fold_mask] = sum_wc[fold_mask] * varcope[fold_mask]
+        tstat = np.zeros(mask.shape)
+        tstat[fold_mask] = cope[fold_mask] / np.sqrt(varcope[fold_mask])
+        zstat = np.zeros(mask.shape)
+        zstat[fold_mask] = t_to_z(tstat[fold_mask], dof)
+        
+        os.makedirs(out_dir, exist_ok=True)
+        for stat, vol in [('cope', cope), ('varcope', varcope), ('tstat', tstat), ('zstat', zstat), ('mask', fold_mask)]:
+            out_files.append(_save_vol(vol, ref_img, op.join(out_dir, 'con_%i_%s_%s.nii.gz' % (con_num, name, stat)), n_threads))
+    
+    return out_files
+
+# define function to combine runs with fixed effects for every fold (run_dirs is a dictionary of run number: model directory, out_dirs has an output directory for each fold)
+def combine_folds(run_dirs, folds, contrasts, mask_file, out_dirs, n_threads=1):
+    mask = _load_vol(mask_file) > 0
+    ref_img = nib.load(mask_file)
+    
+    # degrees of freedom of each run
+    dofs = {}
+    for run, modelDir in run_dirs.items():
+        with open(op.join(modelDir, 'dof'), 'r') as f:
+            dofs[run] = float(f.read().split()[0])
+    
+    # contrasts are combined in parallel threads (loading and compressing files release the GIL)
+    with ThreadPoolExecutor(max_workers=max(int(n_threads), 1)) as executor:
+        futures = [executor.submit(_combine_contrast, i + 1, con, run_dirs, folds, mask, dofs, ref_img, out_dirs, 1) for i, con in enumerate(contrasts)]
+        out_files = [f for future in futures for f in future.result()]
+    
+    return out_files
+
+# define function to average percent signal change maps across the runs in each fold (psc_files is a dictionary of run number: psc file, out_files has an output file for each fold)
+def average_psc_folds(psc_files, folds, out_files):
+    ref_img = nib.load(next(iter(psc_files.values())))
+    run_data = {run: nib.load(f).get_fdata() for run, f in psc_files.items()}
+    
+    for fold, psc_sum, out_file in zip(folds, fold_sums(run_data, folds), out_files):
+        psc_mean_img = nib.Nifti1Image(psc_sum / len(fold), affine=ref_img.affine)
+        print('Saving averaged percent signal change map: {}'.format(out_file))
+        save_nifti(psc_mean_img, out_file)
+    
+    return out_files
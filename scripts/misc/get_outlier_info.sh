@@ -11,6 +11,10 @@
 # being flagged for exclusion. This script will extract that information into a 
 # group_scans.tsv file.
 #
+# If the motion exclusions script saved a study QC ledger (qc_ledger.tsv in the
+# derivatives directory), the rows for the listed participants are taken from the
+# ledger rather than from each participant's scans.tsv file.
+#
 # This script must be run AFTER the motion exclusions scripts.
 ################################################################################
 
@@ -100,6 +104,16 @@ fi
 # print confirmation of study directory
 echo "Getting outlier information for" ${derivDir} "data..."
 
+# study QC ledger saved by the motion exclusions script (subjects that aren't in the ledger are read from their scans.tsv file)
+ledger=${derivDir}/qc_ledger.tsv
+if [ -f ${ledger} ]
+then
+	echo "Using QC ledger ${ledger} for subjects that are in the ledger"
+fi
+
+# columns of the scans.tsv files (ledger rows are written in the same order, with the sub column saved as subject and n/a values left empty)
+columns="filename task run subject MotionExclusion MeanFD #Artifacts_FD MeanDVARS #Artifacts_DVARS #Artifacts_ART"
+
 # iterate over subjects
 while read p
 do
@@ -107,6 +121,27 @@ do
 	
 	echo "Getting outlier information for ${sub}"
 	
+	# use the subject's rows in the QC ledger if there are any
+	if [ -f ${ledger} ] && awk -F'\t' -v subject=${sub} 'NR>1 && $1==subject {found=1; exit} END {exit !found}' ${ledger}
+	then
+		if [ ! -f ${qcDir}/outlier_info.tsv ] # on first loop, add header information
+		then
+			echo "${columns}" | tr ' ' '\t' > ${qcDir}/outlier_info.tsv
+		fi
+		
+		awk -F'\t' -v OFS='\t' -v subject=${sub} -v columns="${columns}" '
+			NR==1 {for (i=1; i<=NF; i++) col[$i]=i; col["subject"]=col["sub"]; n=split(columns, out, " "); next}
+			$col["sub"]==subject {
+				line=""
+				for (i=1; i<=n; i++) {v=$col[out[i]]; if (v=="n/a") v=""; line=(i==1 ? v : line OFS v)}
+				print line
+			}' ${ledger} >> ${qcDir}/outlier_info.tsv
+		continue
+	elif [ -f ${ledger} ]
+	then
+		echo "${sub} is not in the QC ledger, so the scans.tsv file will be used"
+	fi
+	
 	# define subject directory depending on whether data are organized in session folders
 	if [[ ${sessions} != 'no' ]]
 	then
@@ -0,0 +1,69 @@
+"""
+Functions to save the hash of each node in a workflow after it runs (used by workflow_scheduler.py when incremental is yes in the config file)
+
+When incremental is yes, the pipelines keep the working directory of each subject between calls rather than removing it, so nipype reuses the outputs of nodes whose inputs haven't changed.
+Nipype saves the hash of a node's inputs in its working directory (_0x<hash>.json) and reruns the node when the hash changes.
+After a workflow runs, the hash of each node is saved to hash_manifest.json in the working directory of the workflow, and the nodes whose hash changed since the last call are printed, so users can check which nodes were rerun (e.g., only the contrast and model nodes after a contrast is changed).
+
+Nodes are identified by their working directory relative to the working directory of the workflow, so nodes that are run over iterables (e.g., runs and splithalves) have separate entries.
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from hash_manifest import update_manifest
+
+"""
+import os
+import os.path as op
+import glob
+import json
+
+# define function to return the hash saved by nipype in a node working directory (or None if the node hasn't run)
+def node_hash(node_dir):
+    hash_files = [f for f in glob.glob(op.join(node_dir, '_0x*.json')) if not f.endswith('_unfinished.json')]
+    if not hash_files:
+        return None
+    
+    # use the most recent hash file if the directory has more than one
+    hash_file = max(hash_files, key=op.getmtime)
+    return op.basename(hash_file)[len('_0x'):-len('.json')]
+
+# define function to return the hashes of the nodes in an executed workflow graph that belong to a workflow directory
+def node_hashes(graph, wfDir):
+    wfDir = op.realpath(wfDir)
+    hashes = {}
+    for node in graph.nodes():
+        node_dir = op.realpath(node.output_dir())
+        if not node_dir.startswith(wfDir + os.sep):
+            continue
+        hashes[op.relpath(node_dir, wfDir)] = node_hash(node_dir)
+    return hashes
+
+# define function to update the manifest in a workflow directory, returning the nodes whose hash changed since the manifest was last saved
+def update_manifest(graph, wfDir, manifest_name='hash_manifest.json'):
+    manifest_file = op.join(wfDir, manifest_name)
+    
+    manifest = {}
+    if op.isfile(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+    
+    # workflows that share a working directory update the entries for their own nodes
+    hashes = node_hashes(graph, wfDir)
+    changed = sorted(node for node, hashval in hashes.items() if manifest.get(node) != hashval)
+    manifest.update(hashes)
+    
+    # written to a temporary file first so a partial file is never left with the final name
+    os.makedirs(wfDir, exist_ok=True)
+    tmp_file = '{}.{}.tmp'.format(manifest_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+    
+    return changed
+
+# define function to print the nodes that were rerun in a workflow
+def report_changes(name, changed, n_nodes):
+    if not changed:
+        print('{}: all {} nodes reused previous outputs'.format(name, n_nodes))
+    else:
+        print('{}: {} of {} nodes were run with new inputs: {}'.format(name, len(changed), n_nodes, changed))
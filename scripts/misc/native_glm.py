@@ -0,0 +1,220 @@
+"""
+Functions to fit a first-level GLM in python as an alternative to FSL FILMGLS (used by firstlevel_pipeline.py when glm_engine is native in the config file)
+
+The model is fit with prewhitened least squares using a voxelwise AR(1) estimate of the temporal autocorrelation:
+    0. the mean of each voxel's time series is removed (as done by FILMGLS, the design has no intercept column)
+    1. the design is fit to each voxel with ordinary least squares and the lag-1 autocorrelation of the residuals is calculated
+    2. the autocorrelation estimates are optionally smoothed within the mask (similar to the smooth_autocorr option in FILMGLS)
+    3. the data and design are prewhitened using the autocorrelation estimate and the model is refit
+Voxels are grouped by their (rounded) autocorrelation estimate so each group shares one whitened design, and the voxels are processed in chunks using a pool of threads.
+This is a simpler noise model than the FILM Tukey taper, so estimates will be similar but not identical to the FILMGLS outputs.
+
+The outputs are saved with the FILMGLS file names (pe, cope, varcope, tstat, zstat, sigmasquareds, res4d, dof, threshac1, logfile) so the datasink substitutions and later scripts don't need to change.
+Only t contrasts are estimated (contrast outputs are skipped if the contrast file has no contrasts).
+The estimates can be compared with FILMGLS outputs for the same run using benchmark_native_glm.py.
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from native_glm import run_glm
+
+"""
+import os
+import os.path as op
+import numpy as np
+import nibabel as nib
+from scipy import ndimage, special, stats
+from concurrent.futures import ThreadPoolExecutor
+from parallel_gzip import save_nifti
+
+# define function to read an FSL matrix file (e.g., design.mat or design.con), returning the matrix and the header fields
+def read_fsl_matrix(mat_file):
+    header = {}
+    rows = []
+    in_matrix = False
+    with open(mat_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if in_matrix:
+                rows.append([float(x) for x in line.split()])
+            elif line.startswith('/Matrix'):
+                in_matrix = True
+            elif line.startswith('/'):
+                field = line.split(None, 1)
+                header[field[0][1:]] = field[1] if len(field) > 1 else ''
+    
+    return np.array(rows, dtype=np.float64), header
+
+# define function to prewhiten the rows (time points) of an array using an AR(1) coefficient
+def ar1_whiten(dat, rho):
+    white = np.empty_like(dat)
+    white[0] = dat[0] * np.sqrt(1 - rho**2)
+    white[1:] = dat[1:] - rho * dat[:-1]
+    return white
+
+# define function to convert t-stats to z-stats (using log probabilities so large t values don't saturate)
+def t_to_z(tvals, dof):
+    log_p = stats.t.logsf(np.abs(tvals), dof)
+    return np.sign(tvals) * -special.ndtri_exp(log_p)
+
+# define function to smooth values within a mask (the smoothed values are normalised by the smoothed mask so voxels outside the mask don't contribute)
+def smooth_in_mask(vals, mask, fwhm, zooms):
+    sigma = [fwhm / (np.sqrt(8 * np.log(2)) * z) for z in zooms]
+    
+    vol = np.zeros(mask.shape)
+    vol[mask] = vals
+    smoothed = ndimage.gaussian_filter(vol, sigma, mode='constant')
+    weights = ndimage.gaussian_filter(mask.astype(np.float64), sigma, mode='constant')
+    
+    return smoothed[mask] / weights[mask]
+
+# define function to estimate the lag-1 autocorrelation of the OLS residuals for a chunk of voxels
+def _ols_autocorr(X_pinv, X, Y):
+    Y = Y.astype(np.float64)
+    resid = Y - X @ (X_pinv @ Y)
+    num = np.sum(resid[1:] * resid[:-1], axis=0)
+    den = np.sum(resid**2, axis=0)
+    
+    rho = np.zeros(Y.shape[1])
+    np.divide(num, den, out=rho, where=den > 0)
+    
+    return rho
+
+# define function to fit the prewhitened model for a chunk of voxels
+def _fit_chunk(X, C, Y, rho, rho_step, dof):
+    Y = Y.astype(np.float64)
+    nvox = Y.shape[1]
+    
+    pes = np.zeros((X.shape[1], nvox))
+    copes = np.zeros((C.shape[0], nvox))
+    varcopes = np.zeros((C.shape[0], nvox))
+    sigmasq = np.zeros(nvox)
+    resid = np.zeros(Y.shape, dtype=np.float32)
+    
+    # voxels with the same rounded autocorrelation share a whitened design
+    bins = np.round(rho / rho_step).astype(int)
+    for b in np.unique(bins):
+        idx = np.flatnonzero(bins == b)
+        r = b * rho_step
+        
+        # whiten design and data
+        Xw = ar1_whiten(X, r)
+        Yw = ar1_whiten(Y[:, idx], r)
+        
+        # least squares fit
+        Xw_pinv = np.linalg.pinv(Xw)
+        B = Xw_pinv @ Yw
+        R = Yw - Xw @ B
+        
+        # residual variance and contrast variance (c (Xw'Xw)^-1 c' * sigma^2)
+        s2 = np.sum(R**2, axis=0) / dof
+        cvar = np.einsum('ij,jk,ik->i', C, Xw_pinv @ Xw_pinv.T, C)
+        
+        pes[:, idx] = B
+        copes[:, idx] = C @ B
+        varcopes[:, idx] = np.outer(cvar, s2)
+        sigmasq[idx] = s2
+        resid[:, idx] = R
+    
+    return pes, copes, varcopes, sigmasq, resid
+
+# define function to fit the GLM to a 4D file and save the outputs in the FILMGLS format
+def run_glm(in_file, design_file, tcon_file, out_dir, mask_file=None, threshold=1000, smooth_autocorr=False, fwhm=0, n_threads=1, chunk_size=20000, rho_step=0.01, out_ext='.nii.gz'):
+    os.makedirs(out_dir, exist_ok=True)
+    
+    # read design and contrast matrices
+    X, design_info = read_fsl_matrix(design_file)
+    C, con_info = read_fsl_matrix(tcon_file)
+    C = C.reshape(-1, X.shape[1]) if C.size else np.zeros((0, X.shape[1]))
+    
+    # load data (uncompressed files are memory mapped, so only the voxels in the mask are read into memory, while compressed files are fully decompressed)
+    img = nib.load(in_file)
+    dat = np.asanyarray(img.dataobj)
+    nVols = dat.shape[3]
+    
+    if X.shape[0] != nVols:
+        raise ValueError('Design matrix has {} time points but {} has {} volumes'.format(X.shape[0], in_file, nVols))
+    
+    # define voxels to fit (within mask and above the intensity threshold, as done by FILMGLS)
+    mask = np.ones(dat.shape[:3], dtype=bool)
+    if mask_file:
+        mask_dat = np.asanyarray(nib.load(mask_file).dataobj)
+        mask = mask_dat.reshape(mask_dat.shape[:3]) > 0
+    Y = np.asarray(dat[mask], dtype=np.float32).T
+    keep = Y.mean(axis=0) > threshold
+    Y = np.ascontiguousarray(Y[:, keep])
+    nvox = Y.shape[1]
+    
+    # remove the mean of each voxel once, so the OLS autocorrelation fit and the prewhitened fit both use demeaned data
+    Y -= Y.mean(axis=0, dtype=np.float64).astype(np.float32)
+    
+    # update mask to the voxels that were fit (voxels are in the same order as the mask)
+    vox_idx = np.flatnonzero(mask)[keep]
+    mask = np.zeros(dat.shape[:3], dtype=bool)
+    mask.flat[vox_idx] = True
+    
+    print('Fitting GLM to {} voxels with {} time points, {} regressors, and {} contrasts'.format(nvox, nVols, X.shape[1], C.shape[0]))
+    
+    # degrees of freedom
+    dof = nVols - np.linalg.matrix_rank(X)
+    
+    # split voxels into chunks that are processed in parallel
+    chunks = [slice(i, min(i + chunk_size, nvox)) for i in range(0, nvox, chunk_size)]
+    
+    with ThreadPoolExecutor(max_workers=max(int(n_threads), 1)) as executor:
+        # estimate autocorrelation from OLS residuals
+        X_pinv = np.linalg.pinv(X)
+        rho = np.concatenate(list(executor.map(lambda s: _ols_autocorr(X_pinv, X, Y[:, s]), chunks))) if chunks else np.zeros(0)
+        
+        # smooth autocorrelation estimates
+        if smooth_autocorr and fwhm > 0 and nvox > 0:
+            rho = smooth_in_mask(rho, mask, fwhm, img.header.get_zooms()[:3])
+        rho = np.clip(rho, -0.99, 0.99)
+        
+        # fit prewhitened model
+        results = list(executor.map(lambda s: _fit_chunk(X, C, Y[:, s], rho[s], rho_step, dof), chunks))
+    
+    if results:
+        pes, copes, varcopes, sigmasq, resid = [np.concatenate(r, axis=-1) for r in zip(*results)]
+    else:
+        pes, copes, varcopes = np.zeros((X.shape[1], 0)), np.zeros((C.shape[0], 0)), np.zeros((C.shape[0], 0))
+        sigmasq, resid = np.zeros(0), np.zeros((nVols, 0), dtype=np.float32)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tstats = np.where(varcopes > 0, copes / np.sqrt(varcopes), 0)
+    zstats = t_to_z(tstats, dof)
+    
+    # define function to save voxel values as an image
+    def save_img(vals, name):
+        vol = np.zeros(mask.shape + vals.shape[1:], dtype=np.float32)
+        vol[mask] = vals
+        out_img = nib.Nifti1Image(vol, img.affine, img.header)
+        out_img.set_data_dtype(np.float32)
+        out_file = op.join(out_dir, name + out_ext)
+        save_nifti(out_img, out_file, n_threads=n_threads)
+        return out_file
+    
+    outputs = {'param_estimates': [save_img(pes[i], 'pe{}'.format(i+1)) for i in range(pes.shape[0])],
+               'copes': [save_img(copes[i], 'cope{}'.format(i+1)) for i in range(C.shape[0])],
+               'varcopes': [save_img(varcopes[i], 'varcope{}'.format(i+1)) for i in range(C.shape[0])],
+               'tstats': [save_img(tstats[i], 'tstat{}'.format(i+1)) for i in range(C.shape[0])],
+               'zstats': [save_img(zstats[i], 'zstat{}'.format(i+1)) for i in range(C.shape[0])],
+               'sigmasquareds': save_img(sigmasq, 'sigmasquareds'),
+               'thresholdac': save_img(rho, 'threshac1'),
+               'residual4d': save_img(resid.T, 'res4d')}
+    
+    # save degrees of freedom
+    outputs['dof_file'] = op.join(out_dir, 'dof')
+    with open(outputs['dof_file'], 'w') as f:
+        f.write('{}\n'.format(dof))
+    
+    # save log file
+    outputs['logfile'] = op.join(out_dir, 'logfile')
+    with open(outputs['logfile'], 'w') as f:
+        f.write('native GLM (AR(1) prewhitening)\n')
+        f.write('input: {}\ndesign: {}\ncontrasts: {}\n'.format(in_file, design_file, tcon_file))
+        f.write('voxels: {}\ntime points: {}\nregressors: {}\ncontrasts: {}\ndof: {}\n'.format(nvox, nVols, X.shape[1], C.shape[0], dof))
+        f.write('smoothed autocorrelation: {} (fwhm: {}mm)\nthreads: {}\n'.format(smooth_autocorr, fwhm, n_threads))
+    
+    return outputs
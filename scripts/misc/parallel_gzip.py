@@ -0,0 +1,91 @@
+"""
+Functions to save large NIfTI images as .nii.gz files using multiple threads (used by timecourse_pipeline.py, calc_psc.py, denoise_echos.py, and the functions that save 4D images in this folder)
+
+nib.save compresses .nii.gz files on a single thread, so saving a 4D run can take tens of seconds.
+Instead, the image is serialised once and the bytes are split into blocks that are compressed in parallel threads (zlib releases the GIL while compressing).
+Each block is saved as a complete gzip member, and the members are written one after the other. Files with multiple gzip members are standard gzip files that are read by nibabel, FSL, and gzip as a single stream.
+The file is written to a temporary file first so a partial file is never left with the final name (this also allows an image to be saved over the file it was loaded from).
+
+Files that don't end in .gz are saved with nib.save.
+
+Images that are too large to hold in memory can be saved from their header and blocks of data (save_nifti_blocks), so only 1 block of data is held in memory while the file is written.
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from parallel_gzip import save_nifti, save_nifti_blocks
+
+"""
+import io
+import os
+import os.path as op
+import zlib
+from itertools import chain
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+
+# define function to compress a block of bytes as a complete gzip member
+def compress_block(block, compress_level=1):
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 31) # wbits of 31 adds the gzip header and trailer
+    return compressor.compress(block) + compressor.flush()
+
+# define function to return the default number of threads used to compress a file
+def default_threads():
+    return min(os.cpu_count() or 1, 8)
+
+# define function to save an image, compressing .nii.gz files in blocks using multiple threads
+def save_nifti(img, out_file, n_threads=None, compress_level=1, block_mb=16):
+    if not str(out_file).endswith('.gz'):
+        nib.save(img, out_file)
+        return out_file
+    
+    n_threads = default_threads() if n_threads is None else max(int(n_threads), 1)
+    
+    # serialise the image (header and data) as an uncompressed NIfTI file
+    payload = memoryview(img.to_bytes())
+    block_size = int(block_mb * 1024 * 1024)
+    blocks = [payload[i:i + block_size] for i in range(0, len(payload), block_size)]
+    
+    # compress blocks in parallel and write them in order as they finish
+    tmp_file = '{}.{}.tmp'.format(out_file, os.getpid())
+    try:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor, open(tmp_file, 'wb') as f:
+            for member in executor.map(lambda b: compress_block(b, compress_level), blocks):
+                f.write(member)
+        os.replace(tmp_file, out_file)
+    finally:
+        if op.exists(tmp_file):
+            os.remove(tmp_file)
+    
+    return out_file
+
+# define function to save an image from its header and an iterable of data blocks in the order they are saved (e.g., blocks of volumes with the voxels in fortran order), so the full image is never held in memory
+def save_nifti_blocks(header, blocks, out_file, n_threads=None, compress_level=1, block_mb=16):
+    n_threads = default_threads() if n_threads is None else max(int(n_threads), 1)
+    block_size = int(block_mb * 1024 * 1024)
+    dtype = header.get_data_dtype()
+    
+    # serialise the header (and any extensions) and pad it to the start of the data
+    hdr_bytes = io.BytesIO()
+    header.write_to(hdr_bytes)
+    hdr_bytes.write(b'\x00' * (header.get_data_offset() - hdr_bytes.tell()))
+    
+    # write the header and then each block of data (compressed in parallel threads for .nii.gz files)
+    tmp_file = '{}.{}.tmp'.format(out_file, os.getpid())
+    try:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor, open(tmp_file, 'wb') as f:
+            payloads = (np.ascontiguousarray(block, dtype=dtype).tobytes() for block in blocks)
+            for payload in chain([hdr_bytes.getvalue()], payloads):
+                if not str(out_file).endswith('.gz'):
+                    f.write(payload)
+                    continue
+                payload = memoryview(payload)
+                parts = [payload[i:i + block_size] for i in range(0, len(payload), block_size)]
+                for member in executor.map(lambda b: compress_block(b, compress_level), parts):
+                    f.write(member)
+        os.replace(tmp_file, out_file)
+    finally:
+        if op.exists(tmp_file):
+            os.remove(tmp_file)
+    
+    return out_file
@@ -0,0 +1,216 @@
+"""
+Functions to estimate new contrasts from the saved outputs of a first-level GLM without refitting the model (used by add_contrasts.py)
+
+The parameter estimates don't depend on the contrasts, so new t contrasts are calculated from the files saved in each run's model and design directories:
+    1. cope = c * pe, using the parameter estimates (pe*.nii.gz) and the contrast weights for the columns of the design (matched to the conditions using pe_names.json)
+    2. varcope = c * (Xw'Xw)^-1 * c' * sigmasquared, using the prewhitened design covariance of each voxel
+    3. t = cope / sqrt(varcope), and z is calculated from t using the degrees of freedom (dof)
+
+The prewhitened design covariance is recalculated from the design matrix (design.mat) and the autocorrelation estimates saved by the GLM (threshac1):
+    - native GLM (glm_engine native): the design is whitened with the AR(1) estimate of each voxel, grouped as in native_glm.py, so the varcopes match those from the GLM
+    - FSL FILMGLS: the design is whitened in the frequency domain using the autocorrelation estimates of each voxel, following the FILM prewhitening. The varcopes are close to but not identical to those estimated by FILMGLS (FILMGLS no longer saves the covariance of each voxel), and the recalculated varcopes for the existing contrasts can be compared with the saved varcopes using check_existing
+Voxels are processed in chunks using a pool of threads.
+
+The new contrasts are added to the contrast file in the design directory (with the peak-to-peak heights used by calc_psc.py) and the outputs are saved with the same file names as the datasink substitutions in firstlevel_pipeline.py (e.g., con_3_faces_gt_objects_cope.nii.gz).
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from posthoc_contrasts import add_run_contrasts
+
+"""
+import os
+import os.path as op
+import glob
+import json
+import re
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+from parallel_gzip import save_nifti
+from native_glm import read_fsl_matrix, ar1_whiten, t_to_z
+from design_builder import pp_heights
+
+# define function to return the contrast name used in output file names (as in the substitutes function in firstlevel_pipeline.py)
+def contrast_file_name(con_num, con_name, stat):
+    name = con_name.replace(' ', '').replace('>', '_gt_').lower()
+    return 'con_%d_%s_%s' % (con_num, name, stat)
+
+# define function to read the contrast names from an FSL contrast file (in the order of the contrasts)
+def read_contrast_names(con_file):
+    mat, header = read_fsl_matrix(con_file)
+    names = {}
+    for field, value in header.items():
+        match = re.match(r'ContrastName(\d+)$', field)
+        if match:
+            names[int(match.group(1))] = value.strip()
+    return [names[i] for i in sorted(names)], np.atleast_2d(mat), header
+
+# define function to convert contrasts (name, 'T', conditions, weights) to weights for the columns of the design (conditions that aren't in the design are ignored, as done by Level1Design)
+def contrast_matrix(contrasts, pe_names):
+    columns = [pe_names['pe{}'.format(i + 1)].lower() for i in range(len(pe_names))]
+    C = np.zeros((len(contrasts), len(columns)))
+    for i, con in enumerate(contrasts):
+        for cond, weight in zip(con[2], con[3]):
+            if cond.lower() in columns:
+                C[i, columns.index(cond.lower())] = weight
+    return C
+
+# define function to save a contrast file with added contrasts (the RequiredEffect field depends on the noise in the FEAT run, so it isn't kept)
+def append_contrasts(con_file, names, C, X):
+    old_names, old_C, header = read_contrast_names(con_file)
+    if old_C.size == 0:
+        old_C = np.zeros((0, C.shape[1]))
+    
+    # peak-to-peak heights of the existing contrasts are kept and heights of the new contrasts are calculated as in design_builder.py
+    heights = [float(h) for h in header.get('PPheights', '').split()] if old_C.shape[0] else []
+    heights += list(pp_heights(X @ C.T))
+    
+    all_names = old_names + names
+    all_C = np.vstack([old_C, C])
+    
+    tmp_file = '{}.{}.tmp'.format(con_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        for i, name in enumerate(all_names, 1):
+            f.write('/ContrastName{}\t{}\n'.format(i, name))
+        f.write('/NumWaves\t{}\n'.format(all_C.shape[1]))
+        f.write('/NumContrasts\t{}\n'.format(all_C.shape[0]))
+        f.write('/PPheights\t\t{}\n'.format('\t'.join('{:e}'.format(h) for h in heights)))
+        f.write('\n/Matrix\n')
+        for row in all_C:
+            f.write('\t'.join('{:e}'.format(v) for v in row) + '\t\n')
+    os.replace(tmp_file, con_file)
+    
+    return con_file
+
+# define function to calculate c * (Xw'Xw)^-1 * c' for voxels with AR(1) autocorrelation estimates (voxels are grouped by rounded estimate, as in native_glm.py)
+def ar1_contrast_variance(X, C, rho, rho_step=0.01):
+    cvar = np.zeros((C.shape[0], len(rho)))
+    bins = np.round(rho / rho_step).astype(int)
+    for b in np.unique(bins):
+        idx = np.flatnonzero(bins == b)
+        Xw_pinv = np.linalg.pinv(ar1_whiten(X, b * rho_step))
+        cvar[:, idx] = np.einsum('ij,jk,ik->i', C, Xw_pinv @ Xw_pinv.T, C)[:, np.newaxis]
+    return cvar
+
+# define function to calculate c * (Xw'Xw)^-1 * c' for voxels with FILM autocorrelation estimates (autocorrelation at each lag in the rows, starting at lag 0)
+def film_contrast_variance(X, C, ac):
+    nVols = X.shape[0]
+    zeropad = int(2**np.ceil(np.log2(nVols)))
+    
+    # spectrum of the autocorrelation of each voxel (autocorrelation is mirrored so the spectrum is real)
+    nlags = min(ac.shape[0], zeropad // 2)
+    acpad = np.zeros((zeropad, ac.shape[1]))
+    acpad[:nlags] = ac[:nlags]
+    acpad[zeropad - nlags + 1:] = ac[1:nlags][::-1]
+    spectrum = np.fft.rfft(acpad, axis=0).real
+    
+    # whitening filter, limited so voxels with poor estimates don't produce extreme values
+    weights = 1 / np.sqrt(np.clip(spectrum, 1e-6, None))
+    
+    # whiten design for each voxel (voxels x time points x columns) and calculate the design covariance
+    Xf = np.fft.rfft(X, n=zeropad, axis=0)
+    Xw = np.fft.irfft(Xf[np.newaxis] * weights.T[:, :, np.newaxis], n=zeropad, axis=1)[:, :nVols]
+    XtX = np.einsum('vti,vtj->vij', Xw, Xw)
+    
+    return np.einsum('ci,vij,cj->cv', C, np.linalg.pinv(XtX, hermitian=True), C)
+
+# define function to calculate new contrasts for a run from the saved GLM outputs
+def estimate_contrasts(modelDir, design_file, C, n_threads=1, chunk_size=1000):
+    X, design_info = read_fsl_matrix(design_file)
+    if C.shape[1] != X.shape[1]:
+        raise ValueError('Contrasts have {} weights but the design {} has {} columns'.format(C.shape[1], design_file, X.shape[1]))
+    
+    # load parameter estimates and residual variance within the voxels that were fit (voxels with zero residual variance are outside the mask)
+    ss_img = nib.load(op.join(modelDir, 'sigmasquareds.nii.gz'))
+    sigmasq = np.asanyarray(ss_img.dataobj).reshape(ss_img.shape[:3])
+    mask = sigmasq > 0
+    sigmasq = sigmasq[mask].astype(np.float64)
+    
+    B = np.vstack([np.asanyarray(nib.load(op.join(modelDir, 'pe{}.nii.gz'.format(i + 1))).dataobj).reshape(mask.shape)[mask] for i in range(X.shape[1])]).astype(np.float64)
+    
+    ac_img = nib.load(op.join(modelDir, 'threshac1.nii.gz'))
+    ac = np.asanyarray(ac_img.dataobj)
+    ac = ac.reshape(ac.shape[:3] + (-1,))[mask].T.astype(np.float64)
+    
+    with open(op.join(modelDir, 'dof'), 'r') as f:
+        dof = float(f.read().split()[0])
+    
+    # a single autocorrelation volume is the AR(1) estimate saved by the native GLM, otherwise the FILM estimates (with or without lag 0)
+    if ac.shape[0] == 1:
+        variance = lambda s: ar1_contrast_variance(X, C, ac[0, s])
+    else:
+        if not np.allclose(np.median(ac[0]), 1):
+            ac = np.vstack([np.ones((1, ac.shape[1])), ac])
+        variance = lambda s: film_contrast_variance(X, C, ac[:, s])
+    
+    nvox = B.shape[1]
+    chunks = [slice(i, min(i + chunk_size, nvox)) for i in range(0, nvox, chunk_size)]
+    with ThreadPoolExecutor(max_workers=max(int(n_threads), 1)) as executor:
+        cvar = np.concatenate(list(executor.map(variance, chunks)), axis=1) if chunks else np.zeros((C.shape[0], 0))
+    
+    copes = C @ B
+    varcopes = cvar * sigmasq
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tstats = np.where(varcopes > 0, copes / np.sqrt(varcopes), 0)
+    zstats = t_to_z(tstats, dof)
+    
+    return {'copes': copes, 'varcopes': varcopes, 'tstats': tstats, 'zstats': zstats}, mask, ss_img
+
+# define function to compare recalculated varcopes for the existing contrasts with the varcopes saved by the GLM (returns the median relative difference for each contrast)
+def check_existing(modelDir, design_file, con_file, n_threads=1):
+    names, C, header = read_contrast_names(con_file)
+    stats, mask, ref_img = estimate_contrasts(modelDir, design_file, C, n_threads)
+    
+    differences = {}
+    for i, name in enumerate(names):
+        saved = glob.glob(op.join(modelDir, contrast_file_name(i + 1, name, 'varcope') + '.nii*'))
+        if not saved:
+            continue
+        saved = np.asanyarray(nib.load(saved[0]).dataobj).reshape(mask.shape)[mask]
+        if not np.any(saved > 0):
+            continue
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rel = np.abs(stats['varcopes'][i] - saved) / saved
+        differences[name] = float(np.nanmedian(rel[saved > 0]))
+    
+    return differences
+
+# define function to add contrasts to a run, skipping contrasts that are already in the contrast file (returns the saved files)
+def add_run_contrasts(modelDir, designDir, contrasts, n_threads=1, out_ext='.nii.gz'):
+    design_file = glob.glob(op.join(designDir, 'run*.mat'))[0]
+    con_file = glob.glob(op.join(designDir, 'run*.con'))[0]
+    
+    old_names = read_contrast_names(con_file)[0]
+    new = [con for con in contrasts if con[0] not in old_names]
+    if not new:
+        print('All contrasts are already estimated in {}'.format(modelDir))
+        return []
+    
+    with open(op.join(modelDir, 'pe_names.json'), 'r') as f:
+        pe_names = json.load(f)
+    C = contrast_matrix(new, pe_names)
+    
+    for con, weights in zip(new, C):
+        if not np.any(weights):
+            print('Warning: none of the conditions in contrast {} are in the design for {}'.format(con[0], modelDir))
+    
+    print('Estimating {} new contrasts in {}: {}'.format(len(new), modelDir, [con[0] for con in new]))
+    stats, mask, ref_img = estimate_contrasts(modelDir, design_file, C, n_threads)
+    
+    # save outputs, numbering the new contrasts after the existing contrasts
+    out_files = []
+    for i, con in enumerate(new):
+        con_num = len(old_names) + i + 1
+        for stat, key in [('cope', 'copes'), ('varcope', 'varcopes'), ('tstat', 'tstats'), ('zstat', 'zstats')]:
+            vol = np.zeros(mask.shape, dtype=np.float32)
+            vol[mask] = stats[key][i]
+            out_img = nib.Nifti1Image(vol, ref_img.affine, ref_img.header)
+            out_img.set_data_dtype(np.float32)
+            out_file = op.join(modelDir, contrast_file_name(con_num, con[0], stat) + out_ext)
+            out_files.append(save_nifti(out_img, out_file, n_threads=n_threads))
+    
+    # add contrasts to the contrast file once the outputs are saved
+    X = read_fsl_matrix(design_file)[0]
+    append_contrasts(con_file, [con[0] for con in new], C, X)
+    
+    return out_files
@@ -0,0 +1,131 @@
+"""
+Functions to save and read the motion information for each run in a study-wide QC ledger (used by mark_motion_exclusions.py, firstlevel_pipeline.py, and timecourse_pipeline.py)
+
+The ledger is a single file in the derivDir with a row for each run (indexed by sub, ses, task, and run) and the following columns:
+    filename, nVols, MotionExclusion, MeanFD, #Artifacts_FD, MeanDVARS, #Artifacts_DVARS, #Artifacts_ART
+The ledger is saved as qc_ledger.tsv, or as qc_ledger.parquet when stats_format is parquet in the config file (parquet requires pyarrow).
+
+mark_motion_exclusions.py replaces the rows of a subject once all runs are checked. Subjects can be checked at the same time:
+    - updates are made while holding a lock on the ledger, so rows saved by another subject are never lost
+    - the ledger is written to a temporary file first and then renamed, so a partial file is never read
+
+The pipelines read the runs of a subject from the ledger with a single lookup, rather than finding and parsing the subject's scans.tsv file.
+The scans.tsv files are still updated and are read for subjects that aren't in the ledger (e.g., data checked before the ledger was added).
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from qc_ledger import subject_scans
+
+"""
+import os
+import os.path as op
+import glob
+import fcntl
+from contextlib import contextmanager
+import pandas as pd
+
+# columns saved in the ledger (the index columns are first)
+index_columns = ['sub', 'ses', 'task', 'run']
+ledger_columns = index_columns + ['filename', 'nVols', 'MotionExclusion', 'MeanFD', '#Artifacts_FD', 'MeanDVARS', '#Artifacts_DVARS', '#Artifacts_ART']
+
+# define function to return the ledger file for the requested format (tsv by default)
+def ledger_file(derivDir, ledger_format='tsv'):
+    if ledger_format == 'parquet':
+        return op.join(derivDir, 'qc_ledger.parquet')
+    else:
+        return op.join(derivDir, 'qc_ledger.tsv')
+
+# define function to return the ledger file in the derivDir (or None if there is no ledger)
+def find_ledger(derivDir):
+    ledger_files = [f for f in [ledger_file(derivDir, 'parquet'), ledger_file(derivDir, 'tsv')] if op.isfile(f)]
+    if not ledger_files:
+        return None
+    
+    # use the most recently updated ledger if both formats are found
+    return max(ledger_files, key=op.getmtime)
+
+# define function to read the ledger (index columns are read as strings so run numbers keep their leading zeros)
+def read_ledger(qc_file):
+    if qc_file.endswith('.parquet'):
+        ledger = pd.read_parquet(qc_file)
+    else:
+        ledger = pd.read_csv(qc_file, sep='\t', dtype={c: str for c in index_columns}, keep_default_na=False, na_values=['n/a'])
+    return ledger
+
+# define function to save the ledger to a temporary file and rename it once it is written
+def write_ledger(ledger, qc_file):
+    tmp_file = '{}.{}.tmp'.format(qc_file, os.getpid())
+    if qc_file.endswith('.parquet'):
+        ledger.to_parquet(tmp_file, index=False)
+    else:
+        ledger.to_csv(tmp_file, sep='\t', index=False, na_rep='n/a')
+    os.replace(tmp_file, qc_file)
+    return qc_file
+
+# define function to hold a lock on the ledger while it is updated
+@contextmanager
+def _locked(qc_file):
+    with open('{}.lock'.format(qc_file), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+# define function to replace the rows of a subject (and session) in the ledger
+def update_ledger(qc_file, sub, ses, runs_df):
+    runs_df = runs_df.copy()
+    runs_df['sub'] = sub
+    runs_df['ses'] = str(ses)
+    runs_df = runs_df.reindex(columns=ledger_columns)
+    
+    os.makedirs(op.dirname(qc_file), exist_ok=True)
+    with _locked(qc_file):
+        if op.isfile(qc_file):
+            ledger = read_ledger(qc_file)
+            ledger = ledger[~((ledger['sub'] == sub) & (ledger['ses'] == str(ses)))]
+            ledger = pd.concat([ledger, runs_df], ignore_index=True) if len(ledger) else runs_df
+        else:
+            ledger = runs_df
+        
+        ledger = ledger.sort_values(index_columns, kind='stable', na_position='first').reset_index(drop=True)
+        write_ledger(ledger, qc_file)
+    
+    return qc_file
+
+# define function to return the runs of a subject from the ledger (or None if the subject isn't in the ledger)
+def ledger_runs(qc_file, sub, ses):
+    ledger = read_ledger(qc_file).set_index(['sub', 'ses']).sort_index()
+    key = (sub, str(ses))
+    if key not in ledger.index:
+        return None
+    return ledger.loc[[key]].reset_index()
+
+# define function to return the runs of a subject with task, run, and MotionExclusion columns, from the ledger when the subject is in it, otherwise from the subject's scans.tsv file
+def subject_scans(derivDir, sub, ses):
+    qc_file = find_ledger(derivDir)
+    if qc_file is not None:
+        scans_df = ledger_runs(qc_file, sub, ses)
+        if scans_df is not None:
+            print('Using run information for {} from QC ledger {}'.format(sub, qc_file))
+            return scans_df
+    
+    # identify scans file (from derivDir bc artifact information is saved in the processed scans.tsv file)
+    if ses != 'no': # if session was provided
+        scans_files = glob.glob(op.join(derivDir, '{}'.format(sub), 'ses-{}'.format(ses), 'func', '*_scans.tsv'))
+    else: # if session was 'no'
+        scans_files = glob.glob(op.join(derivDir, '{}'.format(sub), 'func', '*_scans.tsv'))
+    
+    # return error if scan file not found
+    if not scans_files:
+        raise IOError('scans file not found for {}.'.format(sub))
+    
+    # read in scans file
+    scans_df = pd.read_csv(scans_files[0], sep='\t')
+    
+    # extract task and run information from filenames in scans.tsv file
+    scans_df['task'] = scans_df['filename'].str.split('task-', expand=True).loc[:,1]
+    scans_df['task'] = scans_df['task'].str.split('_', expand=True)[0]
+    scans_df['run'] = scans_df['filename'].apply(lambda x: x.split('run-')[1].split('_')[0] if 'run-' in x else None)
+    
+    return scans_df
@@ -0,0 +1,197 @@
+"""
+Functions to smooth functional data with FSL SUSAN, reusing previously smoothed data from a cache directory (used by firstlevel_pipeline.py and timecourse_pipeline.py when smooth_cache is specified in the config file)
+
+Smoothed files are saved in the cache under a key calculated from:
+    - the content (hash) of the input file
+    - the content (hash) of the mask file
+    - the smoothing kernel size (fwhm)
+    - the volumes of the input file that were smoothed (first volume and number of volumes)
+so analyses that differ in other options (e.g., contrasts or regressors) reuse the same smoothed data, regardless of where their outputs are saved.
+
+File hashes are saved in the cache (hashes.json) along with the file size and modification time, so each input file is only read to calculate its hash once.
+The cache size is limited to smooth_cache_gb (default: 100GB). When the limit is exceeded, the least recently used files are removed.
+Files are added to the cache and to the node working directories as hard links when possible (copied otherwise), so removing a file from the cache doesn't affect analyses that use it.
+Each key is locked while the data are smoothed, so nodes that need the same smoothed data at the same time (e.g., both halves of a run when the full run is smoothed before splitting) wait for the first node and then reuse its output.
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from smooth_cache import smooth_run
+
+"""
+import os
+import os.path as op
+import json
+import shutil
+import hashlib
+import fcntl
+import nibabel as nib
+from temporal_view import save_view, is_full_range
+
+# define function to read the cache settings from the config file (returns None if no cache directory was specified)
+def read_cache_settings(config_file):
+    if 'smooth_cache' not in config_file.index or config_file.loc['smooth_cache',1] is None:
+        return None
+    
+    cache_gb = 100
+    if 'smooth_cache_gb' in config_file.index and config_file.loc['smooth_cache_gb',1] is not None:
+        cache_gb = float(config_file.loc['smooth_cache_gb',1])
+    
+    return {'cache_dir': str(config_file.loc['smooth_cache',1]), 'cache_gb': cache_gb}
+
+# define function to calculate the hash of a file's content
+def _content_hash(in_file, chunk_mb=16):
+    sha = hashlib.sha1()
+    with open(in_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_mb * 1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+# define function to return the hash of a file, using the hash saved in the cache if the file hasn't changed
+def file_hash(in_file, cache_dir):
+    in_file = op.realpath(in_file)
+    stat = os.stat(in_file)
+    index_file = op.join(cache_dir, 'hashes.json')
+    os.makedirs(cache_dir, exist_ok=True)
+    
+    hashes = {}
+    if op.isfile(index_file):
+        try:
+            with open(index_file, 'r') as f:
+                hashes = json.load(f)
+        except ValueError: # index is rewritten if it can't be read
+            hashes = {}
+    
+    entry = hashes.get(in_file)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        return entry['hash']
+    
+    # calculate hash and save it to the index (written to a temporary file first so other processes don't read a partial file)
+    hashes[in_file] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': _content_hash(in_file)}
+    tmp_file = '{}.{}.tmp'.format(index_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(hashes, f)
+    os.replace(tmp_file, index_file)
+    
+    return hashes[in_file]['hash']
+
+# define function to calculate the cache key for smoothed data
+def cache_key(in_file, mask_file, fwhm, t_min, t_size, cache_dir):
+    key = {'method': 'susan',
+           'input': file_hash(in_file, cache_dir),
+           'mask': file_hash(mask_file, cache_dir),
+           'fwhm': float(fwhm),
+           't_min': int(t_min),
+           't_size': int(t_size)}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+# define function to hard link a file (copied if a link can't be made, e.g., across file systems)
+def _link_or_copy(src, dst):
+    if op.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+# define function to return the cached file for a key (or None if the key isn't in the cache)
+def lookup(cache_dir, key, ext):
+    cache_file = op.join(cache_dir, 'smoothed', '{}{}'.format(key, ext))
+    if not op.isfile(cache_file):
+        return None
+    
+    # update the modification time so the file is treated as recently used
+    os.utime(cache_file)
+    
+    return cache_file
+
+# define function to add a file to the cache
+def store(cache_dir, key, in_file, ext, cache_gb=100):
+    os.makedirs(op.join(cache_dir, 'smoothed'), exist_ok=True)
+    cache_file = op.join(cache_dir, 'smoothed', '{}{}'.format(key, ext))
+    
+    # linked to a temporary file first so other processes don't read a partial file
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    _link_or_copy(in_file, tmp_file)
+    os.replace(tmp_file, cache_file)
+    
+    evict(cache_dir, cache_gb)
+    
+    return cache_file
+
+# define function to remove the least recently used files until the cache is within the size limit
+def evict(cache_dir, cache_gb):
+    smoothedDir = op.join(cache_dir, 'smoothed')
+    files = []
+    for f in os.listdir(smoothedDir):
+        if f.endswith('.tmp'):
+            continue
+        try:
+            stat = os.stat(op.join(smoothedDir, f))
+        except FileNotFoundError: # removed by another process
+            continue
+        files.append((stat.st_mtime, stat.st_size, op.join(smoothedDir, f)))
+    
+    total = sum(size for mtime, size, f in files)
+    for mtime, size, f in sorted(files):
+        if total <= cache_gb * 1024**3:
+            break
+        print('Removing least recently used file from smoothing cache: {}'.format(f))
+        try:
+            os.remove(f)
+        except FileNotFoundError: # removed by another process
+            pass
+        total -= size
+
+# define function to smooth the selected volumes of a file with SUSAN (the smoothing workflow used by the pipelines)
+def susan_smooth(in_file, mask_file, fwhm, t_min, t_size, out_dir, out_ext='.nii.gz'):
+    from niflow.nipype1.workflows.fmri.fsl import create_susan_smooth
+    
+    # SUSAN needs a file with the selected volumes
+    roi_file = save_view(in_file, t_min, t_size, out_dir, out_ext)
+    
+    # run smoothing workflow in the output directory
+    smooth = create_susan_smooth()
+    smooth.base_dir = out_dir
+    smooth.inputs.inputnode.in_files = roi_file
+    smooth.inputs.inputnode.fwhm = fwhm
+    smooth.inputs.inputnode.mask_file = mask_file
+    graph = smooth.run()
+    
+    # return output of the smoothing workflow
+    outputnode = [node for node in graph.nodes() if node.name == 'outputnode'][0]
+    smoothed_file = outputnode.result.outputs.smoothed_files
+    
+    return smoothed_file[0] if isinstance(smoothed_file, list) else smoothed_file
+
+# define function to smooth the selected volumes of a file, using the cache if a cache directory is provided
+def smooth_run(in_file, mask_file, fwhm, t_min, t_size, out_dir, cache_dir=None, cache_gb=100, out_ext='.nii.gz'):
+    # use the number of volumes rather than -1 (all volumes), so the same volumes always have the same cache key
+    if t_size < 0:
+        t_size = nib.load(in_file).shape[3] - t_min
+    
+    # smoothed file is named as the SUSAN output (_roi is added when only some volumes are selected, as done by ExtractROI)
+    base = op.basename(in_file).split('.nii')[0]
+    out_file = op.join(out_dir, '{}{}_smooth{}'.format(base, '' if is_full_range(in_file, t_min, t_size) else '_roi', out_ext))
+    
+    if not cache_dir:
+        smoothed_file = susan_smooth(in_file, mask_file, fwhm, t_min, t_size, out_dir, out_ext)
+        _link_or_copy(smoothed_file, out_file)
+        return out_file
+    
+    key = cache_key(in_file, mask_file, fwhm, t_min, t_size, cache_dir)
+    
+    # lock key until the smoothed data are in the cache
+    os.makedirs(op.join(cache_dir, 'locks'), exist_ok=True)
+    with open(op.join(cache_dir, 'locks', '{}.lock'.format(key)), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        
+        cache_file = lookup(cache_dir, key, out_ext)
+        if cache_file:
+            print('Using previously smoothed data from the cache: {}'.format(cache_file))
+            _link_or_copy(cache_file, out_file)
+        else:
+            print('Smoothed data not found in the cache. Smoothing {} and saving to the cache'.format(in_file))
+            _link_or_copy(susan_smooth(in_file, mask_file, fwhm, t_min, t_size, out_dir, out_ext), out_file)
+            store(cache_dir, key, out_file, out_ext, cache_gb)
+    
+    return out_file
@@ -0,0 +1,82 @@
+"""
+Functions to collect and save stats tables (used by extract_stats.py and compile_stats.py)
+
+Results are collected in column buffers and written to file once, rather than appending rows to a csv file.
+Files are saved as csv or parquet depending on the file extension (parquet requires pyarrow).
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from stats_table import StatsTable
+
+"""
+import numpy as np
+import pandas as pd
+
+# define class to collect stats in columns before writing them to file
+class StatsTable:
+    def __init__(self):
+        self.chunks = []
+        self.column_names = []
+    
+    # add rows to the table (single values are repeated to match the length of any array values)
+    def append(self, **columns):
+        nrows = max([len(v) for v in columns.values() if np.ndim(v) > 0] + [1])
+        
+        chunk = {}
+        for name, value in columns.items():
+            if name not in self.column_names:
+                self.column_names.append(name)
+            
+            if np.ndim(value) > 0:
+                chunk[name] = np.asarray(value)
+            else:
+                chunk[name] = np.full(nrows, value, dtype=object)
+        
+        self.chunks.append((nrows, chunk))
+    
+    # return the number of rows in the table
+    def __len__(self):
+        return sum(n for n, chunk in self.chunks)
+    
+    # convert table to dataframe (columns missing from some rows are filled with nan)
+    def to_frame(self):
+        if not self.chunks:
+            return pd.DataFrame(columns=self.column_names)
+        
+        columns = {}
+        for name in self.column_names:
+            parts = [chunk.get(name) for n, chunk in self.chunks]
+            
+            # numeric columns found in every chunk are joined directly, other columns are joined as objects and then converted to the appropriate type
+            if all(p is not None and p.dtype != object for p in parts):
+                columns[name] = np.concatenate(parts)
+            else:
+                parts = [p.astype(object) if p is not None else np.full(n, np.nan, dtype=object) for p, (n, chunk) in zip(parts, self.chunks)]
+                columns[name] = pd.Series(np.concatenate(parts)).infer_objects()
+        
+        return pd.DataFrame(columns, columns=self.column_names)
+    
+    # save table to file
+    def write(self, out_file):
+        write_stats(self.to_frame(), out_file)
+
+# define function to save stats dataframe as csv or parquet file
+def write_stats(stats_df, out_file):
+    if out_file.endswith('.parquet'):
+        stats_df.to_parquet(out_file, index=False)
+    else:
+        stats_df.to_csv(out_file, index=False)
+
+# define function to read stats csv or parquet file
+def read_stats(stats_file):
+    if stats_file.endswith('.parquet'):
+        return pd.read_parquet(stats_file)
+    else:
+        return pd.read_csv(stats_file)
+
+# define function to return the stats file extension for the requested format (csv by default)
+def stats_extension(stats_format):
+    if stats_format == 'parquet':
+        return 'parquet'
+    else:
+        return 'csv'
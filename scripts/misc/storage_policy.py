@@ -0,0 +1,108 @@
+"""
+Functions to set how images are stored while workflows run (used by workflow_scheduler.py and the nipype pipelines)
+
+Compressing and decompressing .nii.gz files is one of the largest costs of the pipelines, and most of these files are intermediate files in the working directory.
+The storage settings are read from the config file:
+    working_format  format of images written while workflows run: nii.gz (default) or nii
+    compress_level  gzip compression level (1-9) used for the final outputs when working_format is nii (default: 6)
+
+When working_format is nii:
+    1. FSL nodes and the python nodes that save images write uncompressed .nii files, which nibabel memory maps when they are read by later nodes
+    2. once a workflow finishes, the .nii files saved by its datasinks are compressed to .nii.gz files in a pool of threads while the next workflow runs
+       (only the files listed in the datasink results are compressed, so other files in the output directories, e.g., outputs of other subjects that are still being written, are never touched)
+    3. all outputs are compressed before run_workflows returns, so the output directories have the same files as when working_format is nii.gz
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from storage_policy import working_ext
+
+"""
+import os
+import os.path as op
+import gzip
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# file extensions and FSL output types for each working format
+WORKING_FORMATS = {'nii.gz': ('.nii.gz', 'NIFTI_GZ'),
+                   'nii': ('.nii', 'NIFTI')}
+
+# define function to read the storage settings from the config file
+def read_storage_settings(config_file):
+    working_format = 'nii.gz'
+    if 'working_format' in config_file.index and config_file.loc['working_format',1] is not None:
+        working_format = str(config_file.loc['working_format',1]).lstrip('.')
+    if working_format not in WORKING_FORMATS:
+        raise ValueError('working_format should be one of {}, but found: {}'.format(list(WORKING_FORMATS), working_format))
+    
+    compress_level = 6
+    if 'compress_level' in config_file.index and config_file.loc['compress_level',1] is not None:
+        compress_level = int(float(config_file.loc['compress_level',1]))
+    
+    return {'working_format': working_format, 'compress_level': compress_level}
+
+# define function to return the file extension for images written while workflows run (read from the FSL output type if the settings aren't provided)
+def working_ext(settings=None):
+    if settings is not None:
+        return WORKING_FORMATS[settings['working_format']][0]
+    return '.nii' if os.environ.get('FSLOUTPUTTYPE') == 'NIFTI' else '.nii.gz'
+
+# define function to set the output type used by FSL nodes (must be called before the workflows are created, as nodes read the default output type when they are created)
+def set_fsl_output_type(settings):
+    from nipype.interfaces import fsl
+    output_type = WORKING_FORMATS[settings['working_format']][1]
+    fsl.FSLCommand.set_default_output_type(output_type)
+    
+    # the FSL output type is also used by the python nodes that save images (see working_ext)
+    os.environ['FSLOUTPUTTYPE'] = output_type
+
+# define function to compress a .nii file to a .nii.gz file (written to a temporary file first so a partial file is never left with the final name)
+def compress_file(nii_file, compress_level=6):
+    gz_file = nii_file + '.gz'
+    tmp_file = gz_file + '.{}.tmp'.format(os.getpid())
+    
+    with open(nii_file, 'rb') as f_in, gzip.open(tmp_file, 'wb', compresslevel=compress_level) as f_out:
+        shutil.copyfileobj(f_in, f_out, 16 * 1024 * 1024)
+    os.replace(tmp_file, gz_file)
+    os.remove(nii_file)
+    
+    return gz_file
+
+# define function to return the .nii files saved by the datasinks in an executed workflow graph (the graph returned by the workflow run call)
+def datasink_files(graph):
+    nii_files = []
+    for node in graph.nodes():
+        if type(node.interface).__name__ != 'DataSink':
+            continue
+        
+        # files (or folders) copied by the datasink are listed in its results
+        result = node.result
+        out_files = getattr(result.outputs, 'out_file', None) if result is not None and result.outputs is not None else None
+        if not out_files:
+            continue
+        for out_file in ([out_files] if isinstance(out_files, str) else out_files):
+            if op.isdir(out_file):
+                for root, dirs, files in os.walk(out_file):
+                    nii_files += [op.join(root, f) for f in files if f.endswith('.nii')]
+            elif out_file.endswith('.nii'):
+                nii_files.append(out_file)
+    
+    # files that were already compressed (e.g., datasinks reused from a previous call) are skipped
+    return sorted(f for f in set(nii_files) if op.isfile(f))
+
+# define function to compress .nii files in a pool of threads (futures are added to a dictionary by file name, so the files are compressed in the background and files that were already submitted are skipped)
+def submit_compression(executor, nii_files, compress_level, futures=None):
+    futures = {} if futures is None else futures
+    for nii_file in nii_files:
+        if nii_file not in futures:
+            futures[nii_file] = executor.submit(compress_file, nii_file, compress_level)
+    return futures
+
+# define function to compress .nii files and wait for all files to finish
+def compress_outputs(nii_files, compress_level=6, n_threads=4):
+    with ThreadPoolExecutor(max_workers=max(int(n_threads), 1)) as executor:
+        gz_files = [future.result() for future in submit_compression(executor, nii_files, compress_level).values()]
+    
+    print('Compressed {} output files'.format(len(gz_files)))
+    
+    return gz_files
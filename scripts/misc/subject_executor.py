@@ -0,0 +1,130 @@
+"""
+Functions to run a subject-level function for a list of subjects, optionally in parallel (used by define_fROIs.py, extract_stats.py, compute_neural_rdms.py, correlate_rdms.py, and check_fold_reliability.py)
+
+Subjects are processed independently in a pool of processes when more than 1 job is requested. The output for each subject is written to its own log file so output from different subjects doesn't interleave.
+Lists that the subject function appends results to (e.g., shrink_vals, fold_stats, rdm_stats) are created for each subject and merged in subject order once all subjects are done, so the merged results don't depend on which subject finishes first.
+When subjects are processed in parallel, an error for one subject doesn't stop the other subjects. If processing failed for any subject, a SubjectsFailedError is raised once all subjects are done. The merged results of the subjects that were processed are kept in the error's results, so they can still be saved.
+When subjects are processed one at a time (the default), output is shown in the terminal as usual and also copied to the subject's log file (when a log directory is given), and an error for a subject stops processing straight away.
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from subject_executor import add_jobs_argument, run_subjects
+
+"""
+import os
+import sys
+import os.path as op
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor
+
+# define error raised once all subjects are done if processing failed for any subject (the merged results of the subjects that were processed are kept in results)
+class SubjectsFailedError(RuntimeError):
+    def __init__(self, failed, results):
+        super().__init__('Processing failed for subjects: {}'.format(failed))
+        self.failed = failed
+        self.results = results
+
+# define function to add the number of parallel jobs to a command line parser
+def add_jobs_argument(parser):
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of subjects to process in parallel (default: 1)')
+    return parser
+
+# define class to write output to several streams (used to copy the terminal output to the subject's log file)
+class _Tee:
+    def __init__(self, *streams):
+        self.streams = streams
+    
+    def write(self, text):
+        for stream in self.streams:
+            stream.write(text)
+        return len(text)
+    
+    def flush(self):
+        for stream in self.streams:
+            stream.flush()
+
+# define function to run the subject function for one subject in this process (output is shown in the terminal and copied to the log file if provided, and errors are raised)
+def _run_subject_serial(func, sub, args, accumulators, log_file):
+    accs = {name: [] for name in accumulators}
+    
+    if log_file is None:
+        func(*args, **accs)
+        return accs
+    
+    with open(log_file, 'w', buffering=1) as log:
+        with redirect_stdout(_Tee(sys.stdout, log)), redirect_stderr(_Tee(sys.stderr, log)):
+            try:
+                func(*args, **accs)
+            except Exception:
+                # the traceback is shown in the terminal when the error is raised, so only write it to the log
+                log.write(traceback.format_exc())
+                raise
+    
+    return accs
+
+# define function to run the subject function for one subject in a parallel job (with output written to the log file, and errors returned rather than raised)
+def _run_subject(func, sub, args, accumulators, log_file):
+    accs = {name: [] for name in accumulators}
+    
+    with open(log_file, 'w', buffering=1) as log:
+        with redirect_stdout(log), redirect_stderr(log):
+            try:
+                func(*args, **accs)
+            except Exception:
+                traceback.print_exc()
+                return accs, traceback.format_exc()
+    
+    return accs, None
+
+# define function to run the subject function for each subject
+def run_subjects(func, subjects, subject_args, jobs=1, logDir=None, accumulators=()):
+    # subject_args is a list with the positional arguments for each subject
+    # accumulators are the names of list arguments that the subject function appends results to
+    
+    # initialise merged outputs
+    merged = {name: [] for name in accumulators}
+    
+    if logDir is not None:
+        os.makedirs(logDir, exist_ok=True)
+    elif jobs is not None and jobs > 1:
+        raise ValueError('A log directory is required to process subjects in parallel')
+    log_files = [op.join(logDir, '{}.log'.format(sub)) if logDir is not None else None for sub in subjects]
+    
+    if jobs is None or jobs <= 1:
+        # run subjects one at a time in this process (stopping at the first error)
+        if logDir is not None:
+            print('Processing {} subjects one at a time. Subject logs will be saved to: {}'.format(len(subjects), logDir))
+        for sub, args, log_file in zip(subjects, subject_args, log_files):
+            accs = _run_subject_serial(func, sub, args, accumulators, log_file)
+            print('Finished processing {}'.format(sub))
+            for name in accumulators:
+                merged[name].extend(accs[name])
+        failed = []
+    else:
+        # run subjects in parallel
+        print('Processing {} subjects using {} parallel jobs. Subject logs will be saved to: {}'.format(len(subjects), jobs, logDir))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_run_subject, func, sub, args, accumulators, log_file) for sub, args, log_file in zip(subjects, subject_args, log_files)]
+            failed = _merge_outputs(subjects, (future.result() for future in futures), log_files, accumulators, merged)
+    
+    if failed:
+        raise SubjectsFailedError(failed, merged)
+    
+    return merged
+
+# define function to merge the outputs of the subjects that were processed, in subject order (returns the subjects that failed)
+def _merge_outputs(subjects, outputs, log_files, accumulators, merged):
+    failed = []
+    for sub, log_file, (accs, error) in zip(subjects, log_files, outputs):
+        if error is not None:
+            print('ERROR: processing failed for {}.{}'.format(sub, ' See log: {}'.format(log_file) if log_file is not None else ''))
+            failed.append(sub)
+            continue
+        
+        print('Finished processing {}'.format(sub))
+        for name in accumulators:
+            merged[name].extend(accs[name])
+    
+    return failed
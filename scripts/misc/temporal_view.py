@@ -0,0 +1,111 @@
+"""
+Functions to select a range of volumes from a 4D file without writing a copy of the data (used by firstlevel_pipeline.py and timecourse_pipeline.py)
+
+Dropping volumes and splitting runs into halves were previously done by 2 ExtractROI nodes, which each wrote a full copy of the data (even when all volumes were kept).
+Instead, the 2 steps are combined into a single volume range (the view) that is passed to later nodes along with the original file:
+    - nodes that run in python load only the volumes in the view (uncompressed files are memory mapped)
+    - a file with the volumes in the view is only written when it is needed by an FSL tool (e.g., SUSAN smoothing), and never when the view includes all volumes
+    - the pipelines save a 3D reference image (the first volume in the view) as a preproc output rather than a copy of the run, as later scripts only read the image dimensions and affine from it
+    - the volumes in the view can also be read in blocks (iter_volume_blocks), so functions that only need summary values never hold the full run in memory
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from temporal_view import view_range, load_view, save_view, save_reference
+
+"""
+import os
+import os.path as op
+import numpy as np
+import nibabel as nib
+from nibabel.openers import ImageOpener
+from parallel_gzip import save_nifti
+
+# define function to return the first volume and number of volumes after dropping volumes (matches the ExtractROI options previously used)
+def dropped_range(fileVols, dropvols, nVols):
+    if dropvols > 0:
+        # drop from start
+        return dropvols, fileVols - dropvols
+    elif dropvols < 0:
+        # drop from end (nVols is the number of volumes in the run minus the dropped volumes)
+        return 0, min(nVols, fileVols)
+    else:
+        return 0, fileVols
+
+# define function to combine the dropped volumes and the split half volumes into a single range of the original file
+def view_range(fileVols, dropvols, nVols, t_min, t_size):
+    drop_min, drop_size = dropped_range(fileVols, dropvols, nVols)
+    
+    # t_min and t_size are relative to the data after dropping volumes (a t_size of -1 means all remaining volumes)
+    if t_size < 0 or t_min + t_size > drop_size:
+        t_size = drop_size - t_min
+    
+    return drop_min + t_min, t_size
+
+# define function to check whether a range includes all volumes in a file
+def is_full_range(in_file, t_min, t_size):
+    fileVols = nib.load(in_file).shape[3]
+    return t_min == 0 and (t_size < 0 or t_size >= fileVols)
+
+# define function to load the volumes in a range as an image (only these volumes are read from the file)
+def load_view(in_file, t_min=0, t_size=-1):
+    img = nib.load(in_file)
+    if is_full_range(in_file, t_min, t_size):
+        return img
+    return img.slicer[..., t_min:t_min + t_size]
+
+# define function to save the volumes in a range to a file (the input file is returned if the range includes all volumes)
+def save_view(in_file, t_min, t_size, out_dir, out_ext='.nii.gz'):
+    if is_full_range(in_file, t_min, t_size):
+        return in_file
+    
+    # save file with the same name used by ExtractROI
+    out_file = op.join(out_dir, op.basename(in_file).split('.nii')[0] + '_roi' + out_ext)
+    save_nifti(load_view(in_file, t_min, t_size), out_file)
+    
+    return out_file
+
+# define function to save the first volume in a range as a 3D reference image (saved in a reference folder with the same file name as save_view)
+def save_reference(in_file, t_min, out_dir, out_ext='.nii.gz'):
+    ref_dir = op.join(out_dir, 'reference')
+    os.makedirs(ref_dir, exist_ok=True)
+    
+    out_file = op.join(ref_dir, op.basename(in_file).split('.nii')[0] + '_roi' + out_ext)
+    save_nifti(nib.load(in_file).slicer[..., t_min], out_file)
+    
+    return out_file
+
+# define function to read blocks of volumes in a range from a functional file (each block is volumes x voxels, with the voxels in the order they are saved)
+def iter_volume_blocks(in_file, t_min=0, t_size=-1, block_mb=64):
+    img = nib.load(in_file)
+    proxy = img.dataobj
+    fileVols = img.shape[3] if len(img.shape) > 3 else 1
+    nVox = int(np.prod(img.shape[:3]))
+    t_end = fileVols if t_size < 0 else min(t_min + t_size, fileVols)
+    
+    # number of volumes in each block
+    vol_bytes = nVox * proxy.dtype.itemsize
+    block_vols = max(1, int(block_mb * 1024**2 // vol_bytes))
+    
+    data_file = img.file_map['image'].filename
+    if not data_file.endswith('.gz') and not data_file.endswith('.bz2'):
+        # uncompressed files are memory mapped
+        data = np.memmap(data_file, dtype=proxy.dtype, mode='r', offset=proxy.offset, shape=(fileVols, nVox))
+        for t0 in range(t_min, t_end, block_vols):
+            yield _scale(np.asarray(data[t0:min(t0 + block_vols, t_end)]), proxy)
+    else:
+        # compressed files are read in order so the data are only decompressed once
+        with ImageOpener(data_file, 'rb') as f:
+            f.seek(proxy.offset + t_min * vol_bytes)
+            for t0 in range(t_min, t_end, block_vols):
+                n = min(block_vols, t_end - t0)
+                block = np.frombuffer(f.read(n * vol_bytes), dtype=proxy.dtype)
+                yield _scale(block.reshape(n, nVox), proxy)
+
+# define function to apply the scaling in the image header (as done when the data are loaded as float32 by nibabel)
+def _scale(block, proxy):
+    block = block.astype(np.float32)
+    slope = proxy.slope if proxy.slope is not None and np.isfinite(proxy.slope) and proxy.slope != 0 else 1
+    inter = proxy.inter if proxy.inter is not None and np.isfinite(proxy.inter) else 0
+    if slope != 1 or inter != 0:
+        block = block * np.float32(slope) + np.float32(inter)
+    return block
@@ -0,0 +1,172 @@
+"""
+Functions to run nipype workflows using the resource settings in the config file (used by firstlevel_pipeline.py, timecourse_pipeline.py, and combine_runs.py)
+
+The MultiProc plugin settings are read from the config file rather than using a fixed number of processes:
+    n_procs         number of processes (default: 4)
+    memory_gb       memory available to the workflow in GB (default: nipype estimates this from the system)
+    node_mem_gb     estimated memory in GB for specific nodes, e.g.: filmgls=4,susan_smooth.smooth=2
+    node_n_procs    estimated number of processes for specific nodes, e.g.: filmgls=1
+    meta_workflow   whether to combine the workflows for all subjects into a single workflow (default: no)
+    incremental     whether to keep the working directories from previous calls so nodes whose inputs haven't changed are not rerun (default: no)
+
+Node names can include wildcards (e.g., susan_smooth.*) and are matched to the node name or to the end of the node name within its workflow (e.g., susan_smooth.smooth).
+When meta_workflow is yes, the subject workflows are run together so the plugin can fit expensive nodes (e.g., FILMGLS and SUSAN) from different subjects into the available processes and memory, rather than running one subject at a time.
+The combined workflow is placed so that each subject workflow uses the same working directory as when it is run on its own.
+
+When incremental is yes, the hash of each node is saved to a manifest in the working directory of each workflow once it finishes, and the nodes that were run with new inputs are printed (see hash_manifest.py).
+
+The storage settings (working_format and compress_level, see storage_policy.py) are read along with the plugin settings. When working_format is nii, the files saved by the datasinks of each workflow are compressed in the background once the workflow finishes.
+
+Scripts outside this folder add it to the path before importing, e.g.:
+sys.path.append(op.join(op.dirname(op.dirname(op.abspath(__file__))), 'misc'))
+from workflow_scheduler import read_plugin_settings, run_workflows
+
+"""
+import os.path as op
+import re
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from nipype import Workflow
+from storage_policy import read_storage_settings, set_fsl_output_type, datasink_files, submit_compression
+from hash_manifest import node_hashes, update_manifest, report_changes
+
+# define function to read a config value, returning the default if the field is missing or empty
+def _config_value(config_file, key, default=None):
+    if key in config_file.index and config_file.loc[key,1] is not None:
+        return config_file.loc[key,1]
+    else:
+        return default
+
+# define function to convert node resource estimates from the config file (e.g., filmgls=4,susan_smooth.*=2) to a dictionary
+def _parse_node_values(values, value_type):
+    node_values = {}
+    if values is None:
+        return node_values
+    
+    for entry in str(values).replace(' ','').split(','):
+        if not entry:
+            continue
+        if '=' not in entry:
+            raise ValueError('Node resource estimates should be formatted as node=value, but found: {}'.format(entry))
+        node, value = entry.split('=')
+        node_values[node] = value_type(value)
+    
+    return node_values
+
+# define function to read plugin settings from the config file
+def read_plugin_settings(config_file, plugin=None):
+    # run multiproc unless plugin specified in script call
+    plugin = plugin if plugin else 'MultiProc'
+    
+    # plugin arguments
+    plugin_args = {'n_procs': int(float(_config_value(config_file, 'n_procs', 4)))}
+    memory_gb = _config_value(config_file, 'memory_gb')
+    if memory_gb is not None:
+        plugin_args['memory_gb'] = float(memory_gb)
+    
+    settings = {'plugin': plugin,
+                'plugin_args': plugin_args,
+                'node_mem_gb': _parse_node_values(_config_value(config_file, 'node_mem_gb'), float),
+                'node_n_procs': _parse_node_values(_config_value(config_file, 'node_n_procs'), int),
+                'meta_workflow': _config_value(config_file, 'meta_workflow', 'no'),
+                'incremental': _config_value(config_file, 'incremental', 'no'),
+                'storage': read_storage_settings(config_file)}
+    
+    print('Workflows will be run using the {} plugin with settings: {}'.format(plugin, plugin_args))
+    
+    # set the file type written by FSL nodes (done here because the settings are read before the workflows are created)
+    set_fsl_output_type(settings['storage'])
+    if settings['storage']['working_format'] == 'nii':
+        print('Images will be saved uncompressed while workflows run and outputs will be compressed (level {}) once each workflow finishes'.format(settings['storage']['compress_level']))
+    if settings['incremental'] == 'yes':
+        print('Working directories from previous calls will be kept, so only nodes with new inputs will be rerun')
+    
+    return settings
+
+# define function to check whether a node matches a node name from the config file
+def _match_node(node, pattern):
+    return fnmatch(node.name, pattern) or fnmatch(node.fullname, pattern) or fnmatch(node.fullname, '*.' + pattern)
+
+# define function to set the resource estimates for nodes in a workflow
+def set_node_resources(wf, settings):
+    for node in wf._get_all_nodes():
+        for pattern, mem_gb in settings['node_mem_gb'].items():
+            if _match_node(node, pattern):
+                node._mem_gb = mem_gb # mem_gb can only be set through the private attribute after the node is created
+        
+        for pattern, n_procs in settings['node_n_procs'].items():
+            if _match_node(node, pattern):
+                node.n_procs = n_procs
+    
+    return wf
+
+# define function to save the node hashes of a workflow after it runs and print the nodes that were run with new inputs
+def _save_manifest(graph, wf, wfDir):
+    changed = update_manifest(graph, wfDir)
+    report_changes(wf.name, changed, len(node_hashes(graph, wfDir)))
+
+# define function to run a list of workflows (each workflow on its own, or together in a single workflow)
+def run_workflows(workflows, workDir, settings):
+    # set node resource estimates
+    for wf in workflows:
+        set_node_resources(wf, settings)
+    
+    # compress uncompressed outputs in the background (only used when the working format is nii)
+    storage = settings.get('storage', {'working_format': 'nii.gz'})
+    compressor = ThreadPoolExecutor(max_workers=settings['plugin_args']['n_procs']) if storage['working_format'] == 'nii' else None
+    futures = {}
+    
+    try:
+        # run each workflow on its own
+        if settings['meta_workflow'] != 'yes':
+            for wf in workflows:
+                graph = wf.run(plugin=settings['plugin'], plugin_args=settings['plugin_args'])
+                if settings.get('incremental') == 'yes':
+                    _save_manifest(graph, wf, op.join(wf.base_dir, wf.name))
+                if compressor:
+                    submit_compression(compressor, datasink_files(graph), storage['compress_level'], futures)
+        else:
+            _run_meta_workflows(workflows, workDir, settings, compressor, futures)
+    finally:
+        # wait for all outputs to be compressed
+        if compressor:
+            compressed = [future.result() for future in futures.values()]
+            compressor.shutdown()
+            print('Compressed {} output files'.format(len(compressed)))
+
+# define function to run workflows together in a single workflow
+def _run_meta_workflows(workflows, workDir, settings, compressor, futures):
+    # nipype saves nodes to base_dir/workflow name/subject workflow name/node name, so the combined workflow is named after the working directory to keep the subject working directories the same
+    base_dir, name = op.split(op.realpath(workDir))
+    if not re.match(r'^[\w-]+$', name):
+        raise ValueError('Working directory name {} cannot be used as a workflow name when meta_workflow is yes'.format(name))
+    
+    # workflows with the same name share a working directory, so they are combined into separate batches that are run in order
+    batches = []
+    for wf in workflows:
+        for batch in batches:
+            if wf.name not in [b.name for b in batch]:
+                batch.append(wf)
+                break
+        else:
+            batches.append([wf])
+    
+    for batch in batches:
+        print('Running {} workflows together: {}'.format(len(batch), [wf.name for wf in batch]))
+        
+        # combine workflows into a single workflow
+        meta = Workflow(name=name, base_dir=base_dir)
+        meta.add_nodes(batch)
+        
+        # use the workflow options from the subject workflows
+        meta.config['execution'] = dict(batch[0].config['execution'])
+        
+        graph = meta.run(plugin=settings['plugin'], plugin_args=settings['plugin_args'])
+        
+        # subject workflows are saved in the same working directories as when they are run on their own
+        if settings.get('incremental') == 'yes':
+            for wf in batch:
+                _save_manifest(graph, wf, op.join(workDir, wf.name))
+        
+        if compressor:
+            submit_compression(compressor, datasink_files(graph), settings['storage']['compress_level'], futures)